@@ -3,8 +3,25 @@
 import serial
 import bluetooth
 import glob
+import os
+import time
 import datetime
+import array
+import struct
+import hashlib
+import tempfile
+import shutil
+import threading
+import weakref
+import collections
+import concurrent.futures
+import json
+import gzip
+import select
+from xml.sax.saxutils import escape
+import numpy as np
 import pygal
+import pygal.style
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import csv
@@ -21,6 +38,19 @@ class CMS50EW():
         self.starttime = 0
         self.stored_data = []
         self.stored_data_time = 0
+        self.session_file = None # File the session was opened from
+        self.aggregator = SampleAggregator() # Summarises live data, see below
+        self.waveform = None # WaveformBuffer if plethysmogram capture is enabled
+        self.live_data = None # LiveDataStore holding full rate live data for plots
+        self.timebase = None # Timebase providing the times of live data frames
+        self.capture = None # CaptureWriter recording all received bytes
+        self.is_replay = False
+        self.checkpoint_file = None # Set up by self.open_checkpoint()
+        self.checkpoint_data = []
+        self.checkpoint_buffer = []
+        self.checkpoint_complete = False
+        self.checkpoint_batch = 100 # Number of data points written at once
+        self.chart_style = pygal.style.DefaultStyle # Style of Pygal charts
         # Most of the following commands we don't use. They are just there as
         # some sort of documentation
         self.cmd_hello1 = b'\x7d\x81\xa7\x80\x80\x80\x80\x80\x80'
@@ -41,10 +71,22 @@ class CMS50EW():
         self.cmd_session_stuff = b'\x7d\x81\xaf\x80\x80\x80\x80\x80\x80'
         self.cmd_get_live_data = b'\x7d\x81\xa1\x80\x80\x80\x80\x80\x80'
         
-    def setup_device(self, target, is_bluetooth=False):
+    def setup_device(self, target, is_bluetooth=False, is_replay=False, speed=1.0):
+        """
+        Connects to a device via serial port or Bluetooth. With is_replay, target
+        is a file recorded via self.start_capture() instead, which is played back
+        at the given speed (0 for as fast as possible); see ReplayTransport.
+        """
         self.target = target
         self.is_bluetooth = is_bluetooth
-        if self.is_bluetooth:
+        self.is_replay = is_replay
+        if self.is_replay:
+            try:
+                self.replay = ReplayTransport(self.target, speed=speed)
+            except (OSError, ValueError):
+                return False
+            return True
+        elif self.is_bluetooth:
             self.btsock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
             try:
                 self.btsock.connect((self.target, 1))
@@ -78,17 +120,77 @@ class CMS50EW():
         self.recv()
         return True
         
+    def read(self, bytes=1):
+        """
+        Reads from device; returns an empty result if nothing arrives in time
+        (or raises bluetooth.btcommon.BluetoothError on Bluetooth).
+        """
+        if self.is_replay:
+            response = self.replay.read(bytes)
+        elif self.is_bluetooth:
+            response = self.btsock.recv(bytes)
+        else:
+            response = self.ser.read(bytes)
+        if self.capture is not None:
+            self.capture.write(response)
+        return response
+        
+    def fileno(self):
+        """Returns the file descriptor of the connection, or None if there is none."""
+        try:
+            if self.is_replay:
+                return None
+            elif self.is_bluetooth:
+                return self.btsock.fileno()
+            else:
+                return self.ser.fileno()
+        except (AttributeError, OSError):
+            return None
+        
+    def wait_readable(self, timeout):
+        """
+        Blocks until data can be read from the device or timeout seconds have
+        passed and returns whether data is available. Without a file descriptor
+        to wait on, e.g. when replaying, data is always considered available.
+        """
+        fd = self.fileno()
+        if fd is None:
+            return True
+        return bool(select.select([fd], [], [], timeout)[0])
+        
+    def read_available(self):
+        """Reads all bytes received so far at once, at least one unless the read times out."""
+        if self.is_replay or self.is_bluetooth:
+            return self.read(4096)
+        return self.read(self.ser.in_waiting or 1)
+        
+    def start_capture(self, filename):
+        """Records all bytes received from now on in a file; see CaptureWriter."""
+        self.capture = CaptureWriter(filename)
+        
+    def new_timebase(self):
+        """
+        Returns a Timebase for the live data frames of this connection. Frames
+        of a replayed capture are timed by the capture's clock, so that they
+        keep their recorded timing at any replay speed.
+        """
+        if self.is_replay:
+            return Timebase(clock=lambda: self.replay.clock, epoch=self.replay.starttime)
+        return Timebase()
+        
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        
     def recv(self, bytes=1):
         """Receives entire response from device and saves it in list."""
         response_list = []
         while True:
-            if self.is_bluetooth:
-                try:
-                    response = self.btsock.recv(bytes)
-                except bluetooth.btcommon.BluetoothError:
-                    response = False
-            else:
-                response = self.ser.read()
+            try:
+                response = self.read(bytes)
+            except (bluetooth.btcommon.BluetoothError, EOFError):
+                response = False
                 
             if response:
                 response_list.append(response)
@@ -96,12 +198,47 @@ class CMS50EW():
                 break
         return response_list
         
+    def stop_stream(self, quiet=0.2, limit=3):
+        """
+        Stops the device sending session data and brings it back into a defined
+        state: the hello command interrupts the stream, and whatever is still
+        on its way is discarded until the connection has been quiet for 'quiet'
+        seconds (at most 'limit' seconds) rather than waiting out the usual
+        receive timeout. When replaying, the rest of the current burst of data
+        is skipped instead.
+        """
+        if self.is_replay:
+            self.replay.discard()
+            return self.initiate_device()
+        self.send_cmd(self.cmd_hello1)
+        if self.is_bluetooth:
+            self.btsock.settimeout(quiet)
+        else:
+            previous_timeout = self.ser.timeout
+            self.ser.timeout = quiet
+        try:
+            deadline = time.monotonic() + limit
+            while time.monotonic() < deadline:
+                try:
+                    if not self.read(4096):
+                        break
+                except bluetooth.btcommon.BluetoothError:
+                    break
+        finally:
+            if self.is_bluetooth:
+                self.btsock.settimeout(1)
+            else:
+                self.ser.timeout = previous_timeout
+        return self.initiate_device()
+    
     def send_cmd(self, cmd, debug=False):
         """
         Sends specified command to device and prints debug output if debug flag
         is set.
         """
-        if self.is_bluetooth:
+        if self.is_replay:
+            pass # Replayed data doesn't depend on commands
+        elif self.is_bluetooth:
             self.btsock.send(cmd)
         else:
             self.ser.write(cmd)
@@ -118,9 +255,9 @@ class CMS50EW():
             
     def get_session_count(self):
         """Checks if stored data is available and stores result in self.sess_available."""
-        self.send_cmd(self.cmd_get_session_count)
-        response = self.recv()
+        self.parse_session_count(self.query(self.cmd_get_session_count))
         
+    def parse_session_count(self, response):
         session_count = ord(response[3]) & 0x7f
         if session_count == 1:
             self.sess_available = 'Yes'
@@ -129,9 +266,9 @@ class CMS50EW():
     
     def get_session_duration(self):
         """Retrieves session duration, calculates data points"""
-        self.send_cmd(self.cmd_get_session_duration)
-        response = self.recv()
+        self.parse_session_duration(self.query(self.cmd_get_session_duration))
         
+    def parse_session_duration(self, response):
         response_conv = []
         for r in response:
             response_conv.append(ord(r) & 0x7f)
@@ -146,33 +283,92 @@ class CMS50EW():
         self.sess_duration = datetime.timedelta(seconds=duration_seconds)
         self.sess_data_points = round(self.sess_duration.total_seconds() / 3)
         
+    def parse_string(self, response):
+        """Extracts the alphanumeric characters of a response."""
+        return ''.join([chr(ord(r) & 0x7f) for r in response if chr(ord(r) & 0x7f).isalnum()])
+        
+    def query(self, cmd):
+        """
+        Sends a single query and returns the reply. The reply's type is noted
+        in reply_types, so that get_device_info() can tell the replies apart
+        when sending several queries at once.
+        """
+        self.send_cmd(cmd)
+        response = self.recv()
+        reply_type = next((ord(r) for r in response if ord(r) < 0x80), None)
+        if reply_type is not None:
+            reply_types[cmd] = reply_type
+        return response
+        
     def get_vendor(self):
         """Retrieves vendor and stores it in self.vendor."""
-        self.send_cmd(self.cmd_get_vendor)
-        response = self.recv()
-        self.vendor = ''.join([chr(ord(r) & 0x7f) for r in response if chr(ord(r) & 0x7f).isalnum()])
+        self.vendor = self.parse_string(self.query(self.cmd_get_vendor))
     
     def get_model(self):
         """Retrieves model and stores it in self.model."""
-        self.send_cmd(self.cmd_get_model)
-        response = self.recv()
-        self.model = ''.join([chr(ord(r) & 0x7f) for r in response if chr(ord(r) & 0x7f).isalnum()])
+        self.model = self.parse_string(self.query(self.cmd_get_model))
         
     def get_user(self):
         """Retrieves user and stores it in self.user."""
-        self.send_cmd(self.cmd_get_user_info)
-        response = self.recv()
-        self.user = ''.join([chr(ord(r) & 0x7f) for r in response if chr(ord(r) & 0x7f).isalnum()])
+        self.user = self.parse_string(self.query(self.cmd_get_user_info))
+        
+    def get_deviceid(self):
+        """Retrieves device ID and stores it in self.deviceid."""
+        self.deviceid = self.parse_string(self.query(self.cmd_get_deviceid))
+        
+    def get_device_info(self, max_age=60):
+        """
+        Retrieves model, vendor, user, device ID, session count and session
+        duration at once and returns them as dictionary (None if the device
+        doesn't respond). Instead of waiting out the receive timeout after each
+        query, all queries are sent in a row and the responses are told apart
+        by the reply type each query got before (see reply_types); as long as
+        these aren't known, the queries are sent one at a time. Results are
+        cached per device for max_age seconds.
+        """
+        info = cached_device_info(self.target, max_age)
+        if info is None:
+            if not self.initiate_device():
+                return None
+            queries = [self.cmd_get_model, self.cmd_get_vendor, self.cmd_get_user_info,
+                       self.cmd_get_deviceid, self.cmd_get_session_count,
+                       self.cmd_get_session_duration]
+            types = [reply_types.get(cmd) for cmd in queries]
+            replies = {}
+            if None not in types and len(set(types)) == len(types):
+                for cmd in queries:
+                    self.send_cmd(cmd)
+                replies = split_replies(self.recv())
+            if all(t in replies for t in types):
+                model, vendor, user, deviceid, session_count, session_duration = [replies[t] for t in types]
+                self.model = self.parse_string(model)
+                self.vendor = self.parse_string(vendor)
+                self.user = self.parse_string(user)
+                self.deviceid = self.parse_string(deviceid)
+                self.parse_session_count(session_count)
+                self.parse_session_duration(session_duration)
+            else:
+                # Reply types unknown or replies missing; one query at a time
+                self.get_model()
+                self.get_vendor()
+                self.get_user()
+                self.get_deviceid()
+                self.get_session_count()
+                self.get_session_duration()
+            info = {'model': self.model, 'vendor': self.vendor, 'user': self.user,
+                    'deviceid': self.deviceid, 'sess_available': self.sess_available,
+                    'sess_duration': self.sess_duration, 'sess_data_points': self.sess_data_points}
+            device_info_cache[self.target] = (time.monotonic(), info)
+        for key, value in info.items():
+            setattr(self, key, value)
+        return info
                         
     def process_data(self):
         """Reads data from device and returns key values."""
         counter = 1
         value_list = []
         while counter < 9:
-            if self.is_bluetooth:
-                value = self.btsock.recv(1)
-            else:
-                value = self.ser.read()
+            value = self.read()
             # The following if clause basically functions to discard the first
             # bunch of data  which is of no use to us; the list of values we
             # need starts with a 1.
@@ -193,8 +389,18 @@ class CMS50EW():
         pulse_rate = int(ord(value_list[5]) & 0x7f)
         spo2 = int(ord(value_list[6]) & 0x7f)
         
+        if self.waveform is not None:
+            self.waveform.append(ord(value_list[2]) & 0x7f)
+        
         return [finger, pulse_rate, spo2]
     
+    def enable_waveform(self, filename=None, capacity=3600):
+        """
+        Captures the plethysmogram sent with every live data frame in a
+        WaveformBuffer; see there for the meaning of the arguments.
+        """
+        self.waveform = WaveformBuffer(filename=filename, capacity=capacity)
+    
     def download_data(self):
         """
         Downloads stored session data from device one value at a time to allow
@@ -204,15 +410,140 @@ class CMS50EW():
         """
         try: 
             data = self.process_data()
-        except (TypeError, bluetooth.btcommon.BluetoothError): # These exceptions are raised when there is no data left to download
+        except (TypeError, EOFError, bluetooth.btcommon.BluetoothError): # These exceptions are raised when there is no data left to download
             self.stored_data_time = 0 # Reset the timer
             print('No data left to download')
+            if self.checkpoint_file:
+                self.finish_checkpoint(ended=True)
             return False
         else:
             data.insert(0, self.stored_data_time)
             self.stored_data.append(data)
             self.stored_data_time += 3 # A data point is stored every three seconds
+            if self.checkpoint_file:
+                self.update_checkpoint(data)
             return True
+            
+    def open_checkpoint(self, directory=None):
+        """
+        Sets up a checkpoint file for the session stored on the device and loads
+        the data points an earlier, interrupted download left in it. The file is
+        keyed by device ID, target and session duration, so
+        self.get_session_duration() has to be called first. As units may share a
+        user-set device ID and sessions their duration, checkpointed data points
+        are still verified against the device; see self.resume_checkpoint().
+        Returns the number of data points found in the checkpoint.
+        """
+        if directory is None:
+            cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+            directory = os.path.join(cache_dir, 'cms50ew', 'checkpoints')
+        os.makedirs(directory, exist_ok=True)
+        
+        device = ''.join([c for c in getattr(self, 'deviceid', '') if c.isalnum()])
+        target = ''.join([c for c in str(self.target) if c.isalnum()])
+        duration = int(self.sess_duration.total_seconds() * 2)
+        self.checkpoint_file = os.path.join(directory, device + '_' + target + '_' + str(duration) + '.csv')
+        self.checkpoint_data = []
+        self.checkpoint_buffer = []
+        self.checkpoint_complete = False
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r') as f:
+                for row in csv.reader(f):
+                    if row == ['end']: # Written once a download ran to completion
+                        self.checkpoint_complete = True
+                    else:
+                        self.checkpoint_data.append([int(row[0]), row[1], int(row[2]), int(row[3])])
+        return len(self.checkpoint_data)
+    
+    def update_checkpoint(self, data):
+        """
+        Verifies a freshly downloaded data point against the checkpoint or queues
+        it to be appended to the checkpoint file.
+        """
+        index = len(self.stored_data) - 1
+        if index < len(self.checkpoint_data):
+            if self.checkpoint_data[index] == data:
+                return # Already checkpointed
+            # The checkpoint doesn't belong to the session on the device (anymore),
+            # so it's rewritten from what has just been verified
+            print('Checkpoint does not match device data; discarding it')
+            self.checkpoint_data = []
+            self.checkpoint_complete = False
+            self.checkpoint_buffer = [list(d) for d in self.stored_data]
+            open(self.checkpoint_file, 'w').close()
+        else:
+            self.checkpoint_buffer.append(list(data))
+        if len(self.checkpoint_buffer) >= self.checkpoint_batch:
+            self.flush_checkpoint()
+    
+    def flush_checkpoint(self):
+        """Appends queued data points to the checkpoint file."""
+        if self.checkpoint_buffer:
+            with open(self.checkpoint_file, 'a') as f:
+                datawriter = csv.writer(f, delimiter=',')
+                datawriter.writerows(self.checkpoint_buffer)
+            self.checkpoint_buffer = []
+    
+    def finish_checkpoint(self, ended=False):
+        """
+        Flushes the checkpoint once a download stops, whether it ran to completion,
+        was aborted or lost its connection. Data points which only an earlier
+        download got hold of are appended to self.stored_data from the checkpoint.
+        The checkpoint is marked complete once all data points are there, or if
+        the device 'ended' sending data on its own with at most one data point
+        less than expected: the expected number is only derived from the rounded
+        session duration.
+        """
+        self.flush_checkpoint()
+        if len(self.stored_data) < len(self.checkpoint_data):
+            print('Restoring', len(self.checkpoint_data) - len(self.stored_data),
+                  'data points from checkpoint')
+            self.stored_data.extend([list(d) for d in self.checkpoint_data[len(self.stored_data):]])
+        expected = self.sess_data_points - 1 if ended else self.sess_data_points
+        if not self.checkpoint_complete and self.stored_data and len(self.stored_data) >= expected:
+            with open(self.checkpoint_file, 'a') as f:
+                f.write('end\n')
+            self.checkpoint_complete = True
+        self.checkpoint_data = [list(d) for d in self.stored_data]
+        
+    def resume_checkpoint(self):
+        """
+        Uses a complete checkpoint as session data instead of processing the
+        download again, once the first self.checkpoint_batch data points sent by
+        the device match it. Otherwise the checkpoint belongs to another session
+        and is discarded. Returns False if a download is necessary.
+        """
+        if not self.checkpoint_complete:
+            return False
+        self.send_cmd(self.cmd_get_session_data)
+        expected = self.checkpoint_data[:self.checkpoint_batch]
+        received = []
+        while len(received) < len(expected):
+            try:
+                data = self.process_data()
+            except (TypeError, EOFError, bluetooth.btcommon.BluetoothError):
+                break
+            received.append([len(received) * 3] + data)
+        # The rest of the session isn't needed, so the device is stopped rather
+        # than sending all of it again
+        self.stop_stream()
+        if received != expected:
+            print('Checkpoint does not match device data; discarding it')
+            self.checkpoint_data = []
+            self.checkpoint_complete = False
+            open(self.checkpoint_file, 'w').close()
+            return False
+        self.stored_data = [list(d) for d in self.checkpoint_data]
+        return True
+        
+    def remove_checkpoint(self):
+        """Deletes the checkpoint file once the session has been saved."""
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        self.checkpoint_file = None
+        self.checkpoint_data = []
+        self.checkpoint_buffer = []
+        self.checkpoint_complete = False
         
     def convert_datetime(self):
         """Replaces time deltas with absolute time."""
@@ -227,22 +558,182 @@ class CMS50EW():
                                    + enddatetime.strftime('%d %B %Y, %H:%M:%S'))
         
     def write_csv(self, filename):
-        """Writes session data as CSV file."""
+        """
+        Writes session data as CSV file; the checkpoint of a completely
+        downloaded session is deleted.
+        """
         with open(filename, 'w') as f:
             datawriter = csv.writer(f, delimiter=',')
             datawriter.writerow([self.x_label, 'Finger out', 'Pulse rate [bpm]', 'SpO2 [%]'])
             datawriter.writerows(self.stored_data)
+        write_session_summary(filename)
+        if self.checkpoint_file and self.checkpoint_complete:
+            # An incomplete session is kept in the checkpoint to be resumed
+            self.remove_checkpoint()
+    
+    def get_seconds(self):
+        """Returns the time of every data point in seconds since the start as numpy array."""
+        if self.x_label == 'Time':
+            # convert_datetime() has replaced the seconds with strings
+            return np.array(self.x_values, dtype=np.float64)
+        return np.fromiter((data[0] for data in self.stored_data), dtype=np.float64,
+                           count=len(self.stored_data))
+    
+    def get_columns(self):
+        """
+        Returns session data as typed numpy arrays 'timestamp', 'finger' (True
+        if finger out), 'pulse' and 'spo2'. Timestamps are absolute (datetime64)
+        if a start time was set via self.convert_datetime() and relative
+        (timedelta64) otherwise.
+        """
+        n = len(self.stored_data)
+        seconds = self.get_seconds()
+        timestamp = np.round(seconds * 1000).astype('timedelta64[ms]')
+        if self.x_label == 'Time':
+            timestamp = np.datetime64(self.pydatetime, 'ms') + timestamp
+        return {'timestamp': timestamp,
+                'finger': np.fromiter((data[1] == 'Y' for data in self.stored_data), dtype=bool, count=n),
+                'pulse': np.fromiter((data[2] for data in self.stored_data), dtype=np.uint8, count=n),
+                'spo2': np.fromiter((data[3] for data in self.stored_data), dtype=np.uint8, count=n)}
+    
+    def get_pyramid(self):
+        """
+        Returns a MinMaxPyramid of pulse rate and SpO2 for plotting, cached beside
+        the session file if the session was opened from one.
+        """
+        columns = self.get_columns()
+        channels = {'pulse': columns['pulse'], 'spo2': columns['spo2']}
+        if self.session_file:
+            return session_pyramid(self.session_file, self.get_seconds(), channels)
+        return MinMaxPyramid(self.get_seconds(), channels)
+    
+    def get_metadata(self):
+        """Returns what is known about the session as a dictionary of strings."""
+        metadata = {'title': self.plot_title}
+        if self.x_label == 'Time':
+            metadata['start'] = self.pydatetime.isoformat()
+        for attribute in ('sess_duration', 'vendor', 'model', 'user', 'deviceid'):
+            if hasattr(self, attribute):
+                metadata[attribute.replace('sess_', '')] = str(getattr(self, attribute))
+        if self.timebase is not None and self.timebase.gaps:
+            metadata['gaps'] = str(self.timebase.gaps)
+        return metadata
+    
+    def to_arrow(self):
+        """
+        Returns session data as pyarrow.Table with session metadata in its schema.
+        Requires pyarrow.
+        """
+        import pyarrow as pa
+        columns = self.get_columns()
+        table = pa.table({'timestamp': pa.array(columns['timestamp']),
+                          'finger': pa.array(columns['finger']),
+                          'pulse': pa.array(columns['pulse']),
+                          'spo2': pa.array(columns['spo2'])})
+        metadata = {'cms50ew.' + key: value for key, value in self.get_metadata().items()}
+        return table.replace_schema_metadata(metadata)
+    
+    def to_dataframe(self):
+        """
+        Returns session data as pandas.DataFrame built directly from typed numpy
+        arrays; session metadata is stored in DataFrame.attrs. Requires pandas.
+        """
+        import pandas as pd
+        dataframe = pd.DataFrame(self.get_columns(), copy=False)
+        dataframe.attrs.update(self.get_metadata())
+        return dataframe
     
+    def write_feather(self, filename):
+        """Writes session data as Arrow IPC (Feather) file. Requires pyarrow."""
+        import pyarrow.feather as feather
+        feather.write_feather(self.to_arrow(), filename)
+    
+    def write_parquet(self, filename):
+        """Writes session data as Parquet file. Requires pyarrow."""
+        import pyarrow.parquet as pq
+        pq.write_table(self.to_arrow(), filename)
+    
+    def write_cmsz(self, filename):
+        """
+        Writes session data as compressed session file (see cms50ew_codec for the
+        format); evenly spaced data points don't take up any space for time values.
+        Like self.write_csv(), deletes the checkpoint of a complete session.
+        """
+        import cms50ew_codec
+        columns = self.get_columns()
+        with open(filename, 'wb') as f:
+            f.write(cms50ew_codec.encode(self.get_seconds(), columns['finger'], columns['pulse'],
+                                         columns['spo2'], metadata=self.get_metadata()))
+        write_session_summary(filename)
+        if self.checkpoint_file and self.checkpoint_complete:
+            self.remove_checkpoint()
+    
+    def open_cmsz(self, filename):
+        """Opens and processes compressed session file."""
+        import cms50ew_codec
+        with open(filename, 'rb') as f:
+            metadata, columns = cms50ew_codec.decode(f.read())
+        self.session_file = filename
+        times = columns['time'].tolist()
+        if all(time.is_integer() for time in times):
+            times = [int(time) for time in times]
+        fingers = np.where(columns['finger'], 'Y', 'N').tolist()
+        self.stored_data = [list(data) for data in zip(times, fingers, columns['pulse'].tolist(),
+                                                       columns['spo2'].tolist())]
+        self.x_label = 'Time [s]'
+        self.x_values = []
+        if (len(self.stored_data)) > 1:
+            self.sess_available = 'Yes'
+            self.sess_duration = datetime.timedelta(seconds=self.stored_data[-1][0])
+        else:
+            self.sess_available = 'No'
+        if 'start' in metadata and self.stored_data:
+            self.pydatetime = datetime.datetime.fromisoformat(metadata['start'])
+            self.convert_datetime()
+    
+    def write_summary_csv(self, filename):
+        """Writes the window summaries of all resolutions kept by self.aggregator as CSV file."""
+        with open(filename, 'w') as f:
+            datawriter = csv.writer(f, delimiter=',')
+            datawriter.writerow(['Window [s]', 'Time [s]', 'Finger out', 'Pulse rate [bpm]', 'SpO2 [%]',
+                                 'Pulse rate min', 'Pulse rate max', 'SpO2 min', 'SpO2 max',
+                                 'Finger out fraction', 'Low signal fraction', 'Samples'])
+            for window in self.aggregator.windows:
+                for row in self.aggregator.get_rows(window):
+                    datawriter.writerow([window] + row)
+        
     def close_device(self):
         """Closes device socket"""
-        if self.is_bluetooth:
+        self.stop_capture()
+        if self.is_replay:
+            pass # Replayed data is held in memory
+        elif self.is_bluetooth:
             self.btsock.close()
         else:
             self.ser.close()
     
+    def chart_key(self, live=False):
+        """
+        Returns a hash of stored session data and chart options identifying a
+        rendered Pygal chart; it changes whenever the data or the time
+        conversion does.
+        """
+        digest = hashlib.sha256(repr(self.stored_data).encode())
+        digest.update(repr((live, self.x_label, self.plot_title, 1800, pygal.__version__,
+                            self.chart_style.__name__)).encode())
+        return digest.hexdigest()
+    
     def plot_pygal(self, live=False):
-        """Plots stored session data as Pygal line chart."""
-
+        """
+        Plots stored session data as Pygal line chart. Charts are looked up in
+        chart_cache first and only rendered if they aren't found there.
+        """
+        key = self.chart_key(live)
+        chart = chart_cache.get(key)
+        if chart is not None:
+            self.chart = chart
+            return
+        
         if live:
             x_labels_every = int(round((len(self.stored_data) / 10)))
         else:
@@ -255,26 +746,27 @@ class CMS50EW():
         # Pygal's major labels feature is used to display a reasonable amount of labels
         x_labels_major = []
         x_labels_n = 0 # First data point is at 0 seconds
-        for time in [data[0] for data in self.stored_data]:
+        for t in [data[0] for data in self.stored_data]:
             if x_labels_n != x_labels_every:
                 x_labels_major.append(None)
                 x_labels_n += 1
             else:
                 if live and self.x_label == 'Time [s]':
-                    x_labels_major.append(round(time, 1))
+                    x_labels_major.append(round(t, 1))
                 else:
-                    x_labels_major.append(time)
+                    x_labels_major.append(t)
                 x_labels_n = 1
             if live and self.x_label == 'Time [s]':
-                x_labels.append(round(time, 1))
+                x_labels.append(round(t, 1))
             else:
-                x_labels.append(time)
+                x_labels.append(t)
                 
         line_chart = pygal.Line(truncate_label=-1, 
                                 x_title=self.x_label, 
                                 show_minor_x_labels=False, 
                                 range=(0, 260), 
-                                secondary_range=(0, 100))
+                                secondary_range=(0, 100),
+                                style=self.chart_style)
         line_chart.title = self.plot_title
         line_chart.x_labels = x_labels
         line_chart.x_labels_major = x_labels_major
@@ -282,9 +774,13 @@ class CMS50EW():
         line_chart.add('SpO2 [%]', [data[3] for data in self.stored_data], secondary=True)
         
         self.chart = line_chart.render(width=1800)
+        chart_cache.put(key, self.chart)
         
-    def plot_mpl(self):
-        """Plots stored session data as Matplotlib plot."""
+    def plot_mpl(self, filename=None):
+        """
+        Plots stored session data as Matplotlib plot. The plot is displayed unless a
+        filename is given, in which case it is saved to that file instead.
+        """
         fig, pulse_plot = plt.subplots(figsize=(15,10))
         
         if self.x_label == 'Time':
@@ -313,24 +809,122 @@ class CMS50EW():
             fig.autofmt_xdate()
             pulse_plot.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
         
-        plt.show()
+        if filename:
+            fig.savefig(filename)
+            plt.close(fig)
+        else:
+            plt.show()
         
     def write_svg(self, filename):
         """Writes Pygal plot as SVG."""
         with open(filename, 'wb') as file:
             file.write(self.chart)
     
+    def stream_svg(self, target, compress=None, width=1800, height=600, chunk_size=4096):
+        """
+        Plots stored session data as SVG line chart written straight to target,
+        a filename or a binary stream, so that the chart is never held in memory
+        as a whole. Unlike plot_pygal() the chart is a plain one: pulse rate and
+        SpO2 lines on the same axes as the Pygal chart, with about 10 time labels.
+        The output is gzip-compressed (SVGZ) if compress is True, or if it is
+        None and the filename ends in '.svgz'.
+        """
+        if isinstance(target, str):
+            if compress is None:
+                compress = target.endswith('.svgz')
+            f = open(target, 'wb')
+        else:
+            f = target
+        stream = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+        
+        left, right, top, bottom = 60, 60, 50, 60
+        plot_width = width - left - right
+        plot_height = height - top - bottom
+        n = len(self.stored_data)
+        step = plot_width / max(n - 1, 1)
+        
+        def write(text):
+            stream.write(text.encode())
+            
+        def y(value, maximum):
+            return top + plot_height * (1 - min(max(value, 0), maximum) / maximum)
+            
+        try:
+            write('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<svg xmlns="http://www.w3.org/2000/svg" width="' + str(width) + '" height="'
+                  + str(height) + '" font-family="sans-serif" font-size="12">\n'
+                  '<rect width="100%" height="100%" fill="white"/>\n'
+                  '<text x="' + str(width / 2) + '" y="25" text-anchor="middle" font-size="16">'
+                  + escape(str(self.plot_title)) + '</text>\n'
+                  '<text x="' + str(width / 2) + '" y="' + str(height - 10) + '" text-anchor="middle">'
+                  + escape(str(self.x_label)) + '</text>\n')
+            # Horizontal grid lines labelled with pulse rate (left) and SpO2 (right)
+            for n_line in range(11):
+                line_y = round(top + plot_height * n_line / 10, 1)
+                write('<line x1="' + str(left) + '" x2="' + str(width - right) + '" y1="' + str(line_y)
+                      + '" y2="' + str(line_y) + '" stroke="#ddd"/>'
+                      '<text x="' + str(left - 5) + '" y="' + str(line_y + 4) + '" text-anchor="end" fill="red">'
+                      + str(round(260 * (10 - n_line) / 10)) + '</text>'
+                      '<text x="' + str(width - right + 5) + '" y="' + str(line_y + 4) + '" fill="blue">'
+                      + str(10 * (10 - n_line)) + '</text>\n')
+            # About 10 time labels
+            labels_every = max(n // 10, 1)
+            for index in range(0, n, labels_every):
+                label = self.stored_data[index][0]
+                if isinstance(label, float):
+                    label = round(label, 1)
+                write('<text x="' + str(round(left + index * step, 1)) + '" y="' + str(top + plot_height + 20)
+                      + '" text-anchor="middle">' + escape(str(label)) + '</text>\n')
+            # Data lines, written chunk by chunk
+            for column, maximum, colour in ((2, 260, 'red'), (3, 100, 'blue')):
+                write('<path fill="none" stroke="' + colour + '" stroke-width="1" d="')
+                for start in range(0, n, chunk_size):
+                    points = []
+                    for index, data in enumerate(self.stored_data[start:start + chunk_size], start):
+                        points.append(('M' if index == 0 else 'L') + str(round(left + index * step, 1))
+                                      + ' ' + str(round(y(data[column], maximum), 1)))
+                    write(' '.join(points) + ' ')
+                write('"/>\n')
+            write('<text x="' + str(left) + '" y="' + str(top - 10) + '" fill="red">Pulse [bpm]</text>'
+                  '<text x="' + str(width - right) + '" y="' + str(top - 10)
+                  + '" text-anchor="end" fill="blue">SpO2 [%]</text>\n</svg>\n')
+        finally:
+            if compress:
+                stream.close()
+            if isinstance(target, str):
+                f.close()
+    
     def open_csv(self, filename):
-        """Opens and processes CSV session file."""
+        """
+        Opens and processes CSV session file. Sessions with clock times (HH:MM:SS),
+        e.g. recorded by the 'record' action, are opened as if converted by
+        self.convert_datetime(); their date is taken from the file's modification time.
+        """
         with open(filename, 'r') as file:
             reader = csv.reader(file)
             next(reader) # Skip header
             self.stored_data = []
             for row in reader:
-                self.stored_data.append([float(row[0]), row[1], int(row[2]), int(row[3])])
+                if ':' in row[0]:
+                    row_time = row[0]
+                else:
+                    row_time = float(row[0])
+                self.stored_data.append([row_time, row[1], int(row[2]), int(row[3])])
+        self.session_file = filename
+        self.x_label = 'Time [s]'
+        self.x_values = []
+        if self.stored_data and isinstance(self.stored_data[0][0], str):
+            import cms50ew_analysis
+            data = cms50ew_analysis.load_session(filename)
+            self.x_values = data['time'].tolist()
+            self.x_label = 'Time'
+            end = datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+            start = end - datetime.timedelta(seconds=self.x_values[-1])
+            self.pydatetime = (datetime.datetime.combine(start.date(), datetime.time())
+                               + datetime.timedelta(seconds=data['clock_start']))
         if (len(self.stored_data)) > 1:
             self.sess_available = 'Yes'
-            self.sess_duration = datetime.timedelta(seconds=self.stored_data[-1][0])
+            self.sess_duration = datetime.timedelta(seconds=self.get_seconds()[-1])
         else:
             self.sess_available = 'No'
         
@@ -340,27 +934,1211 @@ class CMS50EW():
         Doesn't work right now.
         """
         self.send_cmd(self.cmd_session_erase)
+        invalidate_device_info(self.target)
         print('Sent erase command')
         
+class CaptureWriter():
+    """
+    Records received bytes in a compact file with timestamps of 10 ms
+    resolution. Bytes received within the same 10 ms are stored as one record
+    made up of the time since start in 10 ms units, the number of bytes and
+    the bytes themselves.
+    """
+    file_header = struct.Struct('<4sBd') # Magic, version, start time
+    record_header = struct.Struct('<IH') # Time, number of bytes
+    
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.anchor = time.monotonic()
+        self.file.write(self.file_header.pack(b'CMSR', 1, time.time()))
+        self.tick = 0
+        self.buffer = bytearray()
+        
+    def write(self, data):
+        if not data:
+            return
+        tick = int((time.monotonic() - self.anchor) * 100)
+        if tick != self.tick or len(self.buffer) + len(data) > 65535:
+            self.flush()
+            self.tick = tick
+        self.buffer += data
+        
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.record_header.pack(self.tick, len(self.buffer)))
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+            
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class FrameParser():
+    """
+    Splits a stream of live data bytes into frames as they arrive in chunks of
+    any size, like CMS50EW.process_data() does byte by byte: a frame is made up
+    of 9 bytes starting with the sync byte 1, which doesn't occur within frames.
+    feed() returns the complete frames as lists [finger, pulse_rate, spo2,
+    waveform]; bytes outside frames are counted in self.discarded.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.discarded = 0
+        
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        position = 0
+        while True:
+            start = self.buffer.find(1, position)
+            if start < 0:
+                self.discarded += len(self.buffer) - position
+                position = len(self.buffer)
+                break
+            self.discarded += start - position
+            if start + 9 > len(self.buffer):
+                position = start # Wait for the rest of the frame
+                break
+            resync = self.buffer.find(1, start + 1, start + 9)
+            if resync >= 0:
+                # Truncated frame
+                self.discarded += resync - start
+                position = resync
+                continue
+            if self.buffer[start + 3] == 0xc0:
+                finger = 'Y'
+            else:
+                finger = 'N'
+            frames.append([finger, self.buffer[start + 5] & 0x7f, self.buffer[start + 6] & 0x7f,
+                           self.buffer[start + 2] & 0x7f])
+            position = start + 9
+        del self.buffer[:position]
+        return frames
+
+def decode_frames(buffer):
+    """
+    Decodes a whole buffer (bytes, bytearray, mmap or numpy array) of raw live
+    data at once with the same rules as FrameParser, vectorised with numpy
+    instead of searching frame by frame. Returns a dictionary of numpy arrays:
+    'offset' (position of every frame in the buffer), 'finger' (True if finger
+    out), 'pulse', 'spo2', 'waveform' and 'malformed' (True for frames with data
+    bytes lacking the high bit, which are decoded nonetheless), 'truncated'
+    (positions of frames cut short by the next sync byte), as well as the
+    numbers 'discarded' (bytes outside of complete frames) and 'remainder'
+    (position of an incomplete frame at the end, which belongs to data that
+    hasn't been read yet, or the length of the buffer).
+    """
+    if isinstance(buffer, np.ndarray):
+        data = np.ascontiguousarray(buffer).reshape(-1).view(np.uint8)
+    else:
+        data = np.frombuffer(buffer, dtype=np.uint8)
+    syncs = np.flatnonzero(data == 1)
+    remainder = len(data)
+    waiting = np.searchsorted(syncs, len(data) - 8)
+    if waiting < len(syncs):
+        # Like FrameParser, wait for the rest of the data from the first sync
+        # byte without room for a frame after it
+        remainder = int(syncs[waiting])
+        syncs = syncs[:waiting]
+    # A frame is complete if the next sync byte doesn't follow within 9 bytes
+    complete = np.empty(len(syncs), dtype=bool)
+    np.greater_equal(np.diff(syncs), 9, out=complete[:-1])
+    if len(syncs):
+        complete[-1] = remainder - syncs[-1] >= 9
+    if complete.all():
+        offset = syncs # The usual case of an undisturbed stream
+    else:
+        offset = syncs[complete]
+    # Gathering the 8 bytes after every sync byte as one (unaligned) 64 bit word
+    # is much faster than gathering single bytes
+    words = np.ndarray((max(len(data) - 8, 0),), dtype='<u8', buffer=data, offset=min(len(data), 1),
+                       strides=(1,))[offset]
+    frame_bytes = words.view(np.uint8).reshape(-1, 8) # Bytes 1 to 8 of every frame
+    frames = {'offset': offset,
+              'finger': frame_bytes[:, 2] == 0xc0,
+              'pulse': frame_bytes[:, 4] & 0x7f,
+              'spo2': frame_bytes[:, 5] & 0x7f,
+              'waveform': frame_bytes[:, 1] & 0x7f}
+    high_bits = np.uint64(0x8080808080808080)
+    frames['malformed'] = words & high_bits != high_bits
+    frames['truncated'] = syncs[~complete]
+    frames['discarded'] = remainder - 9 * len(offset)
+    frames['remainder'] = remainder
+    return frames
+
+def decode_file(filename):
+    """
+    Decodes a file of raw live data, either a capture file written by
+    CaptureWriter or a plain dump of received bytes (which is memory-mapped
+    rather than read), with decode_frames(). For capture files, the result also
+    holds the 'start' time of the capture (as UNIX time) and the 'arrival' time
+    of every frame in seconds since then.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+        if magic != b'CMSR':
+            if not magic:
+                return decode_frames(b'')
+            import mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return decode_frames(buffer)
+    starttime, times, chunks = read_capture(filename)
+    frames = decode_frames(b''.join(chunks))
+    # A frame has arrived with the record holding its last byte
+    ends = np.cumsum([len(chunk) for chunk in chunks])
+    records = np.searchsorted(ends, frames['offset'] + 8, side='right')
+    frames['start'] = starttime
+    frames['arrival'] = np.asarray(times, dtype=np.float64)[records] if len(times) else np.zeros(0)
+    return frames
+
+class RotatingWriter():
+    """
+    Writes rows of session data to CSV files in a directory, starting a new
+    file once the current one is older than rotate_time seconds or larger than
+    rotate_size bytes (if set). Files are named after their creation time and
+    have the same columns as files written by CMS50EW.write_csv() after
+    CMS50EW.convert_datetime(), i.e. clock times, so they can be analysed and
+    plotted like downloaded sessions.
+    """
+    def __init__(self, directory, prefix='session', rotate_time=3600, rotate_size=None,
+                 header=('Time', 'Finger out', 'Pulse rate [bpm]', 'SpO2 [%]')):
+        self.directory = directory
+        self.prefix = prefix
+        self.rotate_time = rotate_time
+        self.rotate_size = rotate_size
+        self.header = header
+        self.file = None
+        self.filename = None
+        self.opened = 0
+        self.summaries = None # Executor writing the summaries of closed files
+        
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = self.prefix + '-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.filename = os.path.join(self.directory, name + '.csv')
+        n = 1
+        while os.path.exists(self.filename):
+            self.filename = os.path.join(self.directory, name + '-' + str(n) + '.csv')
+            n += 1
+        self.file = open(self.filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.header)
+        self.opened = time.monotonic()
+        
+    def write(self, row):
+        if self.file is not None and (
+                self.rotate_time and time.monotonic() - self.opened >= self.rotate_time
+                or self.rotate_size and self.file.tell() >= self.rotate_size):
+            self.close()
+        if self.file is None:
+            self.open()
+        self.writer.writerow(row)
+        self.file.flush()
+        
+    def close(self):
+        """
+        Closes the current file, whose summary is written by a thread of its own
+        so as not to hold up recording; the next row goes to a new file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if self.summaries is None:
+                self.summaries = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.summaries.submit(write_session_summary, self.filename)
+    
+    def finish(self):
+        """Closes the current file and waits until all summaries have been written."""
+        self.close()
+        if self.summaries is not None:
+            self.summaries.shutdown()
+            self.summaries = None
+
+def read_capture(filename):
+    """
+    Reads a file written by CaptureWriter and returns the start time (as UNIX
+    time) and lists of record times (in seconds since start) and bytes.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, starttime = CaptureWriter.file_header.unpack_from(data)
+    if magic != b'CMSR':
+        raise ValueError('Not a capture file: ' + str(filename))
+    times = []
+    chunks = []
+    position = CaptureWriter.file_header.size
+    while position + CaptureWriter.record_header.size <= len(data):
+        tick, length = CaptureWriter.record_header.unpack_from(data, position)
+        position += CaptureWriter.record_header.size
+        times.append(tick / 100)
+        chunks.append(data[position:position + length])
+        position += length
+    return starttime, times, chunks
+
+class ReplayTransport():
+    """
+    Plays back a file recorded by CaptureWriter in place of a serial port or
+    Bluetooth socket. The original timing is kept at speed 1, scaled at other
+    speeds and ignored at speed 0 (as fast as possible). Reads return nothing if
+    no byte is due within 'timeout' seconds of capture time, just like a serial
+    port's, so responses and downloads end as they did when recorded. Reading
+    beyond the end of the capture raises EOFError.
+    """
+    def __init__(self, filename, speed=1.0, timeout=0.1):
+        self.starttime, self.times, self.chunks = read_capture(filename)
+        self.speed = speed
+        self.timeout = timeout
+        self.record = 0 # Index of next record to read from
+        self.position = 0 # Position within that record
+        self.clock = 0.0 # Capture time replayed so far
+        self.anchor = time.monotonic()
+        
+    def read(self, size=1):
+        if self.record == len(self.chunks):
+            raise EOFError('End of replayed data')
+        due = self.times[self.record]
+        if due > self.clock + self.timeout:
+            self.clock += self.timeout
+            self.wait()
+            return b''
+        self.clock = max(self.clock, due)
+        self.wait()
+        chunk = self.chunks[self.record]
+        data = chunk[self.position:self.position + size]
+        self.position += len(data)
+        if self.position == len(chunk):
+            self.record += 1
+            self.position = 0
+        return data
+    
+    def discard(self):
+        """
+        Skips the rest of the data being sent, up to the next pause of more than
+        'timeout' seconds, without waiting for it, like a device which has been
+        told to stop sending.
+        """
+        skipped = self.clock
+        while self.record < len(self.chunks) and self.times[self.record] <= self.clock + self.timeout:
+            self.clock = max(self.clock, self.times[self.record])
+            self.record += 1
+            self.position = 0
+        if self.speed:
+            # The following data keeps its original timing
+            self.anchor -= (self.clock - skipped) / self.speed
+    
+    def wait(self):
+        """Sleeps until the capture time replayed so far has passed at the chosen speed."""
+        if self.speed:
+            delay = self.anchor + self.clock / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+# Results of CMS50EW.get_device_info() by target: (time.monotonic() at query, info)
+device_info_cache = {}
+
+# Reply type of each query command, noted by CMS50EW.query()
+reply_types = {}
+
+def cached_device_info(target, max_age=60):
+    """Returns cached device information if it's not older than max_age seconds."""
+    cached = device_info_cache.get(target)
+    if cached and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+    return None
+
+def invalidate_device_info(target):
+    """Drops cached device information, e.g. because the stored session changed."""
+    device_info_cache.pop(target, None)
+
+def split_replies(response):
+    """
+    Splits a list of received bytes into replies and groups them by reply type.
+    Every reply starts with its type, the only byte without the high bit set.
+    Returns a dictionary of type to bytes of all replies of that type, ordered
+    by first appearance.
+    """
+    replies = {}
+    reply = None
+    for r in response:
+        if ord(r) < 0x80:
+            reply = replies.setdefault(ord(r), [])
+        if reply is not None:
+            reply.append(r)
+    return replies
+
+class Timebase():
+    """
+    Derives the times of live data frames from their index and the device's
+    fixed frame rate instead of reading the clock for every frame. Only every
+    'check_every' frames the frame times are compared with time.monotonic().
+    If frames have fallen behind by more than 'tolerance' seconds since the
+    previous check, data was lost (e.g. because the live stream had to be
+    restarted), which is recorded as gap in self.gaps and the frame times are
+    moved forward accordingly. Deviations building up slowly are clock drift
+    instead, recorded as self.drift: once beyond 'tolerance' in either
+    direction, the frame interval is adjusted to take the frame times back to
+    the clock over the following check_every frames, so that they never run
+    backwards. Whenever the live stream has been (re)started, restart() has
+    the next frame compared with the clock as soon as it arrives, so that the
+    whole interruption counts as one gap. Times are in seconds since the
+    first frame arrived. Instead of
+    time.monotonic(), any other 'clock' can be used; 'epoch' is the wall clock
+    time at which it reads 0.
+    """
+    def __init__(self, rate=60, check_every=60, tolerance=0.5, clock=time.monotonic, epoch=None):
+        self.rate = rate
+        self.check_every = check_every
+        self.tolerance = tolerance
+        self.clock = clock
+        if epoch is None:
+            epoch = time.time() - clock()
+        self.epoch = epoch
+        self.anchor = clock()
+        self.starttime = epoch + self.anchor # Wall clock time of the first frame
+        self.frames = 0 # Number of frames so far
+        self.anchor_frame = 0 # Frame at which the time was last re-anchored
+        self.offset = 0.0 # Time of self.anchor_frame
+        self.interval = 1 / rate # Time between frames from self.anchor_frame on
+        self.drift = 0.0 # Deviation from the clock at the last check
+        self.max_drift = 0.0
+        self.gaps = [] # (time, length) of detected gaps in seconds
+        self.restarted = True # Whether the next frame is the first after a (re)start
+        
+    def tick(self):
+        """Counts a frame and returns its time."""
+        if self.restarted or (self.frames and self.frames % self.check_every == 0):
+            self.restarted = False
+            self.resync()
+        frame_time = self.offset + (self.frames - self.anchor_frame) * self.interval
+        self.frames += 1
+        return frame_time
+    
+    def restart(self):
+        """Notes that the live stream has been (re)started, see above."""
+        self.restarted = True
+        
+    def resync(self):
+        """
+        Compares the time of the next frame with the clock; called by
+        self.tick(). The first frame starts the time instead.
+        """
+        if not self.frames:
+            self.anchor = self.clock()
+            self.starttime = self.epoch + self.anchor
+            return
+        now = self.clock() - self.anchor
+        expected = self.offset + (self.frames - self.anchor_frame) * self.interval
+        drift = now - expected
+        self.anchor_frame = self.frames
+        self.interval = 1 / self.rate
+        if drift - self.drift > self.tolerance:
+            # A jump since the last check rather than drift
+            self.gaps.append((round(expected, 3), round(drift - self.drift, 3)))
+            self.offset = now - self.drift
+            return
+        self.offset = expected
+        self.drift = drift
+        if abs(drift) > abs(self.max_drift):
+            self.max_drift = drift
+        if abs(drift) > self.tolerance:
+            # Spread the correction over the next check_every frames, at most
+            # half of the nominal interval per frame
+            correction = drift / self.check_every
+            self.interval += max(-0.5 / self.rate, min(correction, 0.5 / self.rate))
+
+class WindowAccumulator():
+    """Running statistics of the samples falling into one aggregation window."""
+    def __init__(self, start):
+        self.start = start
+        self.samples = 0
+        self.valid = 0
+        self.finger_out = 0
+        self.low_signal = 0
+        self.pulse_sum = 0
+        self.pulse_min = 0
+        self.pulse_max = 0
+        self.spo2_sum = 0
+        self.spo2_min = 0
+        self.spo2_max = 0
+        
+    def add(self, finger, pulse_rate, spo2):
+        self.samples += 1
+        if finger == 'Y':
+            self.finger_out += 1
+        elif pulse_rate == 0 or spo2 == 0:
+            self.low_signal += 1
+        else:
+            if self.valid == 0:
+                self.pulse_min = self.pulse_max = pulse_rate
+                self.spo2_min = self.spo2_max = spo2
+            else:
+                if pulse_rate < self.pulse_min:
+                    self.pulse_min = pulse_rate
+                elif pulse_rate > self.pulse_max:
+                    self.pulse_max = pulse_rate
+                if spo2 < self.spo2_min:
+                    self.spo2_min = spo2
+                elif spo2 > self.spo2_max:
+                    self.spo2_max = spo2
+            self.valid += 1
+            self.pulse_sum += pulse_rate
+            self.spo2_sum += spo2
+            
+    def extend(self, finger_out, pulse_rate, spo2):
+        """Adds arrays of samples at once; finger_out is True where the finger is out."""
+        self.samples += len(finger_out)
+        self.finger_out += int(np.count_nonzero(finger_out))
+        low_signal = ~finger_out & ((pulse_rate == 0) | (spo2 == 0))
+        self.low_signal += int(np.count_nonzero(low_signal))
+        valid = ~finger_out & ~low_signal
+        pulse_rate = pulse_rate[valid]
+        spo2 = spo2[valid]
+        if not len(pulse_rate):
+            return
+        pulse_min, pulse_max = int(pulse_rate.min()), int(pulse_rate.max())
+        spo2_min, spo2_max = int(spo2.min()), int(spo2.max())
+        if self.valid == 0:
+            self.pulse_min, self.pulse_max = pulse_min, pulse_max
+            self.spo2_min, self.spo2_max = spo2_min, spo2_max
+        else:
+            self.pulse_min = min(self.pulse_min, pulse_min)
+            self.pulse_max = max(self.pulse_max, pulse_max)
+            self.spo2_min = min(self.spo2_min, spo2_min)
+            self.spo2_max = max(self.spo2_max, spo2_max)
+        self.valid += len(pulse_rate)
+        self.pulse_sum += int(pulse_rate.sum(dtype=np.int64))
+        self.spo2_sum += int(spo2.sum(dtype=np.int64))
+            
+    def summary(self):
+        """
+        Returns [time, finger, pulse_rate, spo2, pulse_min, pulse_max, spo2_min, spo2_max,
+        finger_out_fraction, low_signal_fraction, samples]. The first four values
+        have the same format as rows of CMS50EW.stored_data; means and extremes only
+        cover samples with a valid reading and are 0 if there was none.
+        """
+        if self.valid:
+            pulse_rate = round(self.pulse_sum / self.valid)
+            spo2 = round(self.spo2_sum / self.valid)
+        else:
+            pulse_rate = spo2 = 0
+        if self.finger_out * 2 > self.samples:
+            finger = 'Y'
+        else:
+            finger = 'N'
+        return [self.start, finger, pulse_rate, spo2,
+                self.pulse_min, self.pulse_max, self.spo2_min, self.spo2_max,
+                round(self.finger_out / self.samples, 3), round(self.low_signal / self.samples, 3),
+                self.samples]
+
+class SampleAggregator():
+    """
+    Summarises a stream of live samples in consecutive windows of fixed length
+    (in seconds). Several resolutions are kept at once; each sample costs O(1)
+    per resolution and only one summary row per window is stored.
+    """
+    def __init__(self, windows=(1, 3, 30)):
+        self.windows = sorted(windows)
+        self.summaries = {window: [] for window in self.windows}
+        self.current = {window: None for window in self.windows}
+        
+    def add(self, time, finger, pulse_rate, spo2):
+        """Adds a sample taken 'time' seconds after the start of the session."""
+        for window in self.windows:
+            start = int(time // window) * window
+            accumulator = self.current[window]
+            if accumulator is None or accumulator.start != start:
+                if accumulator is not None:
+                    self.summaries[window].append(accumulator.summary())
+                accumulator = self.current[window] = WindowAccumulator(start)
+            accumulator.add(finger, pulse_rate, spo2)
+            
+    def extend(self, time, finger_out, pulse_rate, spo2):
+        """
+        Adds arrays of samples (in ascending order of time) at once, with
+        finger_out True where the finger is out; each window they fall into is
+        summarised with numpy rather than sample by sample.
+        """
+        if not len(time):
+            return
+        for window in self.windows:
+            starts = (time // window).astype(np.int64) * window
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(starts)) + 1, [len(time)]))
+            for first, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                start = int(starts[first])
+                accumulator = self.current[window]
+                if accumulator is None or accumulator.start != start:
+                    if accumulator is not None:
+                        self.summaries[window].append(accumulator.summary())
+                    accumulator = self.current[window] = WindowAccumulator(start)
+                accumulator.extend(finger_out[first:end], pulse_rate[first:end], spo2[first:end])
+            
+    def get_rows(self, window):
+        """
+        Returns the summaries of the given resolution including the window
+        currently being filled.
+        """
+        rows = list(self.summaries[window])
+        if self.current[window] is not None:
+            rows.append(self.current[window].summary())
+        return rows
+    
+    def get_stored_data(self):
+        """Returns the finest resolution in the format of CMS50EW.stored_data."""
+        return [row[:4] for row in self.get_rows(self.windows[0])]
+
+class WaveformBuffer():
+    """
+    Stores plethysmogram samples, one byte per live data frame, in a preallocated
+    array. Without a file the array is used as a ring holding the latest
+    'capacity' samples. With a file, the array is written to it as a chunk
+    whenever it is full, so memory use stays the same for any recording length.
+    Sample times aren't stored but reconstructed from the frame counter and the
+    device's frame rate.
+    """
+    file_header = struct.Struct('<4sBdd') # Magic, version, frame rate, start time
+    chunk_header = struct.Struct('<qI') # Index of first frame, number of samples
+    
+    def __init__(self, filename=None, capacity=3600, rate=60):
+        self.capacity = capacity
+        self.rate = rate # The device sends 60 live data frames per second
+        self.samples = array.array('B', bytes(capacity))
+        self.frames = 0 # Frame counter, i.e. index of the next sample
+        self.chunk_start = 0 # Index of the first frame not yet written to file
+        self.starttime = time.time()
+        self.file = None
+        if filename:
+            self.file = open(filename, 'wb')
+            self.file.write(self.file_header.pack(b'CMSW', 1, self.rate, self.starttime))
+    
+    def append(self, value):
+        self.samples[self.frames % self.capacity] = value
+        self.frames += 1
+        if self.file and self.frames - self.chunk_start == self.capacity:
+            self.spill()
+            
+    def spill(self):
+        """Writes the samples received since the last spill to file."""
+        count = self.frames - self.chunk_start
+        if count:
+            self.file.write(self.chunk_header.pack(self.chunk_start, count))
+            self.file.write(self.samples[:count].tobytes())
+            self.chunk_start = self.frames
+    
+    def close(self):
+        """Writes remaining samples to file and closes it."""
+        if self.file:
+            self.spill()
+            self.file.close()
+            self.file = None
+    
+    def get_samples(self):
+        """
+        Returns the samples held in memory as arrays of times (in seconds since
+        the first frame) and values.
+        """
+        if self.file:
+            first = self.chunk_start
+        else:
+            first = max(0, self.frames - self.capacity)
+        count = self.frames - first
+        position = first % self.capacity
+        if position + count <= self.capacity:
+            values = self.samples[position:position + count]
+        else:
+            values = self.samples[position:] + self.samples[:position + count - self.capacity]
+        times = array.array('d', [index / self.rate for index in range(first, self.frames)])
+        return times, values
+    
+def read_waveform(filename):
+    """
+    Reads a file written by WaveformBuffer and returns the recording's start
+    time (as UNIX time) and arrays of sample times (in seconds since the first
+    frame) and values.
+    """
+    times = array.array('d')
+    values = array.array('B')
+    with open(filename, 'rb') as f:
+        magic, version, rate, starttime = WaveformBuffer.file_header.unpack(
+            f.read(WaveformBuffer.file_header.size))
+        if magic != b'CMSW':
+            raise ValueError('Not a waveform file: ' + str(filename))
+        while True:
+            header = f.read(WaveformBuffer.chunk_header.size)
+            if len(header) < WaveformBuffer.chunk_header.size:
+                break
+            first, count = WaveformBuffer.chunk_header.unpack(header)
+            values.frombytes(f.read(count))
+            times.extend([index / rate for index in range(first, first + count)])
+    return starttime, times, values
+
+class LiveDataStore():
+    """
+    Holds live data of any length with bounded memory use. The latest
+    'capacity' samples are kept in a preallocated array; whenever it is full,
+    the oldest 'chunk_size' samples are spilled to a file in a temporary
+    directory and are read back only when requested via self.get_range().
+    Samples are appended by one thread and may be read by others. The
+    directory is removed by self.close(), or at the latest when the store is
+    garbage collected or the interpreter exits.
+    """
+    dtype = np.dtype([('time', '<f8'), ('pulse', 'u1'), ('spo2', 'u1'), ('finger', '?')])
+    
+    def __init__(self, capacity=36000, chunk_size=18000):
+        # At 60 frames per second, the default keeps the last 5 to 10 minutes in memory
+        self.data = np.zeros(capacity, dtype=self.dtype)
+        self.chunk_size = chunk_size
+        self.length = 0 # Number of samples in memory
+        self.chunks = [] # (first time, last time, filename) of spilled chunks
+        self.lock = threading.Lock()
+        self.directory = tempfile.mkdtemp(prefix='cms50ew-live-')
+        self.remove_directory = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        
+    def append(self, time, pulse_rate, spo2, finger):
+        with self.lock:
+            if self.length == len(self.data):
+                self.spill()
+            self.data[self.length] = (time, pulse_rate, spo2, finger == 'Y')
+            self.length += 1
+            
+    def extend(self, samples):
+        """Appends an array of samples (of self.dtype) under a single lock."""
+        with self.lock:
+            while len(samples):
+                if self.length == len(self.data):
+                    self.spill()
+                count = min(len(samples), len(self.data) - self.length)
+                self.data[self.length:self.length + count] = samples[:count]
+                self.length += count
+                samples = samples[count:]
+        
+    def spill(self):
+        """
+        Writes the oldest chunk to disk and moves the remaining samples to the
+        front; called by self.append() and self.extend() with the lock held.
+        """
+        chunk = self.data[:self.chunk_size]
+        filename = os.path.join(self.directory, str(len(self.chunks)) + '.bin')
+        chunk.tofile(filename)
+        self.chunks.append((chunk['time'][0], chunk['time'][-1], filename))
+        remaining = self.length - self.chunk_size
+        self.data[:remaining] = self.data[self.chunk_size:self.length]
+        self.length = remaining
+        
+    def last(self):
+        """Returns the pulse rate and SpO2 of the latest sample (0 if there is none)."""
+        with self.lock:
+            if not self.length:
+                return 0, 0
+            return int(self.data['pulse'][self.length - 1]), int(self.data['spo2'][self.length - 1])
+    
+    def hot_start(self):
+        """Returns the time of the oldest sample in memory."""
+        with self.lock:
+            if not self.length:
+                return float('inf')
+            return self.data['time'][0]
+    
+    def get_hot(self):
+        """Returns a copy of the samples in memory."""
+        with self.lock:
+            return self.data[:self.length].copy()
+    
+    def get_range(self, start, end):
+        """Returns all samples from 'start' to 'end' seconds, reading spilled chunks as needed."""
+        with self.lock:
+            chunks = list(self.chunks)
+            hot = self.data[:self.length].copy()
+        # Spilled chunks don't change anymore, so they are read without the lock
+        parts = [np.fromfile(filename, dtype=self.dtype) for first, last, filename in chunks
+                 if last >= start and first <= end]
+        parts.append(hot)
+        data = np.concatenate(parts)
+        return data[(data['time'] >= start) & (data['time'] <= end)]
+    
+    def close(self):
+        """Removes spilled chunks from disk."""
+        with self.lock:
+            self.remove_directory()
+            self.chunks = []
+            self.length = 0
+        
+class MinMaxPyramid():
+    """
+    Level of detail pyramid for plotting long sessions: level 0 holds the
+    samples themselves, every further level the minimum and maximum of each
+    'factor' consecutive entries of the level below. select() returns the
+    coarsest level which still has at least one entry per pixel of a plot, so
+    any view can be drawn from about as many points as the plot is wide while
+    keeping every peak visible. 'channels' maps names to arrays of values at
+    'time' (in seconds, ascending).
+    """
+    def __init__(self, time, channels, factor=4, levels=None):
+        self.factor = factor
+        self.time = np.asarray(time, dtype=np.float64)
+        self.channels = {name: np.asarray(values, dtype=np.float64) for name, values in channels.items()}
+        if levels is None:
+            levels = self.build()
+        self.levels = levels # Per level above 0: (time, {name: (minima, maxima)})
+        
+    def build(self):
+        levels = []
+        time = self.time
+        extremes = {name: (values, values) for name, values in self.channels.items()}
+        while len(time) > 2 * self.factor:
+            # Pad with the last entry to a multiple of factor
+            padding = -len(time) % self.factor
+            def reduce(values, function):
+                values = np.concatenate((values, np.repeat(values[-1:], padding)))
+                return function(values.reshape(-1, self.factor), axis=1)
+            time = time[::self.factor]
+            extremes = {name: (reduce(minima, np.min), reduce(maxima, np.max))
+                        for name, (minima, maxima) in extremes.items()}
+            levels.append((time, extremes))
+        return levels
+    
+    def level(self, start, end, pixels):
+        """
+        Returns the level to plot from 'start' to 'end' seconds on 'pixels'
+        pixels and the range of samples (at level 0) covering that time.
+        """
+        first = max(np.searchsorted(self.time, start, side='right') - 1, 0)
+        last = np.searchsorted(self.time, end, side='left') + 1
+        level = 0
+        while (level < len(self.levels)
+               and (last - first) / self.factor ** level > max(pixels, 1)):
+            level += 1
+        return level, first, last
+    
+    def select(self, start, end, pixels):
+        """
+        Returns the level number and the time and values of each channel to
+        plot from 'start' to 'end' seconds on 'pixels' pixels. Above level 0,
+        minimum and maximum of an entry follow each other at the same time.
+        """
+        level, first, last = self.level(start, end, pixels)
+        if level == 0:
+            return 0, self.time[first:last], {name: values[first:last]
+                                              for name, values in self.channels.items()}
+        size = self.factor ** level
+        first, last = first // size, -(-last // size)
+        t, extremes = self.levels[level - 1]
+        values = {}
+        for name, (minima, maxima) in extremes.items():
+            values[name] = np.column_stack((minima[first:last], maxima[first:last])).ravel()
+        return level, np.repeat(t[first:last], 2), values
+    
+    def save(self, filename, source_hash):
+        """Stores the levels in a .npz file together with the hash of the session they belong to."""
+        arrays = {'hash': np.array(source_hash), 'factor': np.array(self.factor)}
+        for n, (t, extremes) in enumerate(self.levels):
+            arrays['time_' + str(n)] = t
+            for name, (minima, maxima) in extremes.items():
+                arrays[name + '_min_' + str(n)] = minima
+                arrays[name + '_max_' + str(n)] = maxima
+        # np.savez would append .npz to a name not ending in it
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+def session_pyramid(filename, time, channels, factor=4):
+    """
+    Returns the MinMaxPyramid of a session file's data, which is cached beside
+    it as '<filename>.lod.npz' and rebuilt if the session file has changed.
+    """
+    cache_file = filename + '.lod.npz'
+    source_hash = file_hash(filename)
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['hash']) == source_hash and int(cached['factor']) == factor:
+                levels = []
+                n = 0
+                while 'time_' + str(n) in cached:
+                    levels.append((cached['time_' + str(n)],
+                                   {name: (cached[name + '_min_' + str(n)], cached[name + '_max_' + str(n)])
+                                    for name in channels}))
+                    n += 1
+                return MinMaxPyramid(time, channels, factor=factor, levels=levels)
+    except (OSError, ValueError, KeyError):
+        pass # No usable cache
+    pyramid = MinMaxPyramid(time, channels, factor=factor)
+    try:
+        pyramid.save(cache_file, source_hash)
+    except OSError:
+        pass # Read-only location; the pyramid is simply built again next time
+    return pyramid
+
+class ChartCache():
+    """
+    Least recently used cache of rendered charts by key, holding up to 'size'
+    charts in memory. If a directory is set, charts are also stored there and
+    survive the program; the least recently used ones are deleted once they
+    take up more than 'disk_size' bytes.
+    """
+    def __init__(self, size=8, directory=None, disk_size=200 * 1024 * 1024):
+        self.size = size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.charts = collections.OrderedDict()
+        
+    def get(self, key):
+        if key in self.charts:
+            self.charts.move_to_end(key)
+            return self.charts[key]
+        if self.directory:
+            filename = os.path.join(self.directory, key + '.svg')
+            try:
+                with open(filename, 'rb') as f:
+                    chart = f.read()
+                os.utime(filename) # Marks the chart as recently used
+            except OSError:
+                return None
+            self.remember(key, chart)
+            return chart
+        return None
+    
+    def put(self, key, chart):
+        self.remember(key, chart)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, key + '.svg'), 'wb') as f:
+                f.write(chart)
+            self.prune()
+    
+    def prune(self):
+        """Deletes the least recently used charts from the directory until they fit into disk_size."""
+        charts = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.svg'):
+                stat = entry.stat()
+                charts.append((stat.st_mtime, stat.st_size, entry.path))
+        charts.sort()
+        total = sum(size for mtime, size, path in charts)
+        for mtime, size, path in charts:
+            if total <= self.disk_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+                
+    def remember(self, key, chart):
+        self.charts[key] = chart
+        self.charts.move_to_end(key)
+        while len(self.charts) > self.size:
+            self.charts.popitem(last=False)
+
+chart_cache = ChartCache() # Used by CMS50EW.plot_pygal()
+
+def file_hash(filename):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def render_session(filename, svg=None, png=None, known_hash=None, svgz=None):
+    """
+    Plots a CSV session file with Pygal (saved as SVG), streams the plot to an
+    SVGZ file with CMS50EW.stream_svg() and/or plots it with Matplotlib (saved
+    as PNG without a display); meant to be run in a process pool. If the
+    file's content hash equals known_hash, the existing plots are considered up
+    to date and nothing is rendered. Returns the hash and whether plots were
+    rendered.
+    """
+    content_hash = file_hash(filename)
+    if content_hash == known_hash:
+        return content_hash, False
+    
+    oxi = CMS50EW()
+    oxi.open_csv(filename)
+    oxi.plot_title = os.path.basename(filename)
+    if svgz:
+        oxi.stream_svg(svgz)
+    if svg:
+        oxi.plot_pygal(live=True)
+        oxi.write_svg(svg)
+    if png:
+        if plt.get_backend().lower() != 'agg':
+            plt.switch_backend('Agg')
+        oxi.plot_mpl(filename=png)
+    return content_hash, True
+
+SUMMARY_VERSION = 2 # Increased whenever the content of summaries changes
+
+def summary_file(filename):
+    return filename + '.summary.json'
+
+def build_session_summary(filename, content_hash=None):
+    """
+    Computes the summary of a CSV or compressed session file: the statistics of
+    cms50ew_analysis.session_metrics() (number of samples, duration, min/max/mean
+    of pulse rate and SpO2, desaturations, finger out fraction, ...) together
+    with the content hash, size and modification time of the file.
+    """
+    import cms50ew_analysis
+    stat = os.stat(filename)
+    if filename.endswith('.cmsz'):
+        import cms50ew_codec
+        with open(filename, 'rb') as f:
+            metadata, columns = cms50ew_codec.decode(f.read())
+        data = {'time': columns['time'], 'finger_out': columns['finger'],
+                'pulse_rate': columns['pulse'].astype(np.int16), 'spo2': columns['spo2'].astype(np.int16),
+                'clock_start': None}
+    else:
+        data = cms50ew_analysis.load_session(filename)
+    summary = {'version': SUMMARY_VERSION,
+               'hash': content_hash or file_hash(filename),
+               'size': stat.st_size,
+               'mtime': stat.st_mtime_ns,
+               'clock_start': data['clock_start']}
+    summary.update(cms50ew_analysis.session_metrics(data))
+    return summary
+
+def save_session_summary(filename, summary):
+    try:
+        with open(summary_file(filename), 'w') as f:
+            json.dump(summary, f)
+    except OSError:
+        pass # Read-only location; the summary is simply built again next time
+
+def write_session_summary(filename):
+    """
+    Writes the summary sidecar '<filename>.summary.json' of a session file just
+    saved and returns the summary. Failures are only reported, as the session
+    itself has been saved; the summary is built again when it's needed.
+    """
+    try:
+        summary = build_session_summary(filename)
+    except Exception as e:
+        print('Could not summarize ' + str(filename) + ': ' + (str(e) or type(e).__name__))
+        return None
+    save_session_summary(filename, summary)
+    return summary
+
+def read_session_summary(filename):
+    """
+    Returns the summary of a session file from its sidecar if size and
+    modification time of the file still match it, else None. This only takes a
+    stat() and a small read, so that archives can be listed quickly.
+    """
+    try:
+        with open(summary_file(filename), 'r') as f:
+            summary = json.load(f)
+        stat = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    if (summary.get('version') == SUMMARY_VERSION and summary.get('size') == stat.st_size
+            and summary.get('mtime') == stat.st_mtime_ns):
+        return summary
+    return None
+
+def session_summary(filename):
+    """
+    Returns the summary of a session file and whether it had to be computed;
+    meant to be run in a process pool. A stale sidecar whose content hash still
+    matches the file (e.g. after a copy) only gets its size and modification
+    time updated, otherwise it is rebuilt.
+    """
+    summary = read_session_summary(filename)
+    if summary is not None:
+        return summary, False
+    content_hash = file_hash(filename)
+    try:
+        with open(summary_file(filename), 'r') as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        summary = {}
+    if summary.get('version') == SUMMARY_VERSION and summary.get('hash') == content_hash:
+        stat = os.stat(filename)
+        summary.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+        rebuilt = False
+    else:
+        summary = build_session_summary(filename, content_hash)
+        rebuilt = True
+    save_session_summary(filename, summary)
+    return summary, rebuilt
+
+def download_session(target, is_bluetooth=False, is_replay=False, speed=1.0, progress=None, stop=None):
+    """
+    Connects to a device, downloads its stored session (resuming from a
+    checkpoint if an earlier attempt was interrupted) and disconnects again.
+    progress(count, total) is called after every data point. If the
+    threading.Event stop is set, the download ends early, keeping the data
+    points downloaded so far in the checkpoint. Returns the
+    CMS50EW instance holding the session data; its sess_available is 'No' if
+    the device has no stored session. Raises ConnectionError if the device
+    can't be reached or doesn't respond.
+    """
+    oxi = CMS50EW()
+    if not oxi.setup_device(target, is_bluetooth=is_bluetooth, is_replay=is_replay, speed=speed):
+        raise ConnectionError('Connection attempt unsuccessful')
+    try:
+        if oxi.get_device_info(max_age=0) is None:
+            raise ConnectionError('No response from device')
+        if oxi.sess_available == 'No':
+            return oxi
+        oxi.open_checkpoint()
+        if not oxi.resume_checkpoint():
+            oxi.send_cmd(oxi.cmd_get_session_data)
+            while oxi.download_data():
+                if progress is not None:
+                    progress(len(oxi.stored_data), oxi.sess_data_points)
+                if stop is not None and stop.is_set():
+                    oxi.finish_checkpoint()
+                    break
+    finally:
+        oxi.close_device()
+    return oxi
+
+def frame_times(arrival, rate=60, tolerance=0.5, min_fit=10):
+    """
+    Derives the times of frames in seconds since the first one from their
+    arrival times (numpy array), which are late by a varying latency and shared
+    by all frames received at once. Where the earliest arrival of all following
+    frames jumps by more than 'tolerance' seconds beyond the frame count at
+    'rate' frames per second, data was lost and the times continue after the
+    gap. In between, frames are evenly spaced, at the interval fitted to their
+    arrival times to follow the clock drift of the device if they span at least
+    'min_fit' seconds, else at the nominal rate, and anchored to the earliest
+    arrival.
+    """
+    if not len(arrival):
+        return np.zeros(0)
+    index = np.arange(len(arrival))
+    # The lowest latency from every frame on is the best estimate of the delay
+    # the frame had been sent with
+    lag = np.minimum.accumulate((arrival - index / rate)[::-1])[::-1]
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(lag) > tolerance) + 1, [len(arrival)]))
+    times = np.empty(len(arrival))
+    for first, end in zip(bounds[:-1], bounds[1:]):
+        frames = index[first:end] - first
+        interval = 1 / rate
+        if arrival[end - 1] - arrival[first] >= min_fit:
+            interval = np.polyfit(frames, arrival[first:end], 1)[0]
+        times[first:end] = np.min(arrival[first:end] - frames * interval) + frames * interval
+    return np.maximum.accumulate(times) - times[0]
+
+def decode_session(filename, csv_file, keep_malformed=False, rate=60):
+    """
+    Decodes a capture file or raw dump with decode_file() and writes the frames
+    as CSV session file, leaving out malformed frames unless keep_malformed is
+    set; meant to be run in a process pool. Frame times of capture files follow
+    the arrival times of the frames (see frame_times()), those of raw dumps are
+    counted at 'rate' frames per second. Returns a report of the decoded data as
+    a dictionary.
+    """
+    start = time.perf_counter()
+    frames = decode_file(filename)
+    decoded = time.perf_counter()
+    keep = np.ones(len(frames['offset']), dtype=bool) if keep_malformed else ~frames['malformed']
+    if 'arrival' in frames:
+        times = frame_times(frames['arrival'], rate)
+        gaps = int(np.count_nonzero(np.diff(times) > 1.5 / rate))
+    else:
+        times = np.arange(len(frames['offset'])) / rate
+        gaps = 0
+    seconds = np.round(times[keep], 3)
+    with open(csv_file, 'w') as f:
+        datawriter = csv.writer(f, delimiter=',')
+        datawriter.writerow(['Time [s]', 'Finger out', 'Pulse rate [bpm]', 'SpO2 [%]'])
+        datawriter.writerows(zip(seconds.tolist(), np.where(frames['finger'][keep], 'Y', 'N').tolist(),
+                                 frames['pulse'][keep].tolist(), frames['spo2'][keep].tolist()))
+    write_session_summary(csv_file)
+    return {'file': filename, 'bytes': frames['remainder'], 'frames': len(frames['offset']),
+            'malformed': int(frames['malformed'].sum()), 'truncated': len(frames['truncated']),
+            'discarded': frames['discarded'], 'gaps': gaps, 'decode_time': decoded - start,
+            'total_time': time.perf_counter() - start}
+
+class KnownDevices():
+    """
+    Persistent record of Bluetooth oximeters which have answered before, by
+    address, so they can be offered before a scan has found them. Stored as
+    JSON in the cache directory unless another filename is given.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+            filename = os.path.join(cache_dir, 'cms50ew', 'bluetooth_devices.json')
+        self.filename = filename
+        try:
+            with open(self.filename, 'r') as f:
+                self.devices = json.load(f)
+        except (OSError, ValueError):
+            self.devices = {}
+            
+    def names(self):
+        """Returns a dictionary of the known devices' addresses and names, most recently seen first."""
+        devices = sorted(self.devices.items(), key=lambda item: item[1]['seen'], reverse=True)
+        return {address: device['name'] for address, device in devices}
+    
+    def remember(self, address, name=None):
+        """Records a device as oximeter; its name is kept if none is given."""
+        if name is None:
+            name = self.devices.get(address, {}).get('name', '')
+        self.devices[address] = {'name': name, 'seen': time.time()}
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, 'w') as f:
+                json.dump(self.devices, f, indent=1)
+        except OSError:
+            pass # Known devices are a convenience only
+        
 class DeviceScan():
-    """Scans for serial or Bluetooth devices."""
-    def __init__(self, is_bluetooth=False):
+    """
+    Scans for serial or Bluetooth devices. If given, callback is called with
+    address and name of every Bluetooth device as soon as its name is known.
+    """
+    def __init__(self, is_bluetooth=False, callback=None):
         if is_bluetooth:
             self.devices_dict = {}
-            self.get_bt_devices()
+            self.get_bt_devices(callback)
         else:
             self.accessible_ports = []
             self.get_serial_ports()
 
-    def get_bt_devices(self):
+    def get_bt_devices(self, callback=None, workers=8):
         """
-        Scans for Bluetooth devices, looks up their name and returns a dictionary with both
-        the devices' MAC address and name.
+        Scans for Bluetooth devices, looks up their names and fills self.devices_dict
+        with both the devices' MAC address and name. Names are looked up in
+        parallel, each as soon as its device has been discovered where PyBluez
+        supports asynchronous discovery, and after the whole scan otherwise;
+        callback is called from the lookup threads.
         """
-        devices_addr = bluetooth.discover_devices()
-        for address in devices_addr:
-            device_name = bluetooth.lookup_name(address)
-            self.devices_dict = {address:device_name}
+        def looked_up(address, future):
+            try:
+                device_name = future.result()
+            except bluetooth.btcommon.BluetoothError:
+                device_name = None
+            self.devices_dict[address] = device_name or ''
+            if callback is not None:
+                callback(address, self.devices_dict[address])
+        
+        # Leaving the with block waits for all name lookups
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            lookups = set()
+            
+            def discovered(address):
+                if address not in lookups:
+                    lookups.add(address)
+                    future = executor.submit(bluetooth.lookup_name, address)
+                    future.add_done_callback(lambda future: looked_up(address, future))
+            
+            if hasattr(bluetooth, 'DeviceDiscoverer'):
+                class Discoverer(bluetooth.DeviceDiscoverer):
+                    def pre_inquiry(self):
+                        self.done = False
+                    def device_discovered(self, address, *args):
+                        discovered(address)
+                    def inquiry_complete(self):
+                        self.done = True
+                discoverer = Discoverer()
+                discoverer.find_devices(lookup_names=False)
+                while not discoverer.done:
+                    discoverer.process_event()
+            else:
+                for address in bluetooth.discover_devices():
+                    discovered(address)
 
     def get_serial_ports(self):
         """
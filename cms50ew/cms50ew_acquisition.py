@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import multiprocessing.shared_memory
+import sys
+import time
+import numpy as np
+import bluetooth
+import cms50ew
+
+# Slots of the ring's header, an array of 64 bit integers
+SEQUENCE = 0 # Number of samples written so far
+DISCARDED = 1 # Bytes received outside of frames
+RESTARTS = 2 # Number of times the live data stream was (re)started
+GAPS = 3 # Number of gaps detected by the writer's Timebase
+STATE = 4 # One of the states below
+HEADER_SLOTS = 8
+
+STARTING = 0
+RUNNING = 1
+STOPPED = 2
+FAILED = 3
+
+class SampleRing():
+    """
+    Ring buffer of live data samples in shared memory, written by exactly one
+    process and read by any number of others without locks: the writer stores
+    samples first and only then advances the sequence counter in the header, so
+    every sample below the counter is complete. Readers remember the sequence
+    number they have read up to and get numpy views of the newer samples.
+    Samples are overwritten after 'capacity' more have been written; readers
+    falling that far behind lose them, which read() reports.
+    """
+    dtype = cms50ew.LiveDataStore.dtype
+
+    def __init__(self, name=None, capacity=36000):
+        header_size = HEADER_SLOTS * 8
+        if name is None:
+            self.shm = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=header_size + capacity * self.dtype.itemsize)
+            self.owner = True
+        else:
+            self.shm = multiprocessing.shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.header = np.ndarray(HEADER_SLOTS, dtype=np.int64, buffer=self.shm.buf)
+        self.capacity = (self.shm.size - header_size) // self.dtype.itemsize
+        self.data = np.ndarray(self.capacity, dtype=self.dtype, buffer=self.shm.buf, offset=header_size)
+
+    def write(self, samples):
+        """Appends an array of samples (of self.dtype); only to be called by the writer."""
+        sequence = int(self.header[SEQUENCE]) + len(samples)
+        samples = samples[-self.capacity:]
+        start = (sequence - len(samples)) % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+        self.header[SEQUENCE] = sequence
+
+    def read(self, since):
+        """
+        Returns views of the samples written since sequence number 'since' (two
+        if they wrap around the end of the ring), the new sequence number and
+        the number of samples lost because they were overwritten. The views
+        are valid until the writer has written another 'capacity' samples.
+        """
+        sequence = int(self.header[SEQUENCE])
+        lost = max(0, sequence - self.capacity - since)
+        since += lost
+        start = since % self.capacity
+        count = sequence - since
+        if start + count <= self.capacity:
+            parts = [self.data[start:start + count]]
+        else:
+            parts = [self.data[start:], self.data[:start + count - self.capacity]]
+        return parts, sequence, lost
+
+    def close(self):
+        """Detaches from the shared memory; the creating instance also frees it."""
+        self.header = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def acquire(ring_name, target, is_bluetooth=False, is_replay=False, speed=1.0, stop=None,
+            timeout=2, report_every=10):
+    """
+    Reads live data from a device and writes the decoded frames into the
+    SampleRing of the given name until 'stop' (a multiprocessing.Event) is set
+    or a replayed capture ends; run by AcquisitionProcess in a process of its
+    own. Frame rate and lost data are reported every 'report_every' seconds.
+    """
+    ring = SampleRing(name=ring_name)
+    oxi = cms50ew.CMS50EW()
+    if not oxi.setup_device(target, is_bluetooth=is_bluetooth, is_replay=is_replay, speed=speed):
+        ring.header[STATE] = FAILED
+        ring.close()
+        return
+    ring.header[STATE] = RUNNING
+    parser = cms50ew.FrameParser()
+    oxi.timebase = oxi.new_timebase()
+    streaming = False
+    silent = 0.0
+    last_report = time.monotonic()
+    reported = 0
+    try:
+        while not (stop is not None and stop.is_set()):
+            if not streaming:
+                oxi.initiate_device()
+                oxi.send_cmd(oxi.cmd_get_live_data)
+                oxi.timebase.restart()
+                ring.header[RESTARTS] += 1
+                streaming = True
+                silent = 0.0
+            # Wait in short steps to notice the stop event quickly
+            if not oxi.wait_readable(0.25):
+                silent += 0.25
+                streaming = silent < timeout
+                continue
+            try:
+                data = oxi.read_available()
+            except bluetooth.btcommon.BluetoothError:
+                streaming = False
+                continue
+            except EOFError:
+                break # A replayed capture has ended
+            frames = parser.feed(data)
+            if frames:
+                silent = 0.0
+                samples = np.zeros(len(frames), dtype=SampleRing.dtype)
+                samples['time'] = [oxi.timebase.tick() for frame in frames]
+                finger, samples['pulse'], samples['spo2'], waveform = zip(*frames)
+                samples['finger'] = np.array(finger) == 'Y'
+                ring.write(samples)
+            ring.header[DISCARDED] = parser.discarded
+            ring.header[GAPS] = len(oxi.timebase.gaps)
+
+            now = time.monotonic()
+            if report_every and now - last_report >= report_every:
+                sequence = int(ring.header[SEQUENCE])
+                print('Acquisition: ' + str(round((sequence - reported) / (now - last_report), 1))
+                      + ' frames/s, ' + str(sequence) + ' frames, ' + str(len(oxi.timebase.gaps))
+                      + ' gaps, ' + str(parser.discarded) + ' bytes discarded',
+                      file=sys.stderr, flush=True)
+                reported = sequence
+                last_report = now
+    finally:
+        oxi.close_device()
+        ring.header[STATE] = STOPPED
+        ring.close()
+
+def simulate(ring_name, rate=60, stop=None, frame_rate=60, interval=0.01):
+    """
+    Writes synthetic live data into the SampleRing of the given name instead of
+    reading a device, at 'rate' frames per second in batches every 'interval'
+    seconds, until 'stop' is set. Frame times advance by 1 / frame_rate per
+    frame, so rates above frame_rate simulate hours of recording in minutes;
+    used for benchmarks. The data has a desaturation every two minutes and the
+    finger out for 5 s every 10 minutes.
+    """
+    ring = SampleRing(name=ring_name)
+    ring.header[STATE] = RUNNING
+    ring.header[RESTARTS] = 1
+    written = 0
+    start = time.monotonic()
+    try:
+        while not (stop is not None and stop.is_set()):
+            due = int((time.monotonic() - start) * rate)
+            if due > written:
+                t = np.arange(written, due) / frame_rate
+                finger = t % 600 < 5
+                samples = np.zeros(len(t), dtype=SampleRing.dtype)
+                samples['time'] = t
+                samples['finger'] = finger
+                samples['pulse'] = np.where(finger, 0, np.round(65 + 10 * np.sin(2 * np.pi * t / 300)))
+                samples['spo2'] = np.where(finger, 0, np.round(96 - 6 * np.maximum(0, np.sin(2 * np.pi * t / 120)) ** 4))
+                ring.write(samples)
+                written = due
+            time.sleep(interval)
+    finally:
+        ring.header[STATE] = STOPPED
+        ring.close()
+
+class AcquisitionProcess():
+    """
+    Runs acquire() in a separate process, so that reading and decoding live
+    data neither competes with a user interface for the interpreter lock nor
+    gets delayed by it. The samples are read from self.ring. Without a target,
+    synthetic live data is generated at 'rate' frames per second; see simulate().
+    """
+    def __init__(self, target, is_bluetooth=False, is_replay=False, speed=1.0, capacity=36000, rate=60):
+        self.ring = SampleRing(capacity=capacity)
+        # A fresh interpreter rather than a fork of one which may run threads
+        context = multiprocessing.get_context('spawn')
+        self.stop_event = context.Event()
+        if target is None:
+            self.process = context.Process(target=simulate, daemon=True,
+                                           args=(self.ring.name, rate, self.stop_event))
+        else:
+            self.process = context.Process(target=acquire, daemon=True,
+                                           args=(self.ring.name, target, is_bluetooth, is_replay, speed,
+                                                 self.stop_event))
+
+    def start(self):
+        self.process.start()
+
+    def state(self):
+        return int(self.ring.header[STATE])
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stats(self):
+        """Returns the writer's counters as a dictionary."""
+        return {'frames': int(self.ring.header[SEQUENCE]),
+                'discarded': int(self.ring.header[DISCARDED]),
+                'restarts': int(self.ring.header[RESTARTS]),
+                'gaps': int(self.ring.header[GAPS])}
+
+    def stop(self, timeout=2):
+        """Stops the acquisition process and frees the ring."""
+        self.stop_event.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.ring.close()
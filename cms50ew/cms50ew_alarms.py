@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+
+class AlarmRule():
+    """
+    Raises an alarm once pulse rate or SpO2 ('channel') has been below 'below'
+    or above 'above' for at least 'duration' seconds. The alarm is cleared when
+    the value has recovered by 'hysteresis' beyond the threshold, so that values
+    hovering around it don't raise a series of alarms. The threshold has to be
+    crossed without interruption: samples more than 'max_gap' seconds apart or
+    an interrupt() in between (e.g. finger out) start the duration anew.
+    """
+    def __init__(self, channel, below=None, above=None, duration=0, hysteresis=1, max_gap=1):
+        if channel not in ('pulse', 'spo2'):
+            raise ValueError('Unknown channel: ' + str(channel))
+        self.channel = channel
+        self.below = below
+        self.above = above
+        self.duration = duration
+        self.hysteresis = hysteresis
+        self.max_gap = max_gap
+        self.active = False
+        self.since = None # Time at which the threshold was crossed
+        self.last = None # Time of the previous sample
+
+    def __str__(self):
+        if self.below is not None:
+            text = self.channel + '<' + format(self.below, 'g')
+        else:
+            text = self.channel + '>' + format(self.above, 'g')
+        return text + ':' + format(self.duration, 'g') + ':' + format(self.hysteresis, 'g')
+
+    def update(self, time, value):
+        """Evaluates a sample and returns 'raised' or 'cleared' if the alarm changed, else None."""
+        if self.last is not None and time - self.last > self.max_gap:
+            self.since = None
+        self.last = time
+        if not self.active:
+            if (self.below is not None and value < self.below
+                    or self.above is not None and value > self.above):
+                if self.since is None:
+                    self.since = time
+                if time - self.since >= self.duration:
+                    self.active = True
+                    return 'raised'
+            else:
+                self.since = None
+        elif ((self.below is None or value >= self.below + self.hysteresis)
+              and (self.above is None or value <= self.above - self.hysteresis)):
+            self.active = False
+            self.since = None
+            return 'cleared'
+        return None
+    
+    def interrupt(self):
+        """Starts the duration anew, e.g. because there is no valid reading; raised alarms stay."""
+        self.since = None
+
+def parse_rule(text):
+    """
+    Parses a rule given as <channel><'<' or '>'><threshold>[:<duration>[:<hysteresis>]],
+    e.g. 'spo2<90:10' or 'pulse>120:5:2'.
+    """
+    for operator in '<>':
+        if operator in text:
+            channel, threshold = text.split(operator, 1)
+            break
+    else:
+        raise ValueError('Rule needs < or >: ' + str(text))
+    values = [float(v) for v in threshold.split(':')]
+    if not 1 <= len(values) <= 3:
+        raise ValueError('Too many values in rule: ' + str(text))
+    kwargs = {'duration': values[1] if len(values) > 1 else 0,
+              'hysteresis': values[2] if len(values) > 2 else 1}
+    if operator == '<':
+        kwargs['below'] = values[0]
+    else:
+        kwargs['above'] = values[0]
+    return AlarmRule(channel.strip(), **kwargs)
+
+class CommandAction():
+    """
+    Runs a shell command for every alarm without waiting for it. The alarm is
+    passed in the environment variables CMS50EW_ALARM (rule), CMS50EW_STATE
+    ('raised' or 'cleared'), CMS50EW_VALUE and CMS50EW_TIME.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.processes = []
+
+    def __call__(self, event):
+        env = dict(os.environ, CMS50EW_ALARM=event['rule'], CMS50EW_STATE=event['state'],
+                   CMS50EW_VALUE=str(event['value']), CMS50EW_TIME=str(event['time']))
+        # Reap commands which have finished in the meantime
+        self.processes = [p for p in self.processes if p.poll() is None]
+        self.processes.append(subprocess.Popen(self.command, shell=True, env=env))
+
+class SocketAction():
+    """
+    Sends every alarm as a JSON datagram to 'host:port' (UDP) or to the path
+    of a Unix domain socket.
+    """
+    def __init__(self, address):
+        if ':' in address and not address.startswith('/'):
+            host, port = address.rsplit(':', 1)
+            self.address = (host, int(port))
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.address = address
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def __call__(self, event):
+        self.socket.sendto(json.dumps(event).encode() + b'\n', self.address)
+
+def bell_action(event):
+    """Rings the terminal bell for raised alarms and prints every alarm."""
+    if event['state'] == 'raised':
+        sys.stderr.write('\a')
+    print('Alarm ' + event['state'] + ': ' + event['rule'] + ' (value ' + str(event['value'])
+          + ' at ' + str(round(event['time'], 1)) + ' s)', file=sys.stderr, flush=True)
+
+class LatencyHistogram():
+    """
+    Counts latencies in buckets whose upper bounds are given in milliseconds
+    and keeps the latest 'keep' values for exact percentiles.
+    """
+    def __init__(self, bounds=(0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500), keep=10000):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.values = collections.deque(maxlen=keep)
+
+    def add(self, latency):
+        """Adds a latency in seconds."""
+        milliseconds = latency * 1000
+        self.values.append(milliseconds)
+        for n, bound in enumerate(self.bounds):
+            if milliseconds <= bound:
+                self.counts[n] += 1
+                break
+        else:
+            self.counts[-1] += 1
+
+    def report(self):
+        """Returns percentiles and non-empty buckets as text."""
+        if not self.values:
+            return 'no alarms'
+        values = np.array(self.values)
+        lines = ['{} alarms, latency p50 {:.3f} ms, p90 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'.format(
+            len(values), *np.percentile(values, (50, 90, 99)), values.max())]
+        lower = 0
+        for bound, count in zip(list(self.bounds) + [float('inf')], self.counts):
+            if count:
+                lines.append('  {:>7} - {:<7} ms: {}'.format(format(lower, 'g'), format(bound, 'g'), count))
+            lower = bound
+        return '\n'.join(lines)
+
+class AlarmPipeline():
+    """
+    Evaluates alarm rules on every decoded frame; meant to be called directly by
+    the acquisition loop, as it only compares numbers. Alarms are handed to a
+    thread of their own, which runs the actions so that they can't hold up
+    acquisition, and measures the latency from the arrival of the frame to the
+    dispatch of its alarm in self.latency.
+    """
+    def __init__(self, rules, actions):
+        self.rules = rules
+        self.actions = actions
+        self.latency = LatencyHistogram()
+        self.events = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def process(self, frame_time, finger, pulse_rate, spo2, arrival):
+        """
+        Evaluates a frame taken 'frame_time' seconds after the start of the session and
+        received at time.perf_counter() value 'arrival'. Frames without a valid
+        reading interrupt the rules' durations, but don't clear raised alarms.
+        """
+        if finger == 'Y' or pulse_rate == 0 or spo2 == 0:
+            for rule in self.rules:
+                rule.interrupt()
+            return
+        for rule in self.rules:
+            if rule.channel == 'spo2':
+                value = spo2
+            else:
+                value = pulse_rate
+            state = rule.update(frame_time, value)
+            if state:
+                self.events.put(({'rule': str(rule), 'state': state, 'value': value,
+                                  'time': frame_time, 'wallclock': time.time()}, arrival))
+
+    def dispatch(self):
+        while True:
+            item = self.events.get()
+            if item is None:
+                break
+            event, arrival = item
+            self.latency.add(time.perf_counter() - arrival)
+            for action in self.actions:
+                try:
+                    action(event)
+                except Exception as e:
+                    # A failing action must not stop the dispatching thread
+                    print('Alarm action failed: ' + repr(e), file=sys.stderr)
+
+    def close(self):
+        """Dispatches pending alarms and stops the dispatching thread."""
+        self.events.put(None)
+        self.thread.join(2)
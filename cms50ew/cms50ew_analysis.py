@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+import collections
+import datetime
+import numpy as np
+
+class RollingWindow():
+    """
+    Mean, minimum and maximum of the values added during the last 'length'
+    seconds. Minimum and maximum are tracked with monotonic queues, so adding a
+    value costs O(1) amortised and no query has to rescan the window.
+    """
+    def __init__(self, length):
+        self.length = length
+        self.values = collections.deque()
+        self.minima = collections.deque()
+        self.maxima = collections.deque()
+        self.sum = 0
+
+    def add(self, time, value):
+        self.values.append((time, value))
+        self.sum += value
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((time, value))
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((time, value))
+
+        # Drop values which have left the window
+        limit = time - self.length
+        while self.values[0][0] <= limit:
+            self.sum -= self.values.popleft()[1]
+        while self.minima[0][0] <= limit:
+            self.minima.popleft()
+        while self.maxima[0][0] <= limit:
+            self.maxima.popleft()
+
+    def extend(self, times, values):
+        """
+        Adds arrays of values at ascending times at once: only the values which
+        can still become the minimum or maximum are selected with numpy and
+        queued.
+        """
+        if not len(times):
+            return
+        self.values.extend(zip(times.tolist(), values.tolist()))
+        self.sum += values.sum().item()
+        for queue, accumulate, replaces in ((self.minima, np.minimum, np.greater_equal),
+                                            (self.maxima, np.maximum, np.less_equal)):
+            # A value stays a candidate unless a later one is at least as extreme
+            later = accumulate.accumulate(values[::-1])[::-1]
+            candidates = np.ones(len(values), dtype=bool)
+            candidates[:-1] = ~replaces(values[:-1], later[1:])
+            while queue and replaces(queue[-1][1], later[0]):
+                queue.pop()
+            queue.extend(zip(times[candidates].tolist(), values[candidates].tolist()))
+
+        limit = times[-1] - self.length
+        while self.values[0][0] <= limit:
+            self.sum -= self.values.popleft()[1]
+        while self.minima[0][0] <= limit:
+            self.minima.popleft()
+        while self.maxima[0][0] <= limit:
+            self.maxima.popleft()
+
+    def mean(self):
+        if not self.values:
+            return 0
+        return self.sum / len(self.values)
+
+    def min(self):
+        if not self.minima:
+            return 0
+        return self.minima[0][1]
+
+    def max(self):
+        if not self.maxima:
+            return 0
+        return self.maxima[0][1]
+
+class LiveAnalytics():
+    """
+    Keeps statistics of a live data stream up to date as samples arrive, at O(1)
+    amortised cost per sample:
+    - mean, minimum and maximum of pulse rate and SpO2 over the last 'window' seconds
+    - oxygen desaturation events of at least 3 % and 4 % (ODI-3, ODI-4), i.e.
+      drops below the highest SpO2 value of the last 'baseline' seconds; an event
+      ends once SpO2 has recovered by 'recovery' points above the event threshold
+    - T90, the time spent with SpO2 below 90 %
+    - pulse rate excursions out of 'pulse_range'
+    Samples with finger out or low signal quality are left out; gaps longer
+    than 'max_gap' seconds don't count towards valid time or T90.
+    """
+    def __init__(self, window=60, baseline=120, recovery=1, pulse_range=(40, 120), max_gap=5):
+        self.pulse = RollingWindow(window)
+        self.spo2 = RollingWindow(window)
+        self.spo2_baseline = RollingWindow(baseline)
+        self.recovery = recovery
+        self.pulse_range = pulse_range
+        self.max_gap = max_gap
+        self.desaturations = {3: 0, 4: 0}
+        self.desaturating = {3: False, 4: False}
+        self.pulse_excursions = 0
+        self.pulse_excursion = False
+        self.samples = 0
+        self.valid_samples = 0
+        self.valid_time = 0
+        self.t90 = 0
+        self.last_time = None
+
+    def add(self, time, finger, pulse_rate, spo2):
+        """Adds a sample taken 'time' seconds after the start of the session."""
+        self.samples += 1
+        if finger == 'Y' or pulse_rate == 0 or spo2 == 0:
+            self.last_time = None
+            return
+        self.valid_samples += 1
+
+        if self.last_time is not None:
+            delta = min(time - self.last_time, self.max_gap)
+            self.valid_time += delta
+            if spo2 < 90:
+                self.t90 += delta
+        self.last_time = time
+
+        self.pulse.add(time, pulse_rate)
+        self.spo2.add(time, spo2)
+        self.spo2_baseline.add(time, spo2)
+
+        baseline = self.spo2_baseline.max()
+        for drop in self.desaturations:
+            if spo2 <= baseline - drop:
+                if not self.desaturating[drop]:
+                    self.desaturations[drop] += 1
+                    self.desaturating[drop] = True
+            elif spo2 > baseline - drop + self.recovery:
+                self.desaturating[drop] = False
+
+        excursion = not (self.pulse_range[0] <= pulse_rate <= self.pulse_range[1])
+        if excursion and not self.pulse_excursion:
+            self.pulse_excursions += 1
+        self.pulse_excursion = excursion
+
+    def extend(self, time, finger_out, pulse_rate, spo2):
+        """
+        Adds arrays of samples (in ascending order of time, finger_out True where
+        the finger is out) at once, with the same results as adding them one by
+        one but vectorised like session_metrics().
+        """
+        self.samples += len(time)
+        valid = ~finger_out & (pulse_rate > 0) & (spo2 > 0)
+        if not valid.any():
+            if len(time):
+                self.last_time = None
+            return
+        # Time only accumulates between consecutive valid samples, including the
+        # last one of the previous batch
+        previous = np.concatenate(([self.last_time if self.last_time is not None else 0], time[:-1]))
+        follows_valid = np.concatenate(([self.last_time is not None], valid[:-1])) & valid
+        deltas = np.minimum(time - previous, self.max_gap)[follows_valid]
+        self.valid_samples += int(np.count_nonzero(valid))
+        self.valid_time += deltas.sum().item()
+        self.t90 += deltas[spo2[follows_valid] < 90].sum().item()
+        self.last_time = time[-1].item() if valid[-1] else None
+
+        time = time[valid]
+        pulse_rate = pulse_rate[valid].astype(np.int64)
+        spo2 = spo2[valid].astype(np.int64)
+        # The baseline of every sample is the maximum over the last 'baseline'
+        # seconds; the queued maxima stand in for the samples before this batch
+        earlier = self.spo2_baseline.maxima
+        window_time = np.concatenate(([t for t, value in earlier], time))
+        window_spo2 = np.concatenate(([value for t, value in earlier], spo2)).astype(np.int64)
+        starts = np.searchsorted(window_time, window_time - self.spo2_baseline.length, side='right')
+        baseline = rolling_max(window_spo2, starts)[len(earlier):]
+        self.pulse.extend(time, pulse_rate)
+        self.spo2.extend(time, spo2)
+        self.spo2_baseline.extend(time, spo2)
+
+        for drop in self.desaturations:
+            events, self.desaturating[drop] = track_onsets(spo2 <= baseline - drop,
+                                                           spo2 > baseline - drop + self.recovery,
+                                                           self.desaturating[drop])
+            self.desaturations[drop] += events
+        excursion = (pulse_rate < self.pulse_range[0]) | (pulse_rate > self.pulse_range[1])
+        events, self.pulse_excursion = track_onsets(excursion, ~excursion, self.pulse_excursion)
+        self.pulse_excursions += events
+
+    def odi(self, drop):
+        """Returns the number of desaturations of at least 'drop' % per hour of valid data."""
+        if not self.valid_time:
+            return 0
+        return self.desaturations[drop] / (self.valid_time / 3600)
+
+    def report(self):
+        """Returns the current statistics as a dictionary."""
+        return {'pulse_mean': round(self.pulse.mean(), 1),
+                'pulse_min': self.pulse.min(),
+                'pulse_max': self.pulse.max(),
+                'spo2_mean': round(self.spo2.mean(), 1),
+                'spo2_min': self.spo2.min(),
+                'spo2_max': self.spo2.max(),
+                'desaturations_3': self.desaturations[3],
+                'desaturations_4': self.desaturations[4],
+                'odi_3': round(self.odi(3), 1),
+                'odi_4': round(self.odi(4), 1),
+                't90': round(self.t90),
+                'pulse_excursions': self.pulse_excursions,
+                'valid_time': round(self.valid_time),
+                'samples': self.samples}
+
+def load_session(filename):
+    """
+    Reads a CSV session file as written by CMS50EW.write_csv() into numpy arrays
+    'time' (seconds since start), 'finger_out', 'pulse_rate' and 'spo2'. Absolute
+    times (HH:MM:SS) are converted to seconds, taking a change of date into account;
+    'clock_start' holds the clock time of the first sample in seconds after
+    midnight then and is None otherwise.
+    """
+    with open(filename, 'r') as f:
+        next(f) # Skip header
+        rows = [line.rstrip('\r\n').split(',') for line in f if line.strip()]
+    if not rows:
+        return {'time': np.zeros(0), 'finger_out': np.zeros(0, dtype=bool),
+                'pulse_rate': np.zeros(0, dtype=np.int16), 'spo2': np.zeros(0, dtype=np.int16),
+                'clock_start': None}
+    time, finger, pulse_rate, spo2 = zip(*rows)
+    clock_start = None
+
+    if ':' in time[0]:
+        hms = np.array([t.split(':') for t in time], dtype=np.int64)
+        seconds = hms @ np.array([3600, 60, 1])
+        # Crossing midnight makes the clock time jump back
+        days = np.concatenate(([0], np.cumsum(np.diff(seconds) < 0)))
+        seconds = seconds + 86400 * days
+        time = (seconds - seconds[0]).astype(float)
+        clock_start = int(seconds[0])
+    else:
+        time = np.array(time, dtype=float)
+
+    return {'time': time,
+            'finger_out': np.array(finger) == 'Y',
+            'pulse_rate': np.array(pulse_rate).astype(np.int16),
+            'spo2': np.array(spo2).astype(np.int16),
+            'clock_start': clock_start}
+
+def rolling_max(values, starts):
+    """
+    Returns the maximum of values[starts[i]:i + 1] for every i, vectorised with a
+    sparse table of maxima over power-of-two sized ranges.
+    """
+    table = [values]
+    size = 1
+    while size * 2 <= len(values):
+        previous = table[-1]
+        table.append(np.maximum(previous[:-size], previous[size:]))
+        size *= 2
+    ends = np.arange(len(values))
+    levels = np.floor(np.log2(ends - starts + 1)).astype(int)
+    result = np.empty_like(values)
+    for level in np.unique(levels):
+        selected = levels == level
+        result[selected] = np.maximum(table[level][starts[selected]],
+                                      table[level][ends[selected] - 2 ** level + 1])
+    return result
+
+def track_onsets(start, end, active=False):
+    """
+    Counts events in a sequence of samples where an event begins at a sample for
+    which 'start' is true and lasts until a sample for which 'end' is true.
+    'active' tells whether an event is going on before the first sample.
+    Returns the number of events beginning in the sequence and whether one is
+    still going on after the last sample.
+    """
+    if not len(start):
+        return 0, active
+    decisive = start | end
+    last_decisive = np.maximum.accumulate(np.where(decisive, np.arange(len(start)), -1))
+    states = np.where(last_decisive >= 0, start[np.maximum(last_decisive, 0)], active)
+    onsets = np.count_nonzero(states[1:] & ~states[:-1]) + (states[0] and not active)
+    return int(onsets), bool(states[-1])
+
+def count_onsets(start, end):
+    """Counts the events in a whole sequence of samples, see track_onsets()."""
+    return track_onsets(start, end)[0]
+
+def session_metrics(data, baseline=120, recovery=1, pulse_range=(40, 120), max_gap=5):
+    """
+    Computes summary statistics of a session loaded with load_session(), using
+    the same definitions as LiveAnalytics but vectorised over the whole session.
+    Means, minima and maxima are None if there are no valid samples.
+    """
+    time = data['time']
+    valid = ~data['finger_out'] & (data['pulse_rate'] > 0) & (data['spo2'] > 0)
+    metrics = {'samples': len(time),
+               'duration': float(time[-1] - time[0]) if len(time) else 0.0,
+               'finger_out_fraction': round(float(np.mean(data['finger_out'])), 3) if len(time) else 0.0}
+
+    pulse_rate = data['pulse_rate'][valid]
+    spo2 = data['spo2'][valid]
+    valid_time = time[valid]
+    if not len(spo2):
+        # Without valid data there are no pulse rate and SpO2 values, nor events
+        for key in ('spo2_mean', 'spo2_min', 'spo2_max', 'pulse_mean', 'pulse_min', 'pulse_max'):
+            metrics[key] = None
+        for key in ('valid_time', 't90', 'desaturations_3', 'desaturations_4', 'odi_3', 'odi_4',
+                    'pulse_excursions'):
+            metrics[key] = 0
+        return metrics
+
+    metrics['spo2_mean'] = round(float(spo2.mean()), 1)
+    metrics['spo2_min'] = int(spo2.min())
+    metrics['spo2_max'] = int(spo2.max())
+    metrics['pulse_mean'] = round(float(pulse_rate.mean()), 1)
+    metrics['pulse_min'] = int(pulse_rate.min())
+    metrics['pulse_max'] = int(pulse_rate.max())
+
+    # Time only accumulates between consecutive valid samples
+    follows_valid = valid[1:] & valid[:-1]
+    deltas = np.minimum(np.diff(time), max_gap)[follows_valid]
+    below_90 = (data['spo2'][1:] < 90)[follows_valid]
+    metrics['valid_time'] = round(float(deltas.sum()))
+    metrics['t90'] = round(float(deltas[below_90].sum()))
+
+    starts = np.searchsorted(valid_time, valid_time - baseline, side='right')
+    spo2_baseline = rolling_max(spo2, starts)
+    hours = float(deltas.sum()) / 3600
+    for drop in (3, 4):
+        events = count_onsets(spo2 <= spo2_baseline - drop, spo2 > spo2_baseline - drop + recovery)
+        metrics['desaturations_' + str(drop)] = events
+        metrics['odi_' + str(drop)] = round(events / hours, 1) if hours else 0
+
+    excursion = (pulse_rate < pulse_range[0]) | (pulse_rate > pulse_range[1])
+    metrics['pulse_excursions'] = count_onsets(excursion, ~excursion)
+    return metrics
+
+def analyze_file(filename):
+    """
+    Loads a session file and returns its metrics; meant to be run in a process pool.
+    Errors are reported in the result rather than raised.
+    """
+    try:
+        metrics = session_metrics(load_session(filename))
+    except (OSError, ValueError, StopIteration) as e:
+        return {'file': filename, 'error': str(e) or type(e).__name__}
+    metrics = dict({'file': filename, 'error': ''}, **metrics)
+    return metrics
+
+def session_start(data, start=None):
+    """
+    Returns the absolute time of the first sample of a session loaded with
+    load_session() as datetime.datetime. Sessions with times in seconds need
+    'start'; for sessions with clock times only the date of 'start' is used
+    (and it is required, as the files don't store it).
+    """
+    if start is None:
+        raise ValueError('Start time or date required')
+    if data['clock_start'] is None:
+        return start
+    midnight = datetime.datetime.combine(start.date(), datetime.time())
+    return midnight + datetime.timedelta(seconds=data['clock_start'])
+
+def resample(times, grid, step, tolerance, method):
+    """
+    Returns for every point of the time grid the indices (last, nearest) or
+    index ranges (mean) of the samples at 'times' belonging to it, and which
+    grid points have any. Both arrays are in milliseconds and sorted.
+    """
+    if method == 'mean':
+        # Samples of the step up to and including the grid point
+        left = np.searchsorted(times, grid - step, side='right')
+        right = np.searchsorted(times, grid, side='right')
+        return (left, right), right > left
+    index = np.searchsorted(times, grid, side='right') - 1
+    if method == 'last':
+        # Grid points before the first sample have none; later samples are never used
+        present = index >= 0
+        index = np.maximum(index, 0)
+        return index, present & (grid - times[index] <= tolerance)
+    if method != 'nearest':
+        raise ValueError('Unknown resampling method: ' + str(method))
+    following = np.minimum(index + 1, len(times) - 1)
+    before = np.where(index >= 0, grid - times[np.maximum(index, 0)], np.iinfo(np.int64).max)
+    index = np.where(times[following] - grid < before, following, np.maximum(index, 0))
+    return index, np.abs(grid - times[index]) <= tolerance
+
+def merge_sessions(sessions, step=1, tolerance=3, method='last'):
+    """
+    Aligns sessions, given as (name, start, data) with 'start' the absolute
+    time of the first sample (see session_start()) and 'data' as returned by
+    load_session(), on a common time grid of 'step' seconds covering all of
+    them. A grid point takes the last sample at or before it ('last'), the
+    closest one ('nearest'), each provided it is at most 'tolerance' seconds
+    away, or the mean of the valid samples within the preceding step ('mean').
+    Returns the grid as datetime64 array and per session a dictionary of
+    arrays 'finger_out', 'pulse_rate', 'spo2' and 'present', which is false
+    where the session has no data; all vectorised. Start times with a time
+    zone are converted to local time, those without one are taken as local
+    time, and the grid is in local time.
+    """
+    step_ms = int(round(step * 1000))
+    tolerance_ms = int(round(tolerance * 1000))
+    absolute = []
+    for name, start, data in sessions:
+        if start.tzinfo is not None:
+            start = start.astimezone().replace(tzinfo=None)
+        # Local times are counted like UTC to keep them as they are in the grid
+        start_ms = int(round(start.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000))
+        absolute.append(start_ms + np.round(data['time'] * 1000).astype(np.int64))
+    first = min(times[0] for times in absolute if len(times))
+    last = max(times[-1] for times in absolute if len(times))
+    grid = np.arange(first, last + step_ms, step_ms, dtype=np.int64)
+
+    merged = []
+    for (name, start, data), times in zip(sessions, absolute):
+        if not len(times):
+            merged.append((name, {'present': np.zeros(len(grid), dtype=bool),
+                                  'finger_out': np.zeros(len(grid), dtype=bool),
+                                  'pulse_rate': np.zeros(len(grid)), 'spo2': np.zeros(len(grid))}))
+            continue
+        selection, present = resample(times, grid, step_ms, tolerance_ms, method)
+        if method == 'mean':
+            left, right = selection
+            valid = ~data['finger_out'] & (data['pulse_rate'] > 0) & (data['spo2'] > 0)
+            def window_sums(values):
+                sums = np.concatenate(([0], np.cumsum(values, dtype=np.float64)))
+                return sums[right] - sums[left]
+            counts = window_sums(valid)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns = {'pulse_rate': np.round(window_sums(data['pulse_rate'] * valid) / counts, 1),
+                           'spo2': np.round(window_sums(data['spo2'] * valid) / counts, 1)}
+            columns['finger_out'] = window_sums(data['finger_out']) * 2 > (right - left)
+            # Windows without a valid sample have no pulse rate and SpO2
+            columns['pulse_rate'][counts == 0] = 0
+            columns['spo2'][counts == 0] = 0
+        else:
+            columns = {key: data[key][selection] for key in ('finger_out', 'pulse_rate', 'spo2')}
+        columns['present'] = present
+        merged.append((name, columns))
+    return grid.astype('datetime64[ms]'), merged
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+import random
+import time
+import datetime
+import os
+import gzip
+import csv
+import io
+import tempfile
+import threading
+import sys
+import resource
+import numpy as np
+import cms50ew
+import cms50ew_analysis
+import cms50ew_codec
+
+def synthetic_live_data(seconds, rate=60):
+    """
+    Generates live samples [time, finger, pulse_rate, spo2] resembling a night
+    with a few desaturations and finger out events.
+    """
+    samples = []
+    pulse_rate = 65
+    for n in range(int(seconds * rate)):
+        t = n / rate
+        pulse_rate = min(max(pulse_rate + random.choice((-1, 0, 0, 0, 1)), 45), 130)
+        # A desaturation of up to 6 % every two minutes
+        spo2 = round(96 - 6 * max(0, math.sin(2 * math.pi * t / 120)) ** 4)
+        if n % (rate * 600) < rate * 5: # Finger out for 5 s every 10 minutes
+            samples.append([t, 'Y', 0, 0])
+        else:
+            samples.append([t, 'N', pulse_rate, spo2])
+    return samples
+
+def analytics():
+    """Feeds synthetic 60 Hz live data of several devices through LiveAnalytics."""
+    samples = synthetic_live_data(args.seconds)
+    devices = [cms50ew_analysis.LiveAnalytics() for d in range(args.devices)]
+    print('Feeding ' + str(len(samples)) + ' samples (' + str(args.seconds) + ' s at 60 Hz) into '
+          + str(args.devices) + ' LiveAnalytics instances ...')
+
+    start = time.perf_counter()
+    # Interleave devices like a multiplexed acquisition loop would
+    for sample in samples:
+        for device in devices:
+            device.add(*sample)
+    elapsed = time.perf_counter() - start
+
+    total = len(samples) * len(devices)
+    print('Samples processed: ' + str(total))
+    print('Elapsed time: ' + str(round(elapsed, 3)) + ' s')
+    print('Throughput: ' + str(round(total / elapsed)) + ' samples/s ('
+          + str(round(elapsed / total * 1e6, 2)) + ' µs/sample)')
+    print('Devices sustainable at 60 Hz on one core: ' + str(int(total / elapsed / 60)))
+    print('Real time factor for ' + str(args.devices) + ' devices: '
+          + str(round(args.seconds / elapsed, 1)) + 'x')
+    print('Last report of device 0:', devices[0].report())
+
+def best_time(function, repeat):
+    """Returns the shortest of 'repeat' run times of function in seconds."""
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def codec():
+    """Compares compressed session files with CSV and gzip'd CSV files."""
+    oxi = cms50ew.CMS50EW()
+    # Stored sessions consist of a data point every three seconds
+    oxi.stored_data = [[int(t), finger, pulse_rate, spo2]
+                       for t, finger, pulse_rate, spo2 in synthetic_live_data(args.hours * 3600, rate=1 / 3)]
+    print('Session of ' + str(args.hours) + ' h with ' + str(len(oxi.stored_data)) + ' data points')
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file = os.path.join(directory, 'session.csv')
+        gzip_file = os.path.join(directory, 'session.csv.gz')
+        cmsz_file = os.path.join(directory, 'session.cmsz')
+
+        def write_gzip():
+            with open(csv_file, 'rb') as f, gzip.open(gzip_file, 'wb') as g:
+                g.write(f.read())
+
+        def open_gzip():
+            with gzip.open(gzip_file, 'rt') as f:
+                reader = csv.reader(io.StringIO(f.read()))
+                next(reader)
+                return [[float(row[0]), row[1], int(row[2]), int(row[3])] for row in reader]
+
+        def decode_cmsz():
+            with open(cmsz_file, 'rb') as f:
+                return cms50ew_codec.decode(f.read())
+
+        results = [['CSV', csv_file, lambda: oxi.write_csv(csv_file), lambda: cms50ew.CMS50EW().open_csv(csv_file)],
+                   ['gzip\'d CSV', gzip_file, lambda: (oxi.write_csv(csv_file), write_gzip()), open_gzip],
+                   ['CMSZ', cmsz_file, lambda: oxi.write_cmsz(cmsz_file), lambda: cms50ew.CMS50EW().open_cmsz(cmsz_file)],
+                   ['CMSZ (columns only)', cmsz_file, lambda: oxi.write_cmsz(cmsz_file), decode_cmsz]]
+        csv_size = None
+        print('{:<22}{:>12}{:>10}{:>14}{:>14}'.format('Format', 'Size [B]', 'Ratio', 'Encode [ms]', 'Decode [ms]'))
+        for name, filename, encode, decode in results:
+            encode_time = best_time(encode, args.repeat)
+            decode_time = best_time(decode, args.repeat)
+            size = os.path.getsize(filename)
+            if csv_size is None:
+                csv_size = size
+            print('{:<22}{:>12}{:>10.1f}{:>14.2f}{:>14.2f}'.format(name, size, csv_size / size,
+                                                                  encode_time * 1000, decode_time * 1000))
+
+def synthetic_stream(samples, corrupt=0.001):
+    """
+    Encodes live samples as raw live data frames and corrupts the given
+    fraction of bytes, returning the bytes.
+    """
+    frames = bytearray()
+    for n, (t, finger, pulse_rate, spo2) in enumerate(samples):
+        frames += bytes((1, 0xe0, 0x80 | n % 100, 0xc0 if finger == 'Y' else 0x80, 0x80,
+                         0x80 | pulse_rate, 0x80 | spo2, 0xff, 0xff))
+    for position in random.sample(range(len(frames)), int(len(frames) * corrupt)):
+        frames[position] = random.randrange(256)
+    return bytes(frames)
+
+def decode():
+    """Compares FrameParser with the vectorised decode_frames() on a raw stream."""
+    one_hour = synthetic_stream(synthetic_live_data(3600), corrupt=args.corrupt)
+    data = one_hour * int(args.hours) + one_hour[:int(len(one_hour) * (args.hours % 1))]
+    print('Raw stream of ' + str(args.hours) + ' h at 60 Hz: ' + str(round(len(data) / 1e6, 1)) + ' MB, '
+          + str(args.corrupt * 100) + ' % of bytes corrupted')
+
+    def parse():
+        parser = cms50ew.FrameParser()
+        # Chunks as they would be received
+        for position in range(0, len(one_hour), 4096):
+            parser.feed(one_hour[position:position + 4096])
+
+    parse_time = best_time(parse, 1) * len(data) / len(one_hour)
+    decode_time = best_time(lambda: cms50ew.decode_frames(data), args.repeat)
+    frames = cms50ew.decode_frames(data)
+    print('Frames: ' + str(len(frames['offset'])) + ', malformed: ' + str(frames['malformed'].sum())
+          + ', truncated: ' + str(len(frames['truncated'])) + ', bytes discarded: ' + str(frames['discarded']))
+    print('{:<22}{:>12}{:>12}'.format('Decoder', 'Time [s]', 'MB/s'))
+    for name, elapsed in (('FrameParser', parse_time), ('decode_frames()', decode_time)):
+        print('{:<22}{:>12.3f}{:>12.1f}'.format(name, elapsed, len(data) / elapsed / 1e6))
+
+def memory_usage():
+    """Returns the resident set size of this process in MB (the peak if the current one isn't known)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def percentiles(values):
+    """Returns p50, p90, p99 and maximum of values in milliseconds as text."""
+    if not values:
+        return 'n/a'
+    return 'p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f} ms'.format(
+        *np.percentile(np.array(values) * 1000, (50, 90, 99, 100)))
+
+def qt():
+    """
+    Feeds synthetic or replayed live data through LiveThread and MainWidget of
+    the Qt interface, with the offscreen platform unless QT_QPA_PLATFORM is set.
+    The plots' paint handlers are timed as Qt calls them, and a 10 ms timer
+    measures how late the event loop gets to it.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import cms50ew_qt
+    import cms50ew_acquisition
+    from PyQt5 import QtCore
+    from PyQt5.QtWidgets import QApplication
+
+    # The Qt interface refers to its application and main window as globals
+    app = cms50ew_qt.app = QApplication(sys.argv[:1])
+    w = cms50ew_qt.w = cms50ew_qt.MainWindow()
+    w.oxi = cms50ew.CMS50EW()
+    w.oxi.is_bluetooth = False
+    if args.replay:
+        acquisition = cms50ew_acquisition.AcquisitionProcess(args.replay, is_replay=True, speed=args.speed)
+        print('Replaying ' + args.replay + ' at speed ' + str(args.speed) + ' ...')
+    else:
+        acquisition = cms50ew_acquisition.AcquisitionProcess(None, rate=args.rate)
+        print('Feeding ' + str(args.rate) + ' synthetic samples/s (' + str(round(args.rate / 60, 1))
+              + ' times real time) for ' + str(args.hours) + ' simulated hours ...')
+    acquisition.start()
+    w.live_running = True
+    w.liveThread = cms50ew_qt.LiveThread(w.oxi, acquisition)
+    w.liveThread.start()
+
+    start = time.perf_counter()
+    # Render times and latencies are only kept for the current report interval,
+    # so that the benchmark doesn't add to the memory use it measures; the
+    # worst intervals are kept for the summary
+    render_times = []
+    latencies = []
+    rss = [memory_usage()]
+    rss_time = [0]
+    state = {'tick': time.perf_counter(), 'reported': 0, 'samples': 0, 'backlog': 0, 'time': start,
+             'paints': 0, 'worst_render': [], 'worst_latency': []}
+
+    def timed(paint_event):
+        def paintEvent(event):
+            t = time.perf_counter()
+            paint_event(event)
+            render_times.append(time.perf_counter() - t)
+        return paintEvent
+
+    for plot in (w.cw.pulse_plot, w.cw.spo2_plot):
+        plot.paintEvent = timed(plot.paintEvent)
+
+    def tick():
+        now = time.perf_counter()
+        latencies.append(max(0, now - state['tick'] - 0.01))
+        state['tick'] = now
+
+    def report():
+        simulated = getattr(w.liveThread, 'frame_time', 0)
+        backlog = acquisition.stats()['frames'] - w.oxi.n_data_points - w.liveThread.lost
+        state['backlog'] = max(state['backlog'], backlog)
+        ended = w.liveThread.isFinished()
+        if simulated - state['reported'] >= args.report_every or ended:
+            now = time.perf_counter()
+            rss.append(memory_usage())
+            rss_time.append(simulated)
+            print('{} simulated, {:.0f} s: {:.0f} samples/s, backlog {}, lost {} | {:.1f} plot paints/s, {} | loop latency {} | RSS {:.0f} MB'.format(
+                datetime.timedelta(seconds=round(simulated)), now - start,
+                (w.oxi.n_data_points - state['samples']) / (now - state['time']), backlog, w.liveThread.lost,
+                len(render_times) / (now - state['time']), percentiles(render_times), percentiles(latencies),
+                rss[-1]), flush=True)
+            state['paints'] += len(render_times)
+            for key, values in (('worst_render', render_times), ('worst_latency', latencies)):
+                if values and (not state[key] or max(values) > max(state[key])):
+                    state[key] = list(values)
+            state.update(reported=simulated, samples=w.oxi.n_data_points, time=now)
+            render_times.clear()
+            latencies.clear()
+        if ended:
+            app.quit()
+
+    def watchdog():
+        # Ends the live thread from outside the event loop, which may be flooded
+        # with updates if the plots can't keep up
+        while (not w.liveThread.isFinished()
+               and getattr(w.liveThread, 'frame_time', 0) < args.hours * 3600):
+            time.sleep(0.1)
+        w.live_running = False
+
+    timers = []
+    for function, interval in ((tick, 10), (report, 250)):
+        timer = QtCore.QTimer()
+        timer.setTimerType(QtCore.Qt.PreciseTimer)
+        timer.timeout.connect(function)
+        timer.start(int(interval))
+        timers.append(timer)
+    threading.Thread(target=watchdog, daemon=True).start()
+    app.exec_()
+
+    elapsed = time.perf_counter() - start
+    acquisition.stop()
+    print('Samples displayed: ' + str(w.oxi.n_data_points) + ' in ' + str(round(elapsed, 1)) + ' s ('
+          + str(round(w.oxi.n_data_points / elapsed)) + ' samples/s), lost: ' + str(w.liveThread.lost)
+          + ', largest backlog: ' + str(state['backlog']) + ' samples')
+    print('Plot render time, worst interval: ' + percentiles(state['worst_render']) + ' ('
+          + str(state['paints']) + ' paints)')
+    print('Event loop latency, worst interval: ' + percentiles(state['worst_latency']))
+    print('Memory: ' + str(round(rss[0])) + ' MB at start, ' + str(round(rss[-1])) + ' MB at end')
+    if len(rss) > 2 and rss_time[-1] > rss_time[1]:
+        # Growth after the first report, once plots and buffers have been set up
+        print('Memory growth: ' + str(round((rss[-1] - rss[1]) / (rss_time[-1] - rss_time[1]) * 3600, 1))
+              + ' MB per simulated hour')
+    w.oxi.live_data.close()
+
+# Main parser
+parser = argparse.ArgumentParser(description='benchmarks for the CMS50EW client')
+subparsers = parser.add_subparsers(help='specify benchmark to run', dest='benchmark')
+subparsers.required = True
+
+# Parser for 'analytics' benchmark
+parser_analytics = subparsers.add_parser('analytics', help='online analytics of live data')
+parser_analytics.set_defaults(func=analytics)
+parser_analytics.add_argument('--devices', type=int, default=50, help='number of simulated devices (default: 50)')
+parser_analytics.add_argument('--seconds', type=float, default=600, help='simulated recording length in seconds (default: 600)')
+
+# Parser for 'codec' benchmark
+parser_codec = subparsers.add_parser('codec', help='compressed session files compared with CSV')
+parser_codec.set_defaults(func=codec)
+parser_codec.add_argument('--hours', type=float, default=12, help='length of the stored session in hours (default: 12)')
+parser_codec.add_argument('--repeat', type=int, default=5, help='number of runs, the best of which is reported (default: 5)')
+
+# Parser for 'decode' benchmark
+parser_decode = subparsers.add_parser('decode', help='offline decoding of raw live data')
+parser_decode.set_defaults(func=decode)
+parser_decode.add_argument('--hours', type=float, default=24, help='length of the raw stream in hours (default: 24)')
+parser_decode.add_argument('--corrupt', type=float, default=0.001, help='fraction of corrupted bytes (default: 0.001)')
+parser_decode.add_argument('--repeat', type=int, default=5, help='number of runs, the best of which is reported (default: 5)')
+
+# Parser for 'qt' benchmark
+parser_qt = subparsers.add_parser('qt', help='live plotting of the Qt interface without a display')
+parser_qt.set_defaults(func=qt)
+parser_qt.add_argument('--rate', type=float, default=600, help='synthetic samples per second; live data arrives at 60 (default: 600)')
+parser_qt.add_argument('--hours', type=float, default=0.25, help='simulated recording length in hours (default: 0.25)')
+parser_qt.add_argument('--replay', metavar='file', help='replay live data recorded with --capture instead of synthetic data')
+parser_qt.add_argument('--speed', type=float, default=1.0, help='replay speed factor; 0 replays as fast as possible (default: 1)')
+parser_qt.add_argument('--report-every', metavar='seconds', type=float, default=300,
+                       help='simulated seconds between reports (default: 300)')
+
+# Acquisition processes spawned by the 'qt' benchmark import this module again
+if __name__ == '__main__':
+    # Parse arguments
+    args = parser.parse_args()
+    random.seed(0)
+
+    # Run benchmark function
+    args.func()
@@ -3,10 +3,21 @@
 import argparse
 import curses
 import cms50ew
+import cms50ew_analysis
+import cms50ew_alarms
 import sys
 import time
 import datetime
 import signal
+import os
+import glob
+import csv
+import json
+import struct
+import concurrent.futures
+import threading
+import numpy as np
+import resource
 import bluetooth
 import dateutil.parser as duparser
 
@@ -22,6 +33,23 @@ def main(stdscr):
         global stdscr_height
         stdscr_height = stdscr.getmaxyx()[0]
     
+    def show_analytics():
+        """Adds the statistics of the live session to the screen."""
+        report = analytics.report()
+        stdscr.addstr(4, 0, 'Last ' + str(analytics.pulse.length) + ' s: ')
+        stdscr.addstr('Pulse rate ' + str(report['pulse_min']) + '-' + str(report['pulse_max'])
+                      + ' bpm (mean ' + str(report['pulse_mean']) + '), SpO2 '
+                      + str(report['spo2_min']) + '-' + str(report['spo2_max'])
+                      + ' % (mean ' + str(report['spo2_mean']) + ')')
+        stdscr.addstr(5, 0, 'Session: ')
+        stdscr.addstr('ODI-3 ' + str(report['desaturations_3']) + ' (' + str(report['odi_3'])
+                      + '/h), ODI-4 ' + str(report['desaturations_4']) + ' (' + str(report['odi_4'])
+                      + '/h), T90 ' + str(report['t90']) + ' s, pulse rate excursions '
+                      + str(report['pulse_excursions']))
+        if last_alarm:
+            stdscr.addstr(6, 0, 'Alarm ' + last_alarm['state'] + ': ' + last_alarm['rule'] + ' at '
+                          + str(round(last_alarm['time'], 1)) + ' s', curses.A_BOLD)
+        
     def no_data(status, finger):
         """Updates screen when no data is available."""
 
@@ -33,6 +61,7 @@ def main(stdscr):
             stdscr.addstr('n/a', curses.A_BOLD)
             stdscr.addstr(2, 0, 'Status: ')
             stdscr.addstr(status, curses.A_BLINK)
+            show_analytics()
             stdscr.addstr(stdscr_height - 1, 0, "Press 'q' to quit")
             stdscr.refresh()
         else:
@@ -54,6 +83,7 @@ def main(stdscr):
             stdscr.addstr(' %')
             stdscr.addstr(2, 0, 'Status: ')
             stdscr.addstr(status)
+            show_analytics()
             stdscr.addstr(stdscr_height - 1, 0, "Press 'q' to quit")
             stdscr.refresh()
         else:
@@ -70,16 +100,22 @@ def main(stdscr):
             oxi.old_pulse_rate = -1
             oxi.old_spo2 = -1
             oxi.old_status = 'No status'
-        oxi.starttime = time.time()
+        oxi.timebase = oxi.new_timebase()
         while True:
             oxi.initiate_device()
             oxi.send_cmd(oxi.cmd_get_live_data)
+            # Times start with the first frame; after a restart, the frames
+            # lost in the meantime are recorded as gap
+            oxi.timebase.restart()
             try:
                 update_live_data()
             except (TypeError, bluetooth.btcommon.BluetoothError):
                 # Every once in a while (every ~30 seconds) the data stream
                 # interrupts for reasons unknown. So we just restart.
                 pass
+            except EOFError:
+                # A replayed capture has ended
+                exit_nicely(0, 0)
         
     def update_live_data():
         """Gets, stores and displays live data from oximeter instance."""
@@ -90,19 +126,20 @@ def main(stdscr):
         
         while True:
             data = oxi.process_data()
+            # The clock is only read for the alarms' latency statistics
+            arrival = time.perf_counter() if alarms is not None else None
             finger = data[0]
             pulse_rate = data[1]
             spo2 = data[2]
             
-            # Store live session data in object once every second
-            oxi.timer = time.time()
-            delta_time = oxi.timer - oxi.starttime
-            if not oxi.stored_data: # Might still be empty
-                if delta_time > 1:
-                    oxi.stored_data.append([round(delta_time), finger, pulse_rate, spo2])
-            else:
-                if delta_time - oxi.stored_data[-1][0] > 1: # Save one data set per sec
-                    oxi.stored_data.append([round(delta_time), finger, pulse_rate, spo2])
+            # Alarms are evaluated before anything else is done with the frame
+            delta_time = oxi.timebase.tick()
+            if alarms is not None:
+                alarms.process(delta_time, finger, pulse_rate, spo2, arrival)
+            
+            # Summarise live session data in windows of the requested lengths
+            oxi.aggregator.add(delta_time, finger, pulse_rate, spo2)
+            analytics.add(delta_time, finger, pulse_rate, spo2)
             
             if not args.raw:
                 c = stdscr.getch()
@@ -131,26 +168,95 @@ def main(stdscr):
                 low_signal_quality = False
     
     # Set up an oximeter instance and initiate live data stream
-    if not oxi.setup_device(target=args.device, is_bluetooth=args.bluetooth):
+    oxi.aggregator = cms50ew.SampleAggregator(windows=args.windows)
+    global alarms
+    if args.raw:
+        alarms = setup_alarms()
+    else:
+        # Printing alarms would disturb the curses screen, which shows them instead
+        alarms = setup_alarms(remember_alarm)
+    if args.waveform:
+        oxi.enable_waveform(filename=args.waveform)
+    if not oxi.setup_device(target=args.device, is_bluetooth=args.bluetooth,
+                            is_replay=args.replay, speed=args.speed):
         print('Connection attempt unsuccessful.')
         sys.exit(1)
+    if args.capture:
+        oxi.start_capture(args.capture)
     if args.datetime:
         oxi.pydatetime = datetime.datetime.now()
     init_live_data()
 
+def setup_alarms(notify=cms50ew_alarms.bell_action):
+    """Returns an AlarmPipeline set up by the --alarm options, or None if there are no rules."""
+    if not args.alarm:
+        return None
+    actions = [notify]
+    if args.alarm_command:
+        actions.append(cms50ew_alarms.CommandAction(args.alarm_command))
+    if args.alarm_socket:
+        actions.append(cms50ew_alarms.SocketAction(args.alarm_socket))
+    return cms50ew_alarms.AlarmPipeline(args.alarm, actions)
+
+def remember_alarm(event):
+    """Alarm action keeping the latest alarm for the curses screen."""
+    global last_alarm
+    last_alarm = event
+
+def window_lengths(value):
+    """Parses the comma-separated window lengths of the --windows option."""
+    try:
+        windows = [int(v) for v in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Window lengths need to be whole seconds: ' + str(value))
+    if min(windows) <= 0:
+        raise argparse.ArgumentTypeError('Window lengths need to be greater than 0: ' + str(value))
+    return windows
+
 def exit_nicely(signal, frame):
-    if args.datetime:
+    if args.action == 'live':
+        # The aggregator has summarised the live data per window
+        oxi.stored_data = oxi.aggregator.get_stored_data()
+    elif oxi.checkpoint_file:
+        # Keep what an interrupted download got hold of for the next attempt
+        oxi.finish_checkpoint()
+    if alarms is not None:
+        alarms.close()
+        print('\nAlarms: ' + alarms.latency.report())
+    if oxi.timebase is not None:
+        print('\nLive data frames: ' + str(oxi.timebase.frames) + ', gaps: '
+              + str(len(oxi.timebase.gaps)) + ' (' + str(round(sum(g[1] for g in oxi.timebase.gaps), 1))
+              + ' s), max. clock drift: ' + str(round(oxi.timebase.max_drift, 3)) + ' s')
+    if getattr(args, 'summary', None):
+        print('\nSaving window summaries to: ' + str(args.summary) + ' ...')
+        oxi.write_summary_csv(args.summary)
+    if args.datetime and oxi.stored_data:
         oxi.convert_datetime()
     if args.csv:
-        print('\nSaving live session data to: ' + str(args.csv) + ' ...')
+        print('\nSaving session data to: ' + str(args.csv) + ' ...')
         oxi.write_csv(args.csv)
+    if getattr(args, 'cmsz', None):
+        print('Saving live session data to: ' + str(args.cmsz) + ' ...')
+        oxi.write_cmsz(args.cmsz)
+    if args.feather:
+        print('Saving live session data to: ' + str(args.feather) + ' ...')
+        oxi.write_feather(args.feather)
+    if args.parquet:
+        print('Saving live session data to: ' + str(args.parquet) + ' ...')
+        oxi.write_parquet(args.parquet)
     if args.pygal:
         print('Plotting downloaded data with Pygal and saving plot to: ' + str(args.pygal) + ' ...')
         oxi.plot_pygal()
         oxi.write_svg(args.pygal)
+    if getattr(args, 'svg', None):
+        print('Plotting live session data and streaming plot to: ' + str(args.svg) + ' ...')
+        oxi.stream_svg(args.svg)
     if args.mpl:
         print('Plotting downloaded data with Matplotlib and displaying it ...')
         oxi.plot_mpl()
+    if oxi.waveform is not None:
+        print('Writing plethysmogram to: ' + str(getattr(args, 'waveform', None)) + ' ...')
+        oxi.waveform.close()
     print('Closing device ...')
     oxi.close_device()
     sys.exit(0)
@@ -165,43 +271,614 @@ def live():
     
 def download():
     """Function to deal with 'download' action argument"""
+    # exit_nicely() saves the partly downloaded session of the global instance
+    global oxi
     oxi = cms50ew.CMS50EW()
+    if args.datetime:
+        try:
+            oxi.pydatetime = duparser.parse(args.datetime)
+        except ValueError:
+            raise argparse.ArgumentTypeError('No valid date format')
     print('Connecting to device ' + str(args.device) + ' ...')
-    if not oxi.setup_device(target=args.device, is_bluetooth=args.bluetooth):
+    if not oxi.setup_device(target=args.device, is_bluetooth=args.bluetooth,
+                            is_replay=args.replay, speed=args.speed):
         raise Exception('Connection attempt unsuccessful.')
-    oxi.initiate_device()
-    oxi.get_session_count()
+    if args.capture:
+        oxi.start_capture(args.capture)
+    if oxi.get_device_info(max_age=0) is None:
+        raise Exception('No response from device.')
     if oxi.sess_available == 'No':
         raise Exception('No stored session data available.')
-    oxi.get_session_duration()
-    oxi.send_cmd(oxi.cmd_get_session_data)
-    counter = 1
-    while oxi.download_data():
-        print('Downloading data point ' + str(counter) + ' of ' + str(oxi.sess_data_points))
-        counter += 1
+    checkpointed = oxi.open_checkpoint()
+    if oxi.resume_checkpoint():
+        print('Using complete session data from checkpoint ' + oxi.checkpoint_file)
+    else:
+        if checkpointed:
+            print('Resuming download; verifying ' + str(checkpointed) + ' checkpointed data points')
+        oxi.send_cmd(oxi.cmd_get_session_data)
+        counter = 1
+        while oxi.download_data():
+            print('Downloading data point ' + str(counter) + ' of ' + str(oxi.sess_data_points))
+            counter += 1
+    oxi.stop_capture()
     print('Downloaded data points:', len(oxi.stored_data))
     
     if args.datetime:
-        try:
-            oxi.pydatetime = duparser.parse(args.datetime)
-        except ValueError:
-            raise argparse.ArgumentTypeError('No valid date format')
-        else:
-            oxi.convert_datetime()
+        oxi.convert_datetime()
             
     if args.csv:
         print('Saving downloaded data to: ' + str(args.csv) + ' ...')
         oxi.write_csv(args.csv)
     
+    if args.cmsz:
+        print('Saving downloaded data to: ' + str(args.cmsz) + ' ...')
+        oxi.write_cmsz(args.cmsz)
+    
+    if args.feather:
+        print('Saving downloaded data to: ' + str(args.feather) + ' ...')
+        oxi.write_feather(args.feather)
+    
+    if args.parquet:
+        print('Saving downloaded data to: ' + str(args.parquet) + ' ...')
+        oxi.write_parquet(args.parquet)
+    
     if args.pygal:
         print('Plotting downloaded data with Pygal and saving plot to: ' + str(args.pygal) + ' ...')
         oxi.plot_pygal()
         oxi.write_svg(args.pygal)
     
+    if args.svg:
+        print('Plotting downloaded data and streaming plot to: ' + str(args.svg) + ' ...')
+        oxi.stream_svg(args.svg)
+    
     if args.mpl:
         print('Plotting downloaded data with Matplotlib and displaying it ...')
         oxi.plot_mpl()
 
+def download_all():
+    """Function to deal with 'download-all' action argument"""
+    targets = list(args.device)
+    if args.scan:
+        print('Scanning for devices ...', file=sys.stderr)
+        devicescan = cms50ew.DeviceScan(is_bluetooth=args.bluetooth)
+        if args.bluetooth:
+            found = list(devicescan.devices_dict)
+        else:
+            found = devicescan.accessible_ports
+        targets += [target for target in found if target not in targets]
+    if not targets:
+        raise Exception('No devices given or found.')
+    os.makedirs(args.output, exist_ok=True)
+    
+    # Data points downloaded and expected by target; written by the download
+    # threads, read by the progress display
+    progress = {target: [0, 0] for target in targets}
+    # Set on SIGINT: downloads in progress stop and save what they got, the
+    # remaining devices are skipped
+    stop = threading.Event()
+    
+    def interrupt(signum, frame):
+        print('\nStopping downloads ...', file=sys.stderr)
+        stop.set()
+    
+    def fetch(target):
+        """Downloads and saves the session of one device, retrying failed attempts."""
+        def update(count, total):
+            progress[target] = [count, total]
+        
+        result = {'device': target, 'attempts': 0, 'data_points': 0, 'file': '', 'error': ''}
+        start = time.perf_counter()
+        for attempt in range(1, args.retries + 2):
+            if stop.is_set():
+                result['error'] = result['error'] or 'Canceled'
+                break
+            result['attempts'] = attempt
+            try:
+                oxi = cms50ew.download_session(target, is_bluetooth=args.bluetooth, is_replay=args.replay,
+                                               speed=args.speed, progress=update, stop=stop)
+            except (OSError, bluetooth.btcommon.BluetoothError, IndexError, ValueError) as e:
+                # Lost connections as well as garbled replies
+                result['error'] = str(e) or type(e).__name__
+            else:
+                if oxi.sess_available == 'No':
+                    result['error'] = 'No stored session data available'
+                    break
+                # An interrupted download is resumed from its checkpoint by the next attempt
+                complete = oxi.checkpoint_complete or len(oxi.stored_data) >= oxi.sess_data_points
+                result['error'] = '' if complete else 'Download incomplete'
+                if complete or attempt > args.retries or stop.is_set():
+                    break
+            if attempt <= args.retries:
+                stop.wait(args.retry_delay * attempt)
+        result['time'] = round(time.perf_counter() - start, 1)
+        if result['error'] and result['error'] != 'Download incomplete':
+            return result
+        
+        # Saved right away, so that finished sessions are safe whatever happens to the others
+        name = ''.join([c for c in (oxi.deviceid or target) if c.isalnum()])
+        name += '-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        filename = os.path.join(args.output, name + '.' + args.format)
+        n = 1
+        while os.path.exists(filename):
+            filename = os.path.join(args.output, name + '-' + str(n) + '.' + args.format)
+            n += 1
+        # The checkpoint of an incomplete session is kept for the next run
+        if args.format == 'cmsz':
+            oxi.write_cmsz(filename)
+        else:
+            oxi.write_csv(filename)
+        result.update(data_points=len(oxi.stored_data), file=filename)
+        return result
+    
+    print('Downloading from ' + str(len(targets)) + ' devices, ' + str(args.jobs) + ' at a time ...',
+          file=sys.stderr)
+    start = time.perf_counter()
+    results = []
+    signal.signal(signal.SIGINT, interrupt)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        futures = {executor.submit(fetch, target): target for target in targets}
+        pending = set(futures)
+        last_line = 0
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=1)
+            if stop.is_set():
+                # Devices which haven't been started are skipped
+                executor.shutdown(wait=False, cancel_futures=True)
+            for future in done:
+                if future.cancelled():
+                    result = {'device': futures[future], 'attempts': 0, 'data_points': 0, 'file': '',
+                              'error': 'Canceled'}
+                else:
+                    result = future.result()
+                results.append(result)
+                if result['file']:
+                    status = 'saved ' + str(result['data_points']) + ' data points to ' + result['file']
+                else:
+                    status = 'failed (' + result['error'] + ')'
+                print('[' + str(len(results)) + '/' + str(len(targets)) + '] ' + result['device'] + ': '
+                      + status + ' after ' + str(result['attempts']) + ' attempt(s)', file=sys.stderr)
+            now = time.perf_counter()
+            if pending and now - last_line >= args.progress:
+                downloaded = sum(count for count, total in progress.values())
+                expected = sum(total for count, total in progress.values())
+                active = len([target for target, (count, total) in progress.items() if 0 < count < total])
+                print('Progress: ' + str(len(results)) + ' of ' + str(len(targets)) + ' devices done, '
+                      + str(active) + ' downloading, ' + str(downloaded) + ' of ' + str(expected)
+                      + ' known data points, ' + str(round(downloaded / (now - start), 1))
+                      + ' data points/s', file=sys.stderr)
+                last_line = now
+    finally:
+        executor.shutdown(cancel_futures=True)
+    elapsed = time.perf_counter() - start
+    
+    # Final report
+    results.sort(key=lambda result: targets.index(result['device']))
+    saved = [result for result in results if result['file']]
+    data_points = sum(result['data_points'] for result in saved)
+    print('{:<20}{:>10}{:>13}{:>10}  {}'.format('Device', 'Attempts', 'Data points', 'Time [s]', 'Result'))
+    for result in results:
+        print('{:<20}{:>10}{:>13}{:>10}  {}'.format(result['device'], result['attempts'], result['data_points'],
+                                                    result.get('time', ''),
+                                                    result['file'] + (' (' + result['error'] + ')' if result['error'] else '')
+                                                    if result['file'] else 'failed: ' + result['error']))
+    print('Saved: ' + str(len(saved)) + ', failed: ' + str(len(results) - len(saved)) + ', data points: '
+          + str(data_points) + ', elapsed time: ' + str(round(elapsed, 1)) + ' s, throughput: '
+          + str(round(data_points / elapsed, 1)) + ' data points/s (' + str(round(data_points * 9 / elapsed / 1000, 1))
+          + ' kB/s)')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=1)
+    if len(saved) < len(results):
+        sys.exit(1)
+
+def record():
+    """
+    Function to deal with 'record' action argument: records live data without
+    a user interface, e.g. overnight. The process sleeps until the device has
+    sent data and handles whatever arrived at once. SIGHUP reloads the
+    configuration file and starts new output files, SIGTERM and SIGINT stop
+    recording after the current data has been written.
+    """
+    config = {'output': args.output, 'prefix': args.prefix, 'rotate_time': args.rotate_time,
+              'rotate_size': args.rotate_size, 'stats': args.stats}
+    requests = {'stop': False, 'reload': False}
+    
+    def load_config():
+        if args.config:
+            with open(args.config, 'r') as f:
+                config.update(json.load(f))
+        writer.directory = config['output']
+        writer.prefix = config['prefix']
+        writer.rotate_time = config['rotate_time']
+        writer.rotate_size = config['rotate_size'] and int(config['rotate_size'] * 1024 * 1024)
+        
+    def request(signum, frame):
+        if signum == signal.SIGHUP:
+            requests['reload'] = True
+        else:
+            requests['stop'] = True
+    
+    def report(frames, interval):
+        """Prints frame rate and resource usage of the recorder since the last report."""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time = usage.ru_utime + usage.ru_stime
+        print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ' frames: ' + str(frames)
+              + ' (' + str(round(frames / interval, 1)) + '/s), gaps: ' + str(len(oxi.timebase.gaps))
+              + ', CPU: ' + str(round((cpu_time - stats['cpu_time']) / interval * 100, 2))
+              + ' %, max. RSS: ' + str(round(usage.ru_maxrss / 1024, 1)) + ' MB, file: '
+              + str(writer.filename), file=sys.stderr, flush=True)
+        stats['cpu_time'] = cpu_time
+    
+    writer = cms50ew.RotatingWriter(args.output)
+    load_config()
+    alarms = setup_alarms()
+    signal.signal(signal.SIGTERM, request)
+    signal.signal(signal.SIGINT, request)
+    signal.signal(signal.SIGHUP, request)
+    
+    if not oxi.setup_device(target=args.device, is_bluetooth=args.bluetooth,
+                            is_replay=args.replay, speed=args.speed):
+        print('Connection attempt unsuccessful.', file=sys.stderr)
+        sys.exit(1)
+    if args.capture:
+        oxi.start_capture(args.capture)
+    print('Recording to ' + str(config['output']) + ' (PID ' + str(os.getpid()) + ') ...', file=sys.stderr)
+    
+    frame_parser = cms50ew.FrameParser()
+    oxi.timebase = oxi.new_timebase()
+    window = None # WindowAccumulator of the current second
+    # CPU time used so far, so that reports leave out the start-up
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {'cpu_time': usage.ru_utime + usage.ru_stime}
+    last_report = time.monotonic()
+    frames = 0
+    streaming = False
+    try:
+        while not requests['stop']:
+            if requests['reload']:
+                requests['reload'] = False
+                try:
+                    load_config()
+                except (OSError, ValueError) as e:
+                    print('Keeping configuration, reloading failed: ' + str(e), file=sys.stderr)
+                writer.close()
+                print('Configuration reloaded, starting new file', file=sys.stderr)
+            if not streaming:
+                oxi.initiate_device()
+                oxi.send_cmd(oxi.cmd_get_live_data)
+                oxi.timebase.restart()
+                streaming = True
+            
+            # Sleep until data arrives; a silent device has stopped streaming
+            if not oxi.wait_readable(args.timeout):
+                streaming = False
+                continue
+            try:
+                data = oxi.read_available()
+            except bluetooth.btcommon.BluetoothError:
+                streaming = False
+                continue
+            except EOFError:
+                break # A replayed capture has ended
+            arrival = time.perf_counter()
+            
+            for finger, pulse_rate, spo2, waveform in frame_parser.feed(data):
+                frames += 1
+                frame_time = oxi.timebase.tick()
+                if alarms is not None:
+                    alarms.process(frame_time, finger, pulse_rate, spo2, arrival)
+                second = int(frame_time)
+                if window is None or window.start != second:
+                    if window is not None:
+                        writer.write(session_row(window))
+                    window = cms50ew.WindowAccumulator(second)
+                window.add(finger, pulse_rate, spo2)
+            
+            now = time.monotonic()
+            if config['stats'] and now - last_report >= config['stats']:
+                report(frames, now - last_report)
+                frames = 0
+                last_report = now
+    finally:
+        if window is not None:
+            writer.write(session_row(window))
+        writer.finish()
+        oxi.close_device()
+        report(frames, max(time.monotonic() - last_report, 1e-3))
+        if alarms is not None:
+            alarms.close()
+            print('Alarms: ' + alarms.latency.report(), file=sys.stderr)
+        print('Recording stopped', file=sys.stderr)
+
+def session_row(window):
+    """Returns the summary of a window of live data as row with clock time."""
+    row = window.summary()[:4]
+    row[0] = datetime.datetime.fromtimestamp(oxi.timebase.starttime + row[0]).strftime('%H:%M:%S')
+    return row
+
+def find_sessions(paths, patterns=('*.csv',), names=False):
+    """
+    Expands directories (searched recursively for files matching patterns) and
+    glob patterns. With names, pairs of file and name for its outputs are
+    returned, see output_names().
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in patterns:
+                found = sorted(glob.glob(os.path.join(path, '**', pattern), recursive=True))
+                files.extend([(f, os.path.relpath(f, path)) for f in found if os.path.isfile(f)])
+        else:
+            files.extend([(f, os.path.basename(f)) for f in sorted(glob.glob(path))])
+    if names:
+        return output_names(files)
+    return [f for f, name in files]
+
+def output_names(files):
+    """
+    Takes pairs of file and its path relative to the directory it was found in
+    (or its file name) and returns pairs of file and name for its outputs: the
+    relative path without extension, numbered if it occurs more than once, so
+    that sessions of the same name in different places don't overwrite each
+    other's outputs.
+    """
+    named = []
+    used = set()
+    for filename, name in files:
+        name = os.path.splitext(name)[0]
+        unique = name
+        n = 2
+        while unique in used:
+            unique = name + '-' + str(n)
+            n += 1
+        used.add(unique)
+        named.append((filename, unique))
+    return named
+
+def analyze():
+    """Function to deal with 'analyze' action argument"""
+    files = find_sessions(args.path)
+    if not files:
+        raise Exception('No session files found.')
+    jobs = args.jobs or os.cpu_count()
+    print('Analyzing ' + str(len(files)) + ' session files using ' + str(jobs) + ' processes ...',
+          file=sys.stderr)
+    
+    # Hand out files in chunks to keep inter-process communication low
+    chunksize = max(1, len(files) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(cms50ew_analysis.analyze_file, files, chunksize=chunksize))
+    
+    columns = ['file', 'error', 'samples', 'duration', 'finger_out_fraction',
+               'spo2_mean', 'spo2_min', 'spo2_max', 'pulse_mean', 'pulse_min', 'pulse_max',
+               'valid_time', 't90', 'desaturations_3', 'odi_3', 'desaturations_4', 'odi_4',
+               'pulse_excursions']
+    if args.output:
+        f = open(args.output, 'w', newline='')
+    else:
+        f = sys.stdout
+    datawriter = csv.DictWriter(f, fieldnames=columns, restval='')
+    datawriter.writeheader()
+    datawriter.writerows(results)
+    if args.output:
+        f.close()
+        print('Summary written to: ' + str(args.output), file=sys.stderr)
+    failed = len([r for r in results if r['error']])
+    if failed:
+        print(str(failed) + ' files could not be analyzed', file=sys.stderr)
+
+def merge():
+    """Function to deal with 'merge' action argument"""
+    sessions = []
+    names = set()
+    for session in args.session:
+        filename, separator, start = session.partition('@')
+        start = start or args.date
+        try:
+            start = duparser.parse(start) if start else None
+        except ValueError:
+            raise argparse.ArgumentTypeError('No valid date format: ' + str(start))
+        data = cms50ew_analysis.load_session(filename)
+        try:
+            start = cms50ew_analysis.session_start(data, start)
+        except ValueError:
+            raise Exception(filename + ': specify start time as ' + filename + '@<time> or use --date')
+        # Column names are made up of the file names, which need to be unique
+        name = os.path.splitext(os.path.basename(filename))[0]
+        n = 2
+        while name in names:
+            name = os.path.splitext(os.path.basename(filename))[0] + '-' + str(n)
+            n += 1
+        names.add(name)
+        sessions.append((name, start, data))
+    
+    start_time = time.perf_counter()
+    grid, merged = cms50ew_analysis.merge_sessions(sessions, step=args.step, tolerance=args.tolerance,
+                                                   method=args.method)
+    
+    header = ['Time']
+    columns = [np.datetime_as_string(grid, unit='s' if args.step % 1 == 0 else 'ms')]
+    for name, data in merged:
+        header += [name + ' finger out', name + ' pulse rate [bpm]', name + ' SpO2 [%]']
+        present = data['present']
+        columns.append(np.where(present, np.where(data['finger_out'], 'Y', 'N'), ''))
+        for key in ('pulse_rate', 'spo2'):
+            values = data[key]
+            if values.dtype.kind == 'f':
+                values = np.where(values % 1 == 0, values.astype(np.int64).astype(str), values.astype(str))
+            columns.append(np.where(present, values.astype(str), ''))
+    if args.output:
+        f = open(args.output, 'w', newline='')
+    else:
+        f = sys.stdout
+    datawriter = csv.writer(f)
+    datawriter.writerow(header)
+    datawriter.writerows(zip(*[column.tolist() for column in columns]))
+    if args.output:
+        f.close()
+    print('Merged ' + str(len(sessions)) + ' sessions into ' + str(len(grid)) + ' rows in '
+          + str(round(time.perf_counter() - start_time, 2)) + ' s', file=sys.stderr)
+
+def ls():
+    """Function to deal with 'ls' action argument"""
+    start_time = time.perf_counter()
+    files = find_sessions(args.path, patterns=('*.csv', '*.cmsz'))
+    summaries = {}
+    stale = []
+    for filename in files:
+        summary = cms50ew.read_session_summary(filename)
+        if summary is None:
+            stale.append(filename)
+        else:
+            summaries[filename] = summary
+    
+    # Only sessions without an up-to-date sidecar are read
+    rebuilt = 0
+    failed = []
+    if stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+            futures = {executor.submit(cms50ew.session_summary, filename): filename for filename in stale}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    summaries[futures[future]], is_rebuilt = future.result()
+                except (OSError, ValueError, StopIteration, struct.error) as e:
+                    failed.append(futures[future] + ': ' + (str(e) or type(e).__name__))
+                    continue
+                rebuilt += is_rebuilt
+    
+    keys = {'name': lambda f: f,
+            'date': lambda f: summaries[f]['mtime'],
+            'duration': lambda f: summaries[f]['duration'],
+            'spo2': lambda f: summaries[f]['spo2_min']}
+    # Sessions without valid data have no minimum SpO2 and are listed last
+    listed = sorted([f for f in summaries if args.sort != 'spo2' or summaries[f]['spo2_min'] is not None],
+                    key=keys[args.sort], reverse=args.reverse)
+    listed += sorted([f for f in summaries if f not in listed])
+    columns = ['file', 'modified', 'duration', 'samples', 'finger_out_fraction', 'spo2_min', 'spo2_mean',
+               'spo2_max', 'pulse_min', 'pulse_mean', 'pulse_max', 'desaturations_3', 'desaturations_4']
+    rows = []
+    for filename in listed:
+        summary = summaries[filename]
+        modified = datetime.datetime.fromtimestamp(summary['mtime'] / 1e9).strftime('%Y-%m-%d %H:%M')
+        rows.append([filename, modified, str(datetime.timedelta(seconds=round(summary['duration'])))]
+                    + ['' if summary[key] is None else str(summary[key]) for key in columns[3:]])
+    if args.csv:
+        datawriter = csv.writer(sys.stdout)
+        datawriter.writerow(columns)
+        datawriter.writerows(rows)
+    else:
+        header = ['File', 'Modified', 'Duration', 'Samples', 'Finger out', 'SpO2 min', 'mean', 'max',
+                  'Pulse min', 'mean', 'max', 'Desat 3%', '4%']
+        widths = [max([len(header[n])] + [len(row[n]) for row in rows]) for n in range(len(header))]
+        for row in [header] + rows:
+            print('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width
+                                                         in zip(row[1:], widths[1:])]))
+    for failure in failed:
+        print('Could not summarize ' + failure, file=sys.stderr)
+    print(str(len(summaries)) + ' sessions, ' + str(rebuilt) + ' summaries rebuilt in '
+          + str(round(time.perf_counter() - start_time, 3)) + ' s', file=sys.stderr)
+
+def decode():
+    """Function to deal with 'decode' action argument"""
+    files = find_sessions(args.file, patterns=('*',), names=True)
+    if not files:
+        raise Exception('No capture files found.')
+    jobs = []
+    for filename, name in files:
+        csv_file = os.path.join(args.output, name + '.csv')
+        os.makedirs(os.path.dirname(csv_file), exist_ok=True)
+        jobs.append((filename, csv_file, args.keep_malformed))
+    
+    totals = {'bytes': 0, 'frames': 0, 'malformed': 0, 'truncated': 0, 'discarded': 0, 'gaps': 0, 'decode_time': 0}
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(cms50ew.decode_session, *job): job for job in jobs}
+        for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            filename, csv_file, keep_malformed = futures[future]
+            try:
+                report = future.result()
+            except (OSError, ValueError, struct.error) as e:
+                print('[' + str(n) + '/' + str(len(jobs)) + '] ' + filename + ': failed (' + str(e) + ')')
+                failed += 1
+                continue
+            for key in totals:
+                totals[key] += report[key]
+            print('[' + str(n) + '/' + str(len(jobs)) + '] ' + filename + ': ' + str(report['frames'])
+                  + ' frames, ' + str(report['malformed']) + ' malformed, ' + str(report['truncated'])
+                  + ' truncated, ' + str(report['discarded']) + ' bytes discarded, ' + str(report['gaps'])
+                  + ' gaps -> ' + csv_file)
+    
+    print('Decoded: ' + str(len(jobs) - failed) + ', failed: ' + str(failed) + ', frames: ' + str(totals['frames'])
+          + ', malformed: ' + str(totals['malformed']) + ', truncated: ' + str(totals['truncated'])
+          + ', bytes discarded: ' + str(totals['discarded']) + ', gaps: ' + str(totals['gaps']))
+    if totals['decode_time']:
+        print('Decoding throughput: ' + str(round(totals['bytes'] / totals['decode_time'] / 1e6)) + ' MB/s per process')
+
+def render():
+    """Function to deal with 'render' action argument"""
+    if not args.svg and not args.svgz and not args.png:
+        raise Exception('Specify at least one of --svg, --svgz and --png.')
+    files = find_sessions(args.path, names=True)
+    if not files:
+        raise Exception('No session files found.')
+    os.makedirs(args.output, exist_ok=True)
+    
+    # The manifest remembers content hashes of rendered session files, so a
+    # session file whose modification time changed without its content changing
+    # isn't rendered again
+    manifest_file = os.path.join(args.output, '.render-manifest.json')
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    
+    jobs = []
+    skipped = 0
+    for filename, name in files:
+        # Subdirectories of the session files are mirrored in the output directory
+        os.makedirs(os.path.dirname(os.path.join(args.output, name)), exist_ok=True)
+        svg = os.path.join(args.output, name + '.svg') if args.svg else None
+        svgz = os.path.join(args.output, name + '.svgz') if args.svgz else None
+        png = os.path.join(args.output, name + '.png') if args.png else None
+        outputs = [o for o in (svg, svgz, png) if o]
+        known_hash = None
+        if not args.force and all(os.path.exists(o) for o in outputs):
+            if min(os.path.getmtime(o) for o in outputs) >= os.path.getmtime(filename):
+                skipped += 1
+                continue
+            known_hash = manifest.get(os.path.abspath(filename))
+        jobs.append((filename, svg, png, known_hash, svgz))
+    print('Rendering ' + str(len(jobs)) + ' of ' + str(len(files)) + ' sessions ('
+          + str(skipped) + ' up to date) ...')
+    
+    rendered = unchanged = failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(cms50ew.render_session, *job): job for job in jobs}
+        for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            filename, svg, png, known_hash, svgz = futures[future]
+            try:
+                content_hash, is_rendered = future.result()
+            except Exception as e:
+                print('[' + str(n) + '/' + str(len(jobs)) + '] ' + filename + ': failed (' + str(e) + ')')
+                failed += 1
+                continue
+            manifest[os.path.abspath(filename)] = content_hash
+            if is_rendered:
+                rendered += 1
+                print('[' + str(n) + '/' + str(len(jobs)) + '] ' + filename + ': rendered')
+            else:
+                # Content is unchanged; mark the plots as up to date
+                for o in (svg, svgz, png):
+                    if o:
+                        os.utime(o)
+                unchanged += 1
+    
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print('Rendered: ' + str(rendered) + ', unchanged: ' + str(skipped + unchanged) + ', failed: ' + str(failed))
+
 # Main parser
 parser = argparse.ArgumentParser()
 subparsers = parser.add_subparsers(help='specify action to perform', dest='action')
@@ -212,33 +889,155 @@ parser_live = subparsers.add_parser('live', help='display live data in curses UI
 parser_live.set_defaults(func=live)
 parser_live.add_argument('-b', '--bluetooth', 
                          help='specify if connection is to be established via Bluetooth (default is serial)', action='store_true')
+parser_live.add_argument('--replay', help='treat device as file recorded with --capture and replay it', action='store_true')
+parser_live.add_argument('--speed', type=float, default=1.0, help='replay speed factor; 0 replays as fast as possible (default: 1)')
+parser_live.add_argument('--capture', metavar='file', help='record all bytes received from the device in file')
 parser_live.add_argument('-r', '--raw', help='use raw mode, i.e. print live data in a script-friendly manner as "<Finger out> <Pulse rate> <SpO2>"', action='store_true')
 parser_live.add_argument('--csv', metavar='file', help='store live session data in CSV file')
+parser_live.add_argument('--cmsz', metavar='file', help='store live session data in compressed session file')
+parser_live.add_argument('--feather', metavar='file', help='store live session data in Arrow IPC (Feather) file (requires pyarrow)')
+parser_live.add_argument('--parquet', metavar='file', help='store live session data in Parquet file (requires pyarrow)')
 parser_live.add_argument('--pygal', metavar='file', help='plot live data with Pygal and store it as SVG')
+parser_live.add_argument('--svg', metavar='file', help='plot live data and stream it to an SVG file (compressed if file ends in .svgz)')
 parser_live.add_argument('--mpl', help='plot live data with Matplotlib and display it',
                              action='store_true')
 parser_live.add_argument('--datetime', help='use current time as start time for stored live session data', action='store_true')
-parser_live.add_argument('device', help='specify serial port or MAC address of Bluetooth device')
+parser_live.add_argument('--windows', metavar='seconds', default='1,3,30',
+                         type=window_lengths,
+                         help='comma-separated lengths of the windows live data is summarised in; the shortest one is used for the stored session (default: 1,3,30)')
+parser_live.add_argument('--waveform', metavar='file', help='capture the plethysmogram at the full frame rate in binary file')
+parser_live.add_argument('--summary', metavar='file', help='store window summaries (mean, min, max, finger out and low signal fractions) of all window lengths in CSV file')
+parser_live.add_argument('--alarm', metavar='rule', action='append', type=cms50ew_alarms.parse_rule,
+                         help='raise an alarm when pulse or spo2 has crossed a threshold for some seconds, e.g. "spo2<90:10" or "pulse>120:5:2" (seconds and hysteresis are optional); may be repeated')
+parser_live.add_argument('--alarm-command', metavar='command', help='run shell command for every alarm, which is described in CMS50EW_* environment variables')
+parser_live.add_argument('--alarm-socket', metavar='address', help='send every alarm as JSON datagram to host:port (UDP) or a Unix socket path')
+parser_live.add_argument('device', help='specify serial port or MAC address of Bluetooth device (or capture file with --replay)')
 
 # Parser for 'download' action argument
 parser_download = subparsers.add_parser('download', help='download stored session data')
 parser_download.set_defaults(func=download)
 parser_download.add_argument('-b', '--bluetooth', 
                              help='specify if connection is to be established via Bluetooth (default is serial)', action='store_true')
+parser_download.add_argument('--replay', help='treat device as file recorded with --capture and replay it', action='store_true')
+parser_download.add_argument('--speed', type=float, default=1.0, help='replay speed factor; 0 replays as fast as possible (default: 1)')
+parser_download.add_argument('--capture', metavar='file', help='record all bytes received from the device in file')
 parser_download.add_argument('device', 
-                             help='specify serial port or MAC address of Bluetooth device')
+                             help='specify serial port or MAC address of Bluetooth device (or capture file with --replay)')
 parser_download.add_argument('--csv', metavar='file', help='store saved data in CSV file')
+parser_download.add_argument('--cmsz', metavar='file', help='store saved data in compressed session file')
+parser_download.add_argument('--feather', metavar='file', help='store saved data in Arrow IPC (Feather) file (requires pyarrow)')
+parser_download.add_argument('--parquet', metavar='file', help='store saved data in Parquet file (requires pyarrow)')
 parser_download.add_argument('--pygal', metavar='file', help='plot data with Pygal and store it as SVG')
+parser_download.add_argument('--svg', metavar='file', help='plot data and stream it to an SVG file (compressed if file ends in .svgz)')
 parser_download.add_argument('--mpl', help='plot data with Matplotlib and display it',
                              action='store_true')
 parser_download.add_argument('--datetime', help='specify start time of recording, e.g. 16 Mar 2017 22:30')
 
-# Parse arguments
-args = parser.parse_args()
+# Parser for 'download-all' action argument
+parser_download_all = subparsers.add_parser('download-all', help='download stored session data from many devices in parallel')
+parser_download_all.set_defaults(func=download_all)
+parser_download_all.add_argument('-b', '--bluetooth',
+                                 help='specify if connections are to be established via Bluetooth (default is serial)', action='store_true')
+parser_download_all.add_argument('--scan', help='also download from all devices found by a scan', action='store_true')
+parser_download_all.add_argument('--replay', help='treat devices as files recorded with --capture and replay them', action='store_true')
+parser_download_all.add_argument('--speed', type=float, default=1.0, help='replay speed factor; 0 replays as fast as possible (default: 1)')
+parser_download_all.add_argument('-o', '--output', metavar='dir', required=True, help='directory to store sessions in')
+parser_download_all.add_argument('--format', choices=('csv', 'cmsz'), default='csv',
+                                 help='store sessions as CSV or compressed session files (default: csv)')
+parser_download_all.add_argument('-j', '--jobs', type=int, default=8, help='number of devices to download from at a time (default: 8)')
+parser_download_all.add_argument('--retries', type=int, default=2, help='number of further attempts for a failed download (default: 2)')
+parser_download_all.add_argument('--retry-delay', metavar='seconds', type=float, default=5,
+                                 help='wait before the first retry, increasing with every further one (default: 5)')
+parser_download_all.add_argument('--progress', metavar='seconds', type=float, default=5,
+                                 help='interval of progress reports (default: 5)')
+parser_download_all.add_argument('--report', metavar='file', help='write the results of all devices to JSON file')
+parser_download_all.add_argument('device', nargs='*',
+                                 help='serial ports or MAC addresses of Bluetooth devices (or capture files with --replay)')
+
+# Parser for 'record' action argument
+parser_record = subparsers.add_parser('record', help='record live data without user interface, e.g. as a daemon')
+parser_record.set_defaults(func=record)
+parser_record.add_argument('-b', '--bluetooth', help='specify if connection is to be established via Bluetooth (default is serial)', action='store_true')
+parser_record.add_argument('--replay', help='treat device as file recorded with --capture and replay it', action='store_true')
+parser_record.add_argument('--speed', type=float, default=1.0, help='replay speed factor; 0 replays as fast as possible (default: 1)')
+parser_record.add_argument('--capture', metavar='file', help='record all bytes received from the device in file')
+parser_record.add_argument('-o', '--output', metavar='dir', default='.', help='directory to store CSV files in (default: current directory)')
+parser_record.add_argument('--prefix', default='session', help='name prefix of CSV files (default: session)')
+parser_record.add_argument('--rotate-time', metavar='seconds', type=float, default=3600, help='start a new file after this many seconds (default: 3600, 0 to disable)')
+parser_record.add_argument('--rotate-size', metavar='MB', type=float, help='start a new file once the current one exceeds this size')
+parser_record.add_argument('--config', metavar='file', help='JSON file overriding output, prefix, rotate_time, rotate_size and stats; reloaded on SIGHUP')
+parser_record.add_argument('--stats', metavar='seconds', type=float, default=60, help='report frame rate, CPU and memory use to stderr at this interval (default: 60, 0 to disable)')
+parser_record.add_argument('--timeout', metavar='seconds', type=float, default=2, help='restart the live data stream if the device is silent for this long (default: 2)')
+parser_record.add_argument('--alarm', metavar='rule', action='append', type=cms50ew_alarms.parse_rule,
+                           help='raise an alarm when pulse or spo2 has crossed a threshold for some seconds, e.g. "spo2<90:10" or "pulse>120:5:2" (seconds and hysteresis are optional); may be repeated')
+parser_record.add_argument('--alarm-command', metavar='command', help='run shell command for every alarm, which is described in CMS50EW_* environment variables')
+parser_record.add_argument('--alarm-socket', metavar='address', help='send every alarm as JSON datagram to host:port (UDP) or a Unix socket path')
+parser_record.add_argument('device', help='specify serial port or MAC address of Bluetooth device (or capture file with --replay)')
+
+# Parser for 'analyze' action argument
+parser_analyze = subparsers.add_parser('analyze', help='compute summary statistics of many CSV session files in parallel')
+parser_analyze.set_defaults(func=analyze)
+parser_analyze.add_argument('path', nargs='+',
+                            help='directory (searched recursively for CSV files) or glob pattern of session files')
+parser_analyze.add_argument('-o', '--output', metavar='file', help='write summary table to CSV file instead of stdout')
+parser_analyze.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: number of CPUs)')
+
+# Parser for 'merge' action argument
+parser_merge = subparsers.add_parser('merge', help='align CSV session files of several devices on absolute time')
+parser_merge.set_defaults(func=merge)
+parser_merge.add_argument('session', nargs='+',
+                          help='CSV session file, followed by @ and its start time if its times are in seconds, e.g. "session.csv@16 Mar 2017 22:30"')
+parser_merge.add_argument('-o', '--output', metavar='file', help='write merged table to CSV file instead of stdout')
+parser_merge.add_argument('--date', help='date of sessions with clock times, or start time of all sessions without @')
+parser_merge.add_argument('--step', metavar='seconds', type=float, default=1, help='interval of the merged table (default: 1)')
+parser_merge.add_argument('--tolerance', metavar='seconds', type=float, default=3,
+                          help='maximum distance of samples from the rows they are used for (default: 3)')
+parser_merge.add_argument('--method', choices=('last', 'nearest', 'mean'), default='last',
+                          help='use the last sample up to each row, the nearest sample or the mean of the samples since the previous row (default: last)')
 
-# Set up an oximeter instance and introduce signal handling
-oxi = cms50ew.CMS50EW()
-signal.signal(signal.SIGINT, exit_nicely)
+# Parser for 'ls' action argument
+parser_ls = subparsers.add_parser('ls', help='list CSV and compressed session files with summary statistics')
+parser_ls.set_defaults(func=ls)
+parser_ls.add_argument('path', nargs='*', default=['.'],
+                       help='directory (searched recursively for session files) or glob pattern of session files (default: .)')
+parser_ls.add_argument('-s', '--sort', choices=('name', 'date', 'duration', 'spo2'), default='name',
+                       help='sort by file name, modification time, duration or minimum SpO2 (default: name)')
+parser_ls.add_argument('-r', '--reverse', help='reverse the order', action='store_true')
+parser_ls.add_argument('--csv', help='print the list as CSV', action='store_true')
+parser_ls.add_argument('-j', '--jobs', type=int, help='number of worker processes for outdated summaries (default: number of CPUs)')
+
+# Parser for 'decode' action argument
+parser_decode = subparsers.add_parser('decode', help='decode capture files or raw dumps of live data to CSV session files')
+parser_decode.set_defaults(func=decode)
+parser_decode.add_argument('file', nargs='+', help='capture file (see --capture) or file of raw received bytes, glob pattern of them or directory to search recursively')
+parser_decode.add_argument('-o', '--output', metavar='dir', required=True, help='directory to store CSV session files in')
+parser_decode.add_argument('--keep-malformed', help='keep frames with corrupted data bytes, which are left out by default', action='store_true')
+parser_decode.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: number of CPUs)')
+
+# Parser for 'render' action argument
+parser_render = subparsers.add_parser('render', help='plot many CSV session files in parallel')
+parser_render.set_defaults(func=render)
+parser_render.add_argument('path', nargs='+',
+                           help='directory (searched recursively for CSV files) or glob pattern of session files')
+parser_render.add_argument('-o', '--output', metavar='dir', required=True, help='directory to store plots in')
+parser_render.add_argument('--svg', help='plot with Pygal and store as SVG', action='store_true')
+parser_render.add_argument('--svgz', help='plot and stream to compressed SVG (SVGZ) without Pygal', action='store_true')
+parser_render.add_argument('--png', help='plot with Matplotlib and store as PNG', action='store_true')
+parser_render.add_argument('-f', '--force', help='render all sessions even if their plots are up to date', action='store_true')
+parser_render.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: number of CPUs)')
+
+# Worker processes of the 'analyze' action may import this module again
+if __name__ == '__main__':
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Set up an oximeter instance and introduce signal handling
+    oxi = cms50ew.CMS50EW()
+    analytics = cms50ew_analysis.LiveAnalytics()
+    alarms = None # AlarmPipeline of 'live' action
+    last_alarm = None
+    if args.action in ('live', 'download'):
+        signal.signal(signal.SIGINT, exit_nicely)
 
-# Run action function
-args.func()
+    # Run action function
+    args.func()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import json
+import struct
+import numpy as np
+
+# File layout (all integers little endian):
+# - file header: magic, version, flags, block size, number of samples, first
+#   time and period in milliseconds, number of blocks, length of metadata
+# - session metadata as JSON
+# - block index: byte offset of every block relative to the end of the index
+# - blocks, each made up of a block header holding the number of samples and
+#   the byte lengths of its streams, followed by the streams: finger flags
+#   bit-packed, pulse rate and SpO2 (and time if it isn't implicit) as
+#   run-length encoded deltas, i.e. zigzag varints of delta values followed by
+#   varints of their run lengths
+MAGIC = b'CMSZ'
+VERSION = 1
+FLAG_IMPLICIT_TIME = 1
+file_header = struct.Struct('<4sBBIQqqII')
+block_header = struct.Struct('<IIIIIIII')
+
+def encode_varints(values):
+    """Encodes non-negative integers as LEB128 varints, vectorised."""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28, 35, 42, 49, 56, 63):
+        lengths += values >= (np.uint64(1) << np.uint64(bits))
+    # Position of every output byte within its varint
+    owners = np.repeat(np.arange(len(values)), lengths)
+    positions = np.arange(len(owners)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    out = (values[owners] >> (np.uint64(7) * positions.astype(np.uint64))) & np.uint64(0x7f)
+    out = out.astype(np.uint8)
+    # Set the continuation bit on all but the last byte of every varint
+    out[positions < lengths[owners] - 1] |= 0x80
+    return out.tobytes()
+
+def decode_varints(data):
+    """Decodes a buffer of LEB128 varints, vectorised."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    positions = np.arange(len(data)) - np.repeat(starts, lengths)
+    parts = (data & 0x7f).astype(np.int64) << (7 * positions)
+    return np.add.reduceat(parts, starts)
+
+def encode_channel(values):
+    """Returns the run-length encoded deltas of an integer channel and the number of runs."""
+    deltas = np.diff(np.asarray(values, dtype=np.int64), prepend=0)
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(zigzag)) + 1))
+    run_lengths = np.diff(np.append(starts, len(zigzag)))
+    return encode_varints(zigzag[starts]) + encode_varints(run_lengths), len(starts)
+
+def decode_channel(data, runs):
+    """Reverses encode_channel()."""
+    varints = decode_varints(data)
+    zigzag, run_lengths = varints[:runs], varints[runs:]
+    deltas = (zigzag >> 1) ^ -(zigzag & 1)
+    return np.cumsum(np.repeat(deltas, run_lengths))
+
+def encode(time, finger, pulse, spo2, metadata=None, block_size=4096):
+    """
+    Encodes a session given as arrays of time in seconds, finger (True if finger
+    out), pulse rate and SpO2 and returns it as bytes. If the samples are evenly
+    spaced, only the first time and the period are stored.
+    """
+    time_ms = np.round(np.asarray(time, dtype=np.float64) * 1000).astype(np.int64)
+    finger = np.asarray(finger, dtype=bool)
+    pulse = np.asarray(pulse, dtype=np.int64)
+    spo2 = np.asarray(spo2, dtype=np.int64)
+    n = len(time_ms)
+
+    flags = 0
+    first = int(time_ms[0]) if n else 0
+    period = 0
+    if n < 2:
+        flags |= FLAG_IMPLICIT_TIME
+    else:
+        intervals = np.diff(time_ms)
+        if np.all(intervals == intervals[0]):
+            flags |= FLAG_IMPLICIT_TIME
+            period = int(intervals[0])
+
+    blocks = []
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        finger_bytes = np.packbits(finger[start:end]).tobytes()
+        pulse_bytes, pulse_runs = encode_channel(pulse[start:end])
+        spo2_bytes, spo2_runs = encode_channel(spo2[start:end])
+        if flags & FLAG_IMPLICIT_TIME:
+            time_bytes, time_runs = b'', 0
+        else:
+            time_bytes, time_runs = encode_channel(time_ms[start:end])
+        blocks.append(block_header.pack(end - start, len(finger_bytes),
+                                        pulse_runs, len(pulse_bytes),
+                                        spo2_runs, len(spo2_bytes),
+                                        time_runs, len(time_bytes))
+                      + finger_bytes + pulse_bytes + spo2_bytes + time_bytes)
+
+    metadata_bytes = json.dumps(metadata or {}).encode()
+    offsets = np.cumsum([0] + [len(b) for b in blocks[:-1]]).astype('<u8')
+    return b''.join([file_header.pack(MAGIC, VERSION, flags, block_size, n, first, period,
+                                      len(blocks), len(metadata_bytes)),
+                     metadata_bytes, offsets.tobytes()] + blocks)
+
+class Reader():
+    """Gives access to the metadata and blocks of an encoded session."""
+    def __init__(self, data):
+        self.data = memoryview(data)
+        (magic, version, self.flags, self.block_size, self.samples, self.first,
+         self.period, n_blocks, metadata_length) = file_header.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a compressed CMS50EW session')
+        position = file_header.size
+        self.metadata = json.loads(bytes(self.data[position:position + metadata_length]))
+        position += metadata_length
+        self.offsets = np.frombuffer(self.data[position:position + 8 * n_blocks], dtype='<u8')
+        self.blocks_start = position + 8 * n_blocks
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def block(self, index):
+        """Decodes a single block and returns its columns as a dictionary of arrays."""
+        position = self.blocks_start + int(self.offsets[index])
+        (count, finger_length, pulse_runs, pulse_length, spo2_runs, spo2_length,
+         time_runs, time_length) = block_header.unpack_from(self.data, position)
+        position += block_header.size
+        finger = np.unpackbits(np.frombuffer(self.data[position:position + finger_length],
+                                             dtype=np.uint8), count=count).astype(bool)
+        position += finger_length
+        pulse = decode_channel(self.data[position:position + pulse_length], pulse_runs)
+        position += pulse_length
+        spo2 = decode_channel(self.data[position:position + spo2_length], spo2_runs)
+        position += spo2_length
+        if self.flags & FLAG_IMPLICIT_TIME:
+            start = index * self.block_size
+            time_ms = self.first + self.period * np.arange(start, start + count, dtype=np.int64)
+        else:
+            time_ms = decode_channel(self.data[position:position + time_length], time_runs)
+        return {'time': time_ms / 1000,
+                'finger': finger,
+                'pulse': pulse.astype(np.uint8),
+                'spo2': spo2.astype(np.uint8)}
+
+    def blocks(self):
+        """Yields the decoded blocks one after another."""
+        for index in range(len(self)):
+            yield self.block(index)
+
+def decode(data):
+    """Decodes a whole session and returns its metadata and columns as in Reader.block()."""
+    reader = Reader(data)
+    blocks = list(reader.blocks())
+    if not blocks:
+        columns = {'time': np.zeros(0), 'finger': np.zeros(0, dtype=bool),
+                   'pulse': np.zeros(0, dtype=np.uint8), 'spo2': np.zeros(0, dtype=np.uint8)}
+    else:
+        columns = {key: np.concatenate([b[key] for b in blocks]) for key in blocks[0]}
+    return reader.metadata, columns
@@ -8,9 +8,12 @@ import numpy as np
 import time
 import datetime
 import sys
+import os
 # Bluetooth is imported solely to handle exceptions; needs some rethinking.
 import bluetooth
 import cms50ew
+import cms50ew_analysis
+import cms50ew_acquisition
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -104,15 +107,20 @@ class MainWindow(QMainWindow):
     def on_liveRunAction(self):
         if not self.live_running:
             self.live_running = True
-            self.liveThread = LiveThread(self.oxi)
+            # Live data is read by a process of its own, which needs the device
+            self.oxi.close_device()
+            self.acquisition = cms50ew_acquisition.AcquisitionProcess(
+                self.oxi.target, is_bluetooth=self.oxi.is_bluetooth, is_replay=self.oxi.is_replay)
+            self.acquisition.start()
+            self.liveThread = LiveThread(self.oxi, self.acquisition)
             self.liveThread.start()
             self.liveRunAction.setIcon(QtGui.QIcon('icons/media-playback-stop-symbolic.svg'))
             self.sessDialogAction.setEnabled(False)
             self.statusBar.showMessage('Status: Initiating live stream ...')
         else:
             self.live_running = False
-            time.sleep(0.2) # Give thread the chance to end itself
-            self.oxi.close_device()
+            self.liveThread.wait(1000) # Give thread the chance to end itself
+            self.acquisition.stop()
             self.liveRunAction.setIcon(QtGui.QIcon('icons/media-playback-start-symbolic.svg'))
             self.liveRunAction.setEnabled(False)
             self.statusBar.showMessage('Status: Disconnected')
@@ -126,7 +134,18 @@ class MainWindow(QMainWindow):
         self.saveDialog.exec_()
     
     def on_quitAction(self):
+        self.close()
+        
+    def closeEvent(self, event):
+        # However the window is closed, live data acquisition is stopped and
+        # spilled live data removed
         self.live_running = False
+        if hasattr(self, 'liveThread'):
+            self.liveThread.wait(1000) # Give thread the chance to end itself
+            self.acquisition.stop()
+        if hasattr(self, 'oxi') and self.oxi.live_data is not None:
+            self.oxi.live_data.close()
+        event.accept()
         app.quit()
 
 class MainWidget(QWidget):
@@ -140,27 +159,105 @@ class MainWidget(QWidget):
         ## Create widgets
         self.label_pulse_rate = QtGui.QLabel('Pulse rate: n/a')
         self.label_spo2 = QtGui.QLabel('SpO2: n/a')
+        self.label_analytics = QtGui.QLabel('Statistics: n/a')
+        self.label_throughput = QtGui.QLabel('Throughput: n/a')
 
         ### Create pyqtgraph widgets
-        pulse_plot = pg.PlotWidget(title='Pulse rate')
+        self.pulse_plot = pulse_plot = pg.PlotWidget(title='Pulse rate')
         pulse_plot.setLabel('left', text='Pulse rate [bpm]')
         pulse_plot.setLabel('bottom', text='Time [s]')
         pulse_plot.setYRange(0, 220)
 
-        spo2_plot = pg.PlotWidget(title='SpO2')
+        self.spo2_plot = spo2_plot = pg.PlotWidget(title='SpO2')
         spo2_plot.setLabel('left', text='SpO2 [%]')
         spo2_plot.setLabel('bottom', text='Time [s]')
         spo2_plot.setYRange(0, 100)
+        spo2_plot.setXLink(pulse_plot)
 
         pg.setConfigOptions(antialias=True)
 
         self.pulse_curve = pulse_plot.plot(pen=pg.mkPen('r', width=2))
         self.spo2_curve = spo2_plot.plot(pen=pg.mkPen('c', width=2))
         
+        # Live data older than what's kept in memory is paged back in from
+        # disk when the user scrolls there
+        self.live_data = None
+        self.loaded_range = (float('inf'), float('inf'))
+        self.paging = False
+        pulse_plot.sigXRangeChanged.connect(self.on_rangeChanged)
+        # Recorded sessions are plotted from a cms50ew.MinMaxPyramid at the
+        # level of detail matching the visible range
+        self.pyramid = None
+        self.loaded_level = None
+        
         layout.addWidget(self.label_pulse_rate, 0, 0, 1, 0)
         layout.addWidget(self.label_spo2, 1, 0, 1, 0)
-        layout.addWidget(pulse_plot, 2, 0, 1, 1)
-        layout.addWidget(spo2_plot, 2, 1, 1, 1)
+        layout.addWidget(self.label_analytics, 2, 0, 1, 0)
+        layout.addWidget(pulse_plot, 3, 0, 1, 1)
+        layout.addWidget(spo2_plot, 3, 1, 1, 1)
+        layout.addWidget(self.label_throughput, 4, 0, 1, 0)
+        
+    def following(self):
+        """Returns True unless the user has panned or zoomed away from the latest data."""
+        return bool(self.pulse_plot.getViewBox().autoRangeEnabled()[0])
+    
+    def set_live_data(self, live_data):
+        """Clears the curves to plot live data from LiveDataStore live_data."""
+        self.pulse_curve.clear()
+        self.spo2_curve.clear()
+        self.live_data = live_data
+        self.loaded_range = (float('inf'), float('inf'))
+        self.pyramid = None
+        
+    def set_live_curves(self, data, loaded_range):
+        """Plots an array of LiveDataStore samples covering loaded_range."""
+        self.paging = True
+        self.pulse_curve.setData(data['time'], data['pulse'])
+        self.spo2_curve.setData(data['time'], data['spo2'])
+        self.loaded_range = loaded_range
+        self.paging = False
+        
+    def set_pyramid(self, pyramid):
+        """Plots a recorded session from its MinMaxPyramid, showing all of it."""
+        self.pyramid = pyramid
+        self.loaded_level = None
+        self.loaded_range = (float('inf'), float('inf'))
+        self.set_pyramid_curves(pyramid.time[0], pyramid.time[-1])
+        self.pulse_plot.getViewBox().enableAutoRange()
+        
+    def set_pyramid_curves(self, start, end):
+        """Plots the level of detail matching start to end seconds, plus a margin on both sides."""
+        pixels = int(self.pulse_plot.getViewBox().width()) or 1000
+        margin = end - start
+        level, time, values = self.pyramid.select(start - margin, end + margin, 3 * pixels)
+        self.paging = True
+        self.pulse_curve.setData(time, values['pulse'])
+        self.spo2_curve.setData(time, values['spo2'])
+        self.loaded_range = (start - margin, end + margin)
+        self.loaded_level = level
+        self.paging = False
+        
+    def on_rangeChanged(self, viewbox, x_range):
+        if self.paging:
+            return
+        start, end = x_range
+        if self.live_data is None:
+            if self.pyramid is not None:
+                # Switch level when zooming, and load more when panning beyond the margin
+                pixels = int(self.pulse_plot.getViewBox().width()) or 1000
+                level = self.pyramid.level(start - (end - start), end + (end - start), 3 * pixels)[0]
+                if (level != self.loaded_level or start < self.loaded_range[0]
+                        or end > self.loaded_range[1]):
+                    self.set_pyramid_curves(start, end)
+            return
+        # While following, LiveThread plots the samples in memory, and the auto
+        # range must not page in older data, which would widen it again
+        if self.following() or (self.loaded_range[0] <= start and end <= self.loaded_range[1]):
+            return
+        # Load some data beyond both sides of the view to make panning smooth
+        margin = end - start
+        data = self.live_data.get_range(start - margin, end + margin)
+        self.set_live_curves(data, (start - margin, end + margin))
         
 class SessionDialog(QDialog):
     def __init__(self, is_csv=False, is_live=False):
@@ -269,10 +366,12 @@ class SessionDialog(QDialog):
             self.plotMplButton.setEnabled(True)
             self.saveCSVButton.setEnabled(True)
         else:
-            w.oxi.initiate_device()
-            w.oxi.get_user()
-            w.oxi.get_session_count()
-            w.oxi.get_session_duration()
+            # Queried afresh rather than from the cache filled by DeviceDialog:
+            # the session may have changed, and the query initiates the device
+            # for the download
+            if w.oxi.get_device_info(max_age=0) is None:
+                self.getInfoButton.setText('No response from device')
+                return
         
             self.sessionTable.setItem(0, 0, QTableWidgetItem(w.oxi.sess_available))
             self.sessionTable.setItem(1, 0, QTableWidgetItem(w.oxi.user))
@@ -291,50 +390,55 @@ class SessionDialog(QDialog):
         
     def getSessionData(self):
         if not self.is_csv and not self.is_live:
-            self.dlThread = DownloadDataThread()
+            # The progress dialog lives in the GUI thread; the download thread
+            # only reports to it via signals
+            self.dlDialog = DownloadData()
+            self.dlThread = DownloadDataThread(w.oxi)
+            self.dlThread.progressChanged.connect(self.on_downloadProgress)
+            self.dlThread.sessionDownloaded.connect(self.on_sessionDownloaded)
+            self.dlDialog.canceled.connect(self.dlThread.cancel)
+            self.dlDialog.show()
             self.dlThread.start()
+            
+    def on_downloadProgress(self, value):
+        self.dlDialog.setValue(min(value, w.oxi.sess_data_points))
+        
+    def on_sessionDownloaded(self, stored_data):
+        self.sessionTable.setItem(4, 0, QTableWidgetItem(str(len(stored_data))))
+        if self.dlThread.canceled:
+            # Incomplete session data isn't offered for plotting or saving
+            self.dlDialog.close()
+            self.getInfoButton.setText('Download canceled.')
+            return
+        self.dlDialog.setValue(w.oxi.sess_data_points)
+        #self.dateTimeEdit.setEnabled(True)
+        self.plotButton.setEnabled(True)
+        self.plotPygalButton.setEnabled(True)
+        self.plotMplButton.setEnabled(True)
+        self.saveCSVButton.setEnabled(True)
+        self.eraseSessionButton.setEnabled(False)
+        self.getInfoButton.setText('Download finished.')
     
     def build_data_list(self):
-        # Empty list in case a session was download before
-        w.oxi.stored_data = []
-        data_point = 0
-        
-        while data_point != w.oxi.n_data_points:
-            if w.oxi.stored_data: # Could still be empty
-                delta_time = w.oxi.stored_data[-1][0]
-            else:
-                delta_time = -1
-            
-            if (w.oxi.pulse_xdata[data_point] - delta_time) > 1: # Saving one data point 
-                                                                 # per second is plenty, 
-                                                                 # I think
-                # Build list of values in format [time, finger_status, pulse_rate, spo2_value]
-                values = [ round(w.oxi.pulse_xdata[data_point]), w.oxi.finger_data[data_point],
-                          w.oxi.pulse_ydata[data_point], w.oxi.spo2_ydata[data_point]]
-                # Append value list to stored_data list.
-                w.oxi.stored_data.append(values)
-            data_point += 1
+        # The live thread has already summarised the data per second; take over
+        # the finest resolution as session data
+        w.oxi.stored_data = w.oxi.aggregator.get_stored_data()
         
         w.oxi.sess_available = 'Yes'
         w.oxi.sess_duration = datetime.timedelta(seconds=w.oxi.stored_data[-1][0])
     
     def on_plotData(self):
-        # Reset plot data and rendered plot
-        w.oxi.pulse_xdata = []
-        w.oxi.pulse_ydata = []
-        w.oxi.spo2_xdata = []
-        w.oxi.spo2_ydata = []
+        # Reset plot data and rendered plot; full rate live data isn't plotted anymore
+        if w.oxi.live_data is not None:
+            w.oxi.live_data.close()
+            w.oxi.live_data = None
+        w.cw.live_data = None
         w.cw.pulse_curve.clear()
         w.cw.spo2_curve.clear()
-
-        for data in w.oxi.stored_data:
-            w.oxi.pulse_ydata.append(data[2])
-            w.oxi.pulse_xdata.append(data[0])
-            w.oxi.spo2_ydata.append(data[3])
         
-        # Render plot
-        w.cw.pulse_curve.setData(w.oxi.pulse_xdata, w.oxi.pulse_ydata)
-        w.cw.spo2_curve.setData(w.oxi.pulse_xdata, w.oxi.spo2_ydata)
+        # Render plot; only as many points as the plot is wide are drawn
+        if w.oxi.stored_data:
+            w.cw.set_pyramid(w.oxi.get_pyramid())
         
     def on_dateCheck(self):
         if self.dateCheckBox.isChecked():
@@ -420,44 +524,53 @@ class PlotPygal(QDialog):
             print('No file selected')
 
 class DownloadDataThread(QtCore.QThread):
-    """Downloads stored session data as a thread to allow UI responsiveness"""
-    def __init__(self):
+    """
+    Downloads stored session data as a thread to allow UI responsiveness.
+    The thread never touches any widget itself: progress is reported in batches
+    via progressChanged and the finished session via sessionDownloaded, both of
+    which are delivered to the GUI thread by Qt's queued connections.
+    """
+    progressChanged = QtCore.pyqtSignal(int)
+    sessionDownloaded = QtCore.pyqtSignal(object)
+    
+    def __init__(self, oxi):
         super().__init__()
+        self.oxi = oxi
+        self.canceled = False
+        self.progress_interval = 0.1 # Report progress at most every 100 ms
         
-    def run(self):
-        self.diag = DownloadData()
-        self.diag.show()
-        time.sleep(0.1) # Allow the window to be constructed to avoid crash when 
-                        # download is finished too fast
-        self.downloadData()
+    def cancel(self):
+        """Asks the download loop to stop; safe to call from the GUI thread."""
+        self.canceled = True
 
-    def downloadData(self):
-        w.oxi.send_cmd(w.oxi.cmd_get_session_data)
-        value = 1
-        w.oxi.stored_data = []
-        while w.oxi.download_data(): # CMS50EW.download_data() return False if no data is left
-            if self.diag.wasCanceled():
+    def run(self):
+        # Data points from an interrupted download are kept in a checkpoint and
+        # verified against what the device sends rather than being thrown away
+        self.oxi.open_checkpoint()
+        if self.oxi.resume_checkpoint():
+            print('Using complete session data from checkpoint')
+            self.progressChanged.emit(len(self.oxi.stored_data))
+            self.sessionDownloaded.emit(self.oxi.stored_data)
+            return
+        self.oxi.send_cmd(self.oxi.cmd_get_session_data)
+        self.oxi.stored_data = []
+        last_report = time.monotonic()
+        while self.oxi.download_data(): # CMS50EW.download_data() return False if no data is left
+            if self.canceled:
                 print('Download canceled by user')
-                # Now reset device
-                w.oxi.close_device()
-                w.oxi.setup_device()
-                w.oxi.initiate_device()
                 break
-            if value < w.oxi.sess_data_points:
-                self.diag.setValue(value)
-            else:
-                self.diag.setValue(w.oxi.sess_data_points)
-            value += 1
-        self.diag.setValue(w.oxi.sess_data_points)
-        w.sessDialog.sessionTable.setItem(4, 0,
-                                             QTableWidgetItem(str(len(w.oxi.stored_data))))
-        #w.sessDialog.dateTimeEdit.setEnabled(True)
-        w.sessDialog.plotButton.setEnabled(True)
-        w.sessDialog.plotPygalButton.setEnabled(True)
-        w.sessDialog.plotMplButton.setEnabled(True)
-        w.sessDialog.saveCSVButton.setEnabled(True)
-        w.sessDialog.eraseSessionButton.setEnabled(False)
-        w.sessDialog.getInfoButton.setText('Download finished.')
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval:
+                self.progressChanged.emit(len(self.oxi.stored_data))
+                last_report = now
+        if self.canceled:
+            # Stop the device sending the rest of the data and bring it back
+            # into a defined state without reconnecting
+            self.oxi.stop_stream()
+            self.oxi.stored_data_time = 0
+            self.oxi.finish_checkpoint()
+        self.progressChanged.emit(len(self.oxi.stored_data))
+        self.sessionDownloaded.emit(self.oxi.stored_data)
         print('Downloading data finished')
         
 class DownloadData(QProgressDialog):
@@ -479,6 +592,7 @@ class DeviceDialog(QDialog):
         super().__init__()
         
         self.is_bluetooth = is_bluetooth
+        self.scanThread = None
         
         if self.is_bluetooth:
             type = 'Bluetooth'
@@ -521,6 +635,12 @@ class DeviceDialog(QDialog):
         self.devicesTable.horizontalHeader().setStretchLastSection(True)
         self.devicesTable.itemDoubleClicked.connect(self.onItemClicked)
         
+        # Oximeters which answered before are listed right away
+        if self.is_bluetooth:
+            self.known_devices = cms50ew.KnownDevices()
+            for address, name in self.known_devices.names().items():
+                self.addDevice(address, name + ' (seen before)')
+        
         self.infoTable = QTableWidget()
         # Make the table uneditable
         self.infoTable.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)  
@@ -547,27 +667,68 @@ class DeviceDialog(QDialog):
         
     def scan(self):
         """Scan for devices and populate table with results. """
+        if self.scanThread is not None and self.scanThread.isRunning():
+            return # A Bluetooth scan is still running
         self.scanButton.setText('Scanning ...')
         QtGui.QApplication.processEvents()
         
+        if self.is_bluetooth:
+            # Bluetooth scans take several seconds; devices are added as they are found
+            self.scanButton.setEnabled(False)
+            self.scanThread = BluetoothScanThread()
+            self.scanThread.deviceFound.connect(self.addDevice)
+            self.scanThread.finished.connect(self.on_scanFinished)
+            self.scanThread.start()
+            return
+        
         devicescan = cms50ew.DeviceScan(is_bluetooth=self.is_bluetooth)
         
         row = 0
-        if self.is_bluetooth:
-            self.devicesTable.setRowCount(len(devicescan.devices_dict))
-            for address, name in devicescan.devices_dict.items():
-                self.devicesTable.setItem(row, 0, QTableWidgetItem(address))
-                self.devicesTable.setItem(row, 1, QTableWidgetItem(name))
-                row += 1
-        else:
-            self.devicesTable.setRowCount(len(devicescan.accessible_ports))
-            for port in devicescan.accessible_ports:
-                self.devicesTable.setItem(row, 0, QTableWidgetItem(port))
-                row += 1
+        self.devicesTable.setRowCount(len(devicescan.accessible_ports))
+        for port in devicescan.accessible_ports:
+            self.devicesTable.setItem(row, 0, QTableWidgetItem(port))
+            row += 1
 
         self.scanButton.setText('Scan finished')
         QtGui.QApplication.processEvents()
         
+    def addDevice(self, address, name):
+        """Adds a Bluetooth device to the table or updates its name."""
+        for row in range(self.devicesTable.rowCount()):
+            if self.devicesTable.item(row, 0).text() == address:
+                break
+        else:
+            row = self.devicesTable.rowCount()
+            self.devicesTable.setRowCount(row + 1)
+            self.devicesTable.setItem(row, 0, QTableWidgetItem(address))
+        self.devicesTable.setItem(row, 1, QTableWidgetItem(name))
+        
+    def on_scanFinished(self):
+        self.scanButton.setText('Scan finished')
+        self.scanButton.setEnabled(True)
+        
+    def done(self, result):
+        # A running scan can't be interrupted; the thread mustn't be destroyed
+        # before it has finished, e.g. when the dialog is opened again
+        if self.scanThread is not None:
+            self.scanButton.setText('Finishing scan ...')
+            QtGui.QApplication.processEvents()
+            self.scanThread.wait()
+        super().done(result)
+        
+    def closeEvent(self, event):
+        if self.scanThread is not None:
+            self.scanThread.wait()
+        super().closeEvent(event)
+        
+    def rememberDevice(self):
+        """Records the target as known oximeter with the name shown in the table."""
+        name = None
+        for row in range(self.devicesTable.rowCount()):
+            if self.devicesTable.item(row, 0).text() == self.target and self.devicesTable.item(row, 1):
+                name = self.devicesTable.item(row, 1).text().replace(' (seen before)', '')
+        self.known_devices.remember(self.target, name)
+        
     def onItemClicked(self):
         """Get wanted device from table and retrieve information"""
         item = self.devicesTable.selectedItems()[0]        
@@ -579,28 +740,28 @@ class DeviceDialog(QDialog):
         self.scanButton.setText('Retrieving info from ' + self.target + ' ...')
         QtGui.QApplication.processEvents()
         
-        oxi = cms50ew.CMS50EW()
-        
-        oxi.setup_device(self.target, is_bluetooth=self.is_bluetooth)
+        # Information retrieved before is reused without opening the device
+        info = cms50ew.cached_device_info(self.target)
+        if info is None:
+            oxi = cms50ew.CMS50EW()
+            if oxi.setup_device(self.target, is_bluetooth=self.is_bluetooth):
+                info = oxi.get_device_info()
+                oxi.close_device()
             
-        if not oxi.initiate_device():
+        if info is None:
             self.scanButton.setText('No response from device')
             QtGui.QApplication.processEvents()
         else:
-            oxi.get_model()
-            oxi.get_vendor()
-            oxi.get_user()
-            oxi.get_session_count()
-            oxi.get_session_duration()
-        
-            self.infoTable.setItem(0, 0, QTableWidgetItem(oxi.vendor))
-            self.infoTable.setItem(1, 0, QTableWidgetItem(oxi.model))
-            self.infoTable.setItem(2, 0, QTableWidgetItem(oxi.user))
+            self.infoTable.setItem(0, 0, QTableWidgetItem(info['vendor']))
+            self.infoTable.setItem(1, 0, QTableWidgetItem(info['model']))
+            self.infoTable.setItem(2, 0, QTableWidgetItem(info['user']))
             self.infoTable.setItem(3, 0, 
-                                   QTableWidgetItem(str(oxi.sess_available + ' (Duration: ' + str(oxi.sess_duration) + ')')))
+                                   QTableWidgetItem(str(info['sess_available'] + ' (Duration: ' + str(info['sess_duration']) + ')')))
             
             self.scanButton.setText('Device information received')
             QtGui.QApplication.processEvents()
+            if self.is_bluetooth:
+                self.rememberDevice()
             
     def onDeviceClicked(self):
         self.setupDevice()
@@ -617,6 +778,7 @@ class DeviceDialog(QDialog):
         if w.oxi.setup_device(self.target, is_bluetooth=self.is_bluetooth):
             if w.oxi.is_bluetooth:
                 w.statusBar.showMessage('Status: Connected to Bluetooth device')
+                self.rememberDevice()
             else:
                 w.statusBar.showMessage('Status: Opened serial port')
             w.liveRunAction.setEnabled(True)
@@ -626,120 +788,237 @@ class DeviceDialog(QDialog):
             w.statusBar.showMessage('Status: Connection attempt unsuccessful')
             self.close()
 
+class BluetoothScanThread(QtCore.QThread):
+    """Scans for Bluetooth devices, emitting deviceFound for each as soon as its name is known."""
+    deviceFound = QtCore.pyqtSignal(str, str)
+    
+    def run(self):
+        cms50ew.DeviceScan(is_bluetooth=True, callback=self.deviceFound.emit)
+
 class LiveThread(QtCore.QThread):
-    def __init__(self, oxi):
+    """
+    Processes live data read by a cms50ew_acquisition.AcquisitionProcess: new
+    samples are taken from its shared memory ring in batches and handled as
+    numpy arrays without converting single samples, so this thread doesn't
+    touch the device and mostly sleeps. Like DownloadDataThread, it
+    doesn't touch widgets either: curves, labels and status are updated via
+    signals, which Qt delivers to the GUI thread. Curves are only plotted from
+    the latest copy of the live data, however many have been made since the
+    last plot.
+    """
+    liveDataChanged = QtCore.pyqtSignal(object)
+    curvesChanged = QtCore.pyqtSignal()
+    statusChanged = QtCore.pyqtSignal(str)
+    pulseRateChanged = QtCore.pyqtSignal(str)
+    spo2Changed = QtCore.pyqtSignal(str)
+    analyticsChanged = QtCore.pyqtSignal(str)
+    throughputChanged = QtCore.pyqtSignal(str)
+    
+    def __init__(self, oxi, acquisition):
         super().__init__()
         self.oxi = oxi
+        self.acquisition = acquisition
+        self.liveDataChanged.connect(self.on_liveDataChanged)
+        self.curvesChanged.connect(self.on_curvesChanged)
+        self.curves = None # Latest live data to plot and its range
+        self.curves_pending = False # True until the GUI thread has taken self.curves
+        self.statusChanged.connect(w.statusBar.showMessage)
+        self.pulseRateChanged.connect(w.cw.label_pulse_rate.setText)
+        self.spo2Changed.connect(w.cw.label_spo2.setText)
+        self.analyticsChanged.connect(w.cw.label_analytics.setText)
+        self.throughputChanged.connect(w.cw.label_throughput.setText)
+        self.sequence = 0 # Sequence number of the ring read up to
+        self.lost = 0 # Samples overwritten in the ring before they were read
 
     def run(self):
         """
         Initiates live data feed and keeps it alive as long as our main QWidget is running.
         """
-        w.cw.pulse_curve.clear()
-        w.cw.spo2_curve.clear()
-        self.oxi.pulse_xdata = []
-        self.oxi.pulse_ydata = []
-        self.oxi.spo2_xdata = []
-        self.oxi.spo2_ydata = []
-        self.oxi.initiate_device()
-        self.oxi.send_cmd(self.oxi.cmd_get_live_data)
+        # The GUI thread switches over to the new store and closes the old one
+        self.live_data = cms50ew.LiveDataStore()
+        self.liveDataChanged.emit(self.live_data)
+        self.oxi.aggregator = cms50ew.SampleAggregator()
+        self.analytics = cms50ew_analysis.LiveAnalytics()
         self.oxi.currentdatetime = QtCore.QDateTime.currentDateTime()
-        self.oxi.starttime = time.time()
-        while w.live_running:
-            try:
-                self.update_plot()
-            except (TypeError, bluetooth.btcommon.BluetoothError):
-                # The following if condition prevents printing the restarting message 
-                # if oxi.close_device is called while thread is running
-                if w.live_running:
-                    print('Something happened.\nRestarting live feed ...')
-                    self.oxi.initiate_device()
-                    self.oxi.send_cmd(self.oxi.cmd_get_live_data)  
+        # Restarts of the live data stream are dealt with by the acquisition process
+        self.oxi.timebase = None
+        try:
+            self.update_plot()
+        except EOFError:
+            print('Live data acquisition has ended')
+    
+    def on_liveDataChanged(self, live_data):
+        """Replaces the live data store of the previous run; called in the GUI thread."""
+        if self.oxi.live_data is not None:
+            self.oxi.live_data.close()
+        self.oxi.live_data = live_data
+        w.cw.set_live_data(live_data)
+        
+    def on_curvesChanged(self):
+        """Plots the latest live data; called in the GUI thread."""
+        self.curves_pending = False
+        # Only the samples in memory are plotted while following the live data;
+        # older ones are paged in by MainWidget on demand
+        if w.cw.following():
+            w.cw.set_live_curves(*self.curves)
                     
-    def append_plot_data(self, pulse_rate, spo2):
+    def append_plot_data(self, samples, pulse_rate, spo2):
         """
-        Helper function for self.update_plot() to append the actual live 
-        data to the lists which get plotted eventually.
+        Helper function for self.process_samples() to append a batch of live
+        data to the store which gets plotted eventually, as well as to the
+        aggregator and analytics; pulse rate and SpO2 are given as arrays to
+        support 'Finger out' and 'Low signal quality' events, see
+        self.process_samples() for more details.
         """
-        # Pulse rate and finger can be supplied as arguments to support appending
-        # 'Finger out' and 'Low signal quality' events; see self.update_plot() 
-        # for more details
-        self.oxi.timer = time.time()
-        self.oxi.pulse_xdata.append(self.oxi.timer - self.oxi.starttime)
-        self.oxi.pulse_ydata.append(pulse_rate)
-        self.oxi.spo2_xdata.append(self.oxi.timer - self.oxi.starttime)
-        self.oxi.spo2_ydata.append(spo2)
-        self.oxi.finger_data.append(self.finger)
+        # Frame times are derived from the frame rate by the acquisition process
+        data = np.empty(len(samples), dtype=cms50ew.LiveDataStore.dtype)
+        data['time'] = samples['time']
+        data['pulse'] = pulse_rate
+        data['spo2'] = spo2
+        data['finger'] = samples['finger']
+        self.live_data.extend(data)
+        self.oxi.aggregator.extend(data['time'], data['finger'], data['pulse'], data['spo2'])
+        self.analytics.extend(data['time'], data['finger'], data['pulse'], data['spo2'])
+        
+    def update_throughput(self, interval):
+        """Shows how many samples both processes handled and lost since the last update."""
+        stats = self.acquisition.stats()
+        self.throughputChanged.emit(
+            'Acquisition: ' + str(round((stats['frames'] - self.reported) / interval, 1))
+            + ' frames/s, ' + str(stats['gaps']) + ' gaps, ' + str(stats['discarded'])
+            + ' bytes discarded, ' + str(stats['restarts'] - 1) + ' stream restarts  |  Display: '
+            + str(round(self.processed / interval, 1)) + ' samples/s, '
+            + str(self.lost) + ' samples lost')
+        self.reported = stats['frames']
+        self.processed = 0
+        
+    def update_analytics(self):
+        """Shows the statistics of the live session below the live values."""
+        report = self.analytics.report()
+        self.analyticsChanged.emit(
+            'Last ' + str(self.analytics.pulse.length) + ' s: pulse rate '
+            + str(report['pulse_min']) + '-' + str(report['pulse_max']) + ' bpm (mean '
+            + str(report['pulse_mean']) + '), SpO2 ' + str(report['spo2_min']) + '-'
+            + str(report['spo2_max']) + ' % (mean ' + str(report['spo2_mean']) + ')  |  '
+            + 'ODI-3: ' + str(report['desaturations_3']) + ' (' + str(report['odi_3']) + '/h), '
+            + 'ODI-4: ' + str(report['desaturations_4']) + ' (' + str(report['odi_4']) + '/h), '
+            + 'T90: ' + str(report['t90']) + ' s, pulse rate excursions: '
+            + str(report['pulse_excursions']))
         
     def update_plot(self):
         """Feeds plotting process with live data."""
 
         # The following variables serve to update the status only once if nothing changes
-        finger_out = False
-        low_signal_quality = False
-        processing_data = False
+        self.finger_out = False
+        self.low_signal_quality = False
+        self.processing_data = False
         if w.oxi.is_bluetooth:
-            counter = 11
+            self.counter = 11
         else:
-            counter = 0
+            self.counter = 0
     
+        self.reported = 0
+        self.processed = 0
+        last_update = time.monotonic()
         while w.live_running:
-            data = w.oxi.process_data()
-            self.finger = data[0]
-            self.pulse_rate = data[1]
-            self.spo2 = data[2]
+            if time.monotonic() - last_update >= 1:
+                self.update_throughput(time.monotonic() - last_update)
+                last_update = time.monotonic()
+            # The ring's views are processed in place, long before the
+            # acquisition process can overwrite them
+            parts, self.sequence, lost = self.acquisition.ring.read(self.sequence)
+            self.lost += lost
+            parts = [part for part in parts if len(part)]
+            if not parts:
+                if not self.acquisition.is_alive():
+                    raise EOFError('Live data acquisition has ended')
+                self.msleep(20)
+                continue
+            for part in parts:
+                self.process_samples(part)
+                self.processed += len(part)
     
-            if self.finger == 'Y':
-                # The counter serves to suppress small hiccups where the device reports
-                # "Finger out" when it in fact isn't.
-                if not finger_out and (counter > 20):
-                    self.append_plot_data(0, 0)
-                    w.statusBar.showMessage('Status: Finger out')
-                    w.cw.label_pulse_rate.setText('Pulse rate: n/a')
-                    w.cw.label_spo2.setText('SpO2: n/a')
-                    print('Finger out!')
-                    finger_out = True
-                    low_signal_quality = False
-                    processing_data = False
-                    counter = 0
-                elif not finger_out and (counter < 21):
-                    # If there have been less than n "Finger out" events, just
-                    # append the last valid value.
-                    self.append_plot_data(self.oxi.pulse_ydata[-1],
-                                          self.oxi.spo2_ydata[-1])
-                    counter += 1
+    def process_samples(self, samples):
+        """
+        Handles an array of samples from the ring at once: pulse rate and SpO2
+        are stored as 0 while the finger is out or the signal quality is low,
+        and the status is updated if it differs after the batch.
+        """
+        finger = samples['finger']
+        pulse_rate = samples['pulse'].copy()
+        spo2 = samples['spo2'].copy()
+        low_signal = ~finger & ((pulse_rate == 0) | (spo2 == 0))
+        pulse_rate[finger | low_signal] = 0
+        spo2[finger | low_signal] = 0
+        
+        # The counter serves to suppress small hiccups where the device reports
+        # "Finger out" when it in fact isn't: for up to 21 "Finger out" samples
+        # since the last time it was shown, just the last valid value is
+        # repeated. Runs of "Finger out" samples are handled as a whole.
+        edges = np.diff(np.concatenate(([0], finger.view(np.int8), [0])))
+        for first, end in zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()):
+            if first == 0 and self.finger_out:
+                continue # Still out, '0' values are supplied
+            self.finger_out = False
+            held = max(0, min(21 - self.counter, end - first))
+            if held:
+                if first:
+                    last = pulse_rate[first - 1], spo2[first - 1]
                 else:
-                    # If 'finger_out' is 'True', also supply '0' values.
-                    self.append_plot_data(pulse_rate=0, spo2=0)
-                    
-            elif (self.pulse_rate == 0) or (self.spo2 == 0):
-                self.append_plot_data(0, 0)
-                if not low_signal_quality:
-                    w.statusBar.showMessage('Status: Low signal quality')
-                    w.cw.label_pulse_rate.setText('Pulse rate: n/a')
-                    w.cw.label_spo2.setText('SpO2: n/a')
+                    last = self.live_data.last()
+                pulse_rate[first:first + held], spo2[first:first + held] = last
+                self.counter += held
+            if first + held < end:
+                self.counter = 0
+                self.finger_out = end == len(finger)
+                if self.finger_out:
+                    self.statusChanged.emit('Status: Finger out')
+                    self.pulseRateChanged.emit('Pulse rate: n/a')
+                    self.spo2Changed.emit('SpO2: n/a')
+                    print('Finger out!')
+                    self.low_signal_quality = False
+                    self.processing_data = False
+        self.append_plot_data(samples, pulse_rate, spo2)
+        
+        self.frame_time = samples['time'][-1].item()
+        self.pulse_rate = samples['pulse'][-1].item()
+        self.spo2 = samples['spo2'][-1].item()
+        if finger[-1]:
+            self.finger = 'Y'
+        else:
+            self.finger = 'N'
+            self.finger_out = False
+            if low_signal[-1]:
+                if not self.low_signal_quality:
+                    self.statusChanged.emit('Status: Low signal quality')
+                    self.pulseRateChanged.emit('Pulse rate: n/a')
+                    self.spo2Changed.emit('SpO2: n/a')
                     print('Low signal quality!')
-                    finger_out = False
-                    low_signal_quality = True
-                    processing_data = False
+                    self.low_signal_quality = True
+                    self.processing_data = False
             else:
-                self.append_plot_data(self.pulse_rate, self.spo2)
-                if not processing_data:
-                    w.statusBar.showMessage('Status: Processing data ...')
-                finger_out = False
-                low_signal_quality = False
-                processing_data = True
-                
-            if (self.oxi.n_data_points % 20) == 0:
-                w.cw.pulse_curve.setData(self.oxi.pulse_xdata, self.oxi.pulse_ydata)
-                w.cw.spo2_curve.setData(self.oxi.spo2_xdata, self.oxi.spo2_ydata)
+                if not self.processing_data:
+                    self.statusChanged.emit('Status: Processing data ...')
+                self.low_signal_quality = False
+                self.processing_data = True
                 
-                w.cw.label_pulse_rate.setText(str('Pulse rate: ' + str(self.pulse_rate) + ' bpm'))
-                w.cw.label_spo2.setText(str('SpO2: ' + str(self.spo2) + ' %'))
+        # Every 20 samples, as the previous sample by sample handling did
+        if -self.oxi.n_data_points % 20 < len(samples):
+            self.curves = (self.live_data.get_hot(), (self.live_data.hot_start(), float('inf')))
+            if not self.curves_pending:
+                self.curves_pending = True
+                self.curvesChanged.emit()
+            
+            self.pulseRateChanged.emit(str('Pulse rate: ' + str(self.pulse_rate) + ' bpm'))
+            self.spo2Changed.emit(str('SpO2: ' + str(self.spo2) + ' %'))
+            self.update_analytics()
 
-            self.oxi.n_data_points += 1
+        self.oxi.n_data_points += len(samples)
             
 if __name__ == '__main__':
+    # Keep rendered Pygal charts across dialogs and program runs
+    cms50ew.chart_cache.directory = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cms50ew', 'charts')
     app = QApplication(sys.argv)
     w = MainWindow()
 